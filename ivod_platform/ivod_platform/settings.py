@@ -189,6 +189,64 @@ DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 DATA_ALLOW_UNORDERED = False
 CHART_FILE_WHITELIST = ['config.json', 'site.html', 'shape.json']
 
+# In-process LRU cache for small chart artifacts (config.json, small data.json), per worker process.
+# Sizes are the estimated memory of the loaded values, parsed JSON takes several times the size of its file
+ARTIFACT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+ARTIFACT_CACHE_MAX_ENTRY_BYTES = 256 * 1024
+
+# Chart data: downsampled variants kept per chart and maximum number of rows per page
+CHART_DOWNSAMPLE_CACHE_ENTRIES = 16
+CHART_DATA_MAX_PAGE_SIZE = 10000
+# Chart bundles include data files up to this size in bytes, dashboard resolution returns at most this many bytes
+CHART_BUNDLE_INLINE_DATA_LIMIT = 64 * 1024
+DASHBOARD_RESOLVE_MAX_BYTES = 1024 * 1024
+
+# Maximum size of an uploaded datasource file in bytes
+DATASOURCE_MAX_UPLOAD_SIZE = 1024 ** 3
+# Compression of uploaded datasource files at rest: None, 'gzip' or 'zstd' (requires zstandard, falls back to gzip).
+# Existing files are compressed with the management command compress_datasources
+DATASOURCE_COMPRESSION = None
+DATASOURCE_COMPRESSION_LEVEL_GZIP = 6
+DATASOURCE_COMPRESSION_LEVEL_ZSTD = 10
+# Resumable uploads: default and maximum chunk size in bytes, unfinished sessions are removed by db_gc after their lifetime
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_SESSION_LIFETIME = datetime.timedelta(days=1)
+
+# Threads re-rendering charts in the background after rows were appended to their datasource
+CHART_RERENDER_WORKERS = 2
+# Threads converting, profiling and compressing uploaded datasource content in the background
+DATASOURCE_PREPARE_WORKERS = 1
+
+# Storage reconciliation (management command reconcile_storage): files without database entry are removed once they
+# are older than the minimum age, or moved into the quarantine directory. Interrupted runs resume from the state file.
+STORAGE_ORPHAN_MIN_AGE = datetime.timedelta(hours=1)
+STORAGE_QUARANTINE_PATH = None
+STORAGE_RECONCILE_STATE_FILE = None
+
+# Remote datasources: pooled connections per host, (connect, read) timeouts in seconds and caching of reachability checks
+REMOTE_POOL_SIZE = 10
+REMOTE_TIMEOUT = (3.05, 10)
+REMOTE_CHECK_CACHE_SECONDS = 60
+# Accept url datasources right away and check them in the background, unless requested otherwise per request
+DATASOURCE_VERIFY_ASYNC = False
+# Datasource previews: default and maximum number of rows, cached entries per worker process and lifetime of remote previews in seconds
+PREVIEW_DEFAULT_ROWS = 10
+PREVIEW_MAX_ROWS = 1000
+PREVIEW_CACHE_ENTRIES = 256
+PREVIEW_REMOTE_CACHE_SECONDS = 60
+# Dashboard configs: maximum nesting of splits, number of objects and lists and size of the serialized config in bytes
+DASHBOARD_MAX_DEPTH = 32
+DASHBOARD_MAX_NODES = 1024
+DASHBOARD_MAX_SIZE = 256 * 1024
+# Snapshots of public and semi-public dashboards: maximum size in bytes and lifetime in client and proxy caches in seconds,
+# after which they are revalidated by ETag
+DASHBOARD_SNAPSHOT_MAX_BYTES = 1024 * 1024
+DASHBOARD_SNAPSHOT_MAX_AGE = 0
+# Bulk membership lists of groups: maximum size in bytes and users resolved, inserted or deleted per query
+GROUP_MEMBERSHIP_MAX_SIZE = 16 * 1024 * 1024
+GROUP_MEMBERSHIP_BATCH_SIZE = 1000
+
 
 if 'CUSTOM_SETTING_PATH' in os.environ and Path(os.environ.get('CUSTOM_SETTING_PATH')).exists():
     #Import custom settings into namespace
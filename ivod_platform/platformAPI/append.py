@@ -0,0 +1,158 @@
+"""Appending rows to uploaded CSV datasources.
+
+Stored content is shared by all datasources with the same content and never changes, so appended rows go into
+the append log of the datasource, see append_log. The new rows are validated against the columns of the canonical
+form and staged in a temporary directory first. Only adding them to the log happens while appends to the
+datasource are locked, so an append costs time in proportion to the new rows. Charts of the datasource are
+re-rendered in the background afterwards, pive loads the content followed by the appended rows.
+"""
+import csv
+import io
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .append_log import AppendStage, new_append_log_path, type_column_value
+from .canonical import load_canonical, get_canonical_path, read_csv_sample
+from .compression import open_datasource_file
+from .models import Chart, Datasource
+from .util import generate_chart, get_config_for_chart, get_datasource_base_path, LimitedStream, AbsoluteUrlBuilder
+
+
+def read_csv_format(content_path):
+    """Detect dialect, header and line terminator of stored CSV content from its head.
+    :param Path content_path: The stored content
+    :rtype: (csv.Dialect, [str], str)
+    :raises csv.Error: If the head is not CSV
+    """
+    with io.TextIOWrapper(open_datasource_file(content_path), encoding='utf-8', newline='') as file:
+        _, sample = read_csv_sample(file)
+    dialect = csv.Sniffer().sniff(sample)
+    lines = io.StringIO(sample, newline='')
+    header = next(csv.reader(lines, dialect), [])
+    first_line = sample[:lines.tell()]
+    line_terminator = '\r\n' if first_line.endswith('\r\n') else '\r' if first_line.endswith('\r') else '\n'
+    return dialect, header, line_terminator
+
+def append_rows(datasource, stream, request):
+    """Append CSV rows to an uploaded CSV datasource. The rows may start with the header of the datasource.
+    Values of string columns are kept as they are, values of numeric columns have to be numbers of the column type.
+    Appends to the same datasource are serialized, charts of the datasource are re-rendered once the append is committed.
+    :param Datasource datasource: The datasource
+    :param stream: Object with read(size) returning the UTF-8 encoded rows
+    :param HttpRequest request: Request object of the call that triggered the append, its base url is used for rendering
+    :return: The updated datasource and the number of appended rows
+    :rtype: (Datasource, int)
+    :raises ValueError: If the datasource can not be appended to or the rows do not fit its columns
+    """
+    max_size = getattr(settings, "DATASOURCE_MAX_UPLOAD_SIZE", 1024 ** 3)
+    # Stored content never changes, its format can be read without locking the datasource
+    canonical = load_canonical(datasource.source) if datasource.stored_file_id is not None else None
+    if canonical is None and datasource.stored_file_id is not None and not get_canonical_path(datasource.source).exists():
+        raise ValueError("Datasource is still being prepared, rows can be appended once it is done")
+    if canonical is None or canonical.schema['format'] != 'csv':
+        raise ValueError("Rows can only be appended to uploaded CSV datasources")
+    dialect, header, line_terminator = read_csv_format(datasource.source)
+    if header != canonical.columns:
+        raise ValueError("Header of the datasource does not match its columns")
+    dtypes = [column['dtype'] for column in canonical.schema['columns']]
+
+    stage = AppendStage(get_datasource_base_path(), canonical.schema['columns'],
+                        lambda output: csv.writer(output, dialect, lineterminator=line_terminator))
+    try:
+        first = True
+        text = io.TextIOWrapper(io.BufferedReader(LimitedStream(stream, max_size)), encoding='utf-8', newline='')
+        try:
+            for number, values in enumerate(csv.reader(text, dialect), start=1):
+                if not values:
+                    continue
+                if first:
+                    first = False
+                    if values == header:
+                        continue
+                if len(values) != len(header):
+                    raise ValueError(f"Row {number} has {len(values)} values, expected {len(header)}")
+                typed = []
+                for name, dtype, value in zip(header, dtypes, values):
+                    try:
+                        typed.append(type_column_value(dtype, value))
+                    except ValueError:
+                        raise ValueError(f"Row {number}: '{value}' does not fit column '{name}' of type {dtype}")
+                stage.add(values, typed)
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise ValueError(f"Rows are not valid CSV: {e}")
+        if not stage.rows:
+            raise ValueError("No rows to append")
+        stage.finish()
+
+        with transaction.atomic():
+            datasource = Datasource.objects.select_for_update().get(pk=datasource.pk)
+            if not datasource.append_log:
+                datasource.append_log = str(new_append_log_path(get_datasource_base_path()))
+            datasource.log_lengths = stage.commit(Path(datasource.append_log), datasource.log_lengths)
+            datasource.log_rows += stage.rows
+            datasource.save(update_fields=['append_log', 'log_lengths', 'log_rows', 'modification_time'])
+            chart_ids = list(Chart.objects.filter(original_datasource=datasource).values_list('pk', flat=True))
+            # Rendering outlives the request, only its base url is kept
+            url_builder = AbsoluteUrlBuilder.from_request(request)
+            transaction.on_commit(lambda: rerender_charts_async(chart_ids, url_builder))
+    finally:
+        stage.discard()
+    return datasource, stage.rows
+
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+_pending_renders = set()
+_pending_renders_lock = threading.Lock()
+
+def get_render_executor():
+    """Get the thread pool re-rendering charts.
+    :rtype: ThreadPoolExecutor
+    """
+    global _render_executor
+    if _render_executor is None:
+        with _render_executor_lock:
+            if _render_executor is None:
+                _render_executor = ThreadPoolExecutor(max_workers=getattr(settings, "CHART_RERENDER_WORKERS", 2), thread_name_prefix="chart-render")
+    return _render_executor
+
+def rerender_chart(chart_id, url_builder):
+    """Render a chart again from the current content of its datasource, keeping its config.
+    :param int chart_id: Database id of the chart
+    :param AbsoluteUrlBuilder url_builder: Builds the urls of the chart
+    """
+    with _pending_renders_lock:
+        _pending_renders.discard(chart_id)
+    try:
+        chart = Chart.objects.select_related('original_datasource').filter(pk=chart_id).first()
+        if chart is None or chart.original_datasource is None:
+            return
+        config = json.dumps(get_config_for_chart(chart))
+        pive_version, js_name = generate_chart(datasource=chart.original_datasource, chart_id=chart.id, chart_type=chart.chart_type, request=url_builder, config=config)
+        # The modification time tells snapshots of dashboards that the chart changed
+        Chart.objects.filter(pk=chart_id).update(pive_version=pive_version, js_name=js_name, modification_time=timezone.now())
+    except Exception as e:
+        print(e, file=sys.stderr)
+    finally:
+        # Threads of the pool are not managed by Django, their connections have to be closed explicitly
+        connection.close()
+
+def rerender_charts_async(chart_ids, url_builder):
+    """Re-render charts in the background. A chart waiting to be rendered is not queued again,
+    its render will use the content current at that time.
+    :param [int] chart_ids: Database ids of the charts
+    :param AbsoluteUrlBuilder url_builder: Builds the urls of the charts
+    """
+    for chart_id in chart_ids:
+        with _pending_renders_lock:
+            if chart_id in _pending_renders:
+                continue
+            _pending_renders.add(chart_id)
+        get_render_executor().submit(rerender_chart, chart_id, url_builder)
@@ -0,0 +1,332 @@
+"""Append logs of uploaded CSV datasources.
+
+Stored content is shared by all datasources with the same content and never changes. Rows appended to a datasource
+are kept in its append log instead, a directory <uuid>.append next to the stored content, which holds
+- rows.csv: the appended rows in the dialect of the content, pive loads them following the content
+- per column <index>.bin: the values, raw int64 or float64 for numeric columns, UTF-8 for string and JSON columns
+- per string or JSON column <index>.off: the end offsets of the values in <index>.bin as int64
+Files are only ever appended to. The datasource stores the committed length of every file, readers never look past
+it, so an interrupted append leaves bytes behind which are cut off by the next one. An append costs time in
+proportion to the new rows, readers combine content and log.
+"""
+import io
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+
+from .canonical import CanonicalData, StringColumn, load_canonical, parse_csv_value
+from .compression import open_datasource_file, COPY_BUFFER_SIZE
+
+APPEND_LOG_SUFFIX = '.append'
+ROWS_FILE = 'rows.csv'
+# Values of a column buffered before they are written, and offsets adjusted at once when committing
+APPEND_BATCH_VALUES = 64 * 1024
+
+def new_append_log_path(base_path):
+    """Get the path of a new append log.
+    :param Path base_path: The datasource directory
+    :rtype: Path
+    """
+    return Path(base_path).joinpath(f"{uuid4().hex}{APPEND_LOG_SUFFIX}")
+
+def type_column_value(dtype, value):
+    """Type a CSV value for a column of a canonical form. String columns keep the text as it is.
+    :param str dtype: Storage type of the column
+    :param str value: The CSV value
+    :return: The typed value
+    :raises ValueError: If the value does not fit a numeric column
+    """
+    if dtype == 'string':
+        return value
+    typed = parse_csv_value(value)
+    if dtype == 'int64' and not (type(typed) == int and -2 ** 63 <= typed < 2 ** 63):
+        raise ValueError(f"'{value}' is no integer")
+    if dtype == 'float64' and type(typed) not in (int, float):
+        raise ValueError(f"'{value}' is no number")
+    return typed
+
+
+class _LogColumnWriter:
+    """Writes the values of a column batch by batch into the files of its storage type"""
+
+    def __init__(self, path, index, dtype):
+        self.dtype = dtype
+        self._data = path.joinpath(f"{index}.bin").open('wb')
+        self._offsets = None if dtype in ('int64', 'float64') else path.joinpath(f"{index}.off").open('wb')
+        self._end = 0
+        self._batch = []
+
+    def add(self, value):
+        self._batch.append(value)
+        if len(self._batch) >= APPEND_BATCH_VALUES:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+        if self._offsets is None:
+            self._data.write(np.array(self._batch, dtype=self.dtype).tobytes())
+        else:
+            encoded = [(value if self.dtype == 'string' else json.dumps(value)).encode('utf-8') for value in self._batch]
+            offsets = self._end + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+            self._end = int(offsets[-1])
+            self._offsets.write(offsets.tobytes())
+            self._data.write(b''.join(encoded))
+        self._batch = []
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        if self._offsets is not None:
+            self._offsets.close()
+
+
+class AppendStage:
+    """Rows of an append, written into a temporary directory until they are committed to the append log"""
+
+    def __init__(self, base_path, columns, csv_writer_factory):
+        """
+        :param Path base_path: The datasource directory
+        :param [dict] columns: Schema entries of the columns of the canonical form
+        :param callable csv_writer_factory: Function taking a text stream and returning a csv writer in the dialect of the content
+        """
+        self.path = Path(base_path).joinpath(f".append.{uuid4().hex}.tmp")
+        self.path.mkdir(parents=True)
+        self.rows = 0
+        self._columns = [_LogColumnWriter(self.path, index, column['dtype']) for index, column in enumerate(columns)]
+        self._rows_file = self.path.joinpath(ROWS_FILE).open('wb')
+        self._csv_text = io.StringIO()
+        self._csv_writer_factory = csv_writer_factory
+        self._csv_writer = csv_writer_factory(self._csv_text)
+
+    def add(self, values, typed):
+        """Add a row.
+        :param [str] values: The CSV values, written to the log as they are
+        :param list typed: The values typed for their columns
+        """
+        self._csv_writer.writerow(values)
+        if self._csv_text.tell() >= COPY_BUFFER_SIZE:
+            self._flush_csv()
+        for column, value in zip(self._columns, typed):
+            column.add(value)
+        self.rows += 1
+
+    def _flush_csv(self):
+        self._rows_file.write(self._csv_text.getvalue().encode('utf-8'))
+        self._csv_text = io.StringIO()
+        self._csv_writer = self._csv_writer_factory(self._csv_text)
+
+    def finish(self):
+        """Write everything buffered. No rows can be added afterwards."""
+        self._flush_csv()
+        self._close()
+
+    def _close(self):
+        for file in [self._rows_file] + self._columns:
+            file.close()
+
+    def discard(self):
+        """Remove the staged files"""
+        self._close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def commit(self, log_path, lengths):
+        """Append the staged files to the append log, after cutting off anything past their committed lengths.
+        Has to be called while appends to the log are locked. The new lengths are only valid once they are stored.
+        :param Path log_path: The append log
+        :param dict lengths: Committed lengths of the files of the log, by name
+        :return: The lengths of the files including the staged rows
+        :rtype: dict
+        """
+        log_path = Path(log_path)
+        log_path.mkdir(parents=True, exist_ok=True)
+        new_lengths = dict(lengths)
+        names = sorted(os.listdir(self.path))
+        # Data files first, the offsets of a column continue after its committed data
+        for name in sorted(names, key=lambda name: name.endswith('.off')):
+            committed = lengths.get(name, 0)
+            shift = lengths.get(name[:-len('.off')] + '.bin', 0) if name.endswith('.off') else 0
+            fd = os.open(log_path.joinpath(name), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, committed)
+                position = committed
+                with self.path.joinpath(name).open('rb') as staged:
+                    while True:
+                        if shift:
+                            data = np.fromfile(staged, dtype=np.int64, count=APPEND_BATCH_VALUES)
+                            data = (data + shift).tobytes() if len(data) else b''
+                        else:
+                            data = staged.read(COPY_BUFFER_SIZE)
+                        if not data:
+                            break
+                        position += os.pwrite(fd, data, position)
+            finally:
+                os.close(fd)
+            new_lengths[name] = position
+        return new_lengths
+
+
+class AppendLog:
+    """Read access to the committed part of an append log"""
+
+    def __init__(self, path, rows, lengths):
+        self.path = Path(path)
+        self.rows = rows
+        self.lengths = lengths
+
+    def iter_file(self, name):
+        """Iterate over the committed content of a file in chunks.
+        :rtype: iterator of bytes
+        """
+        remaining = self.lengths.get(name, 0)
+        if remaining == 0:
+            return
+        with self.path.joinpath(name).open('rb') as file:
+            while remaining > 0:
+                data = file.read(min(COPY_BUFFER_SIZE, remaining))
+                if not data:
+                    raise OSError(f"{self.path.joinpath(name)} is shorter than committed")
+                remaining -= len(data)
+                yield data
+
+    def _map(self, name, dtype, count):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path.joinpath(name), dtype=dtype, mode='r', shape=(count,))
+
+    def column(self, index, dtype):
+        """Get the appended values of a column.
+        :param int index: Index of the column
+        :param str dtype: Storage type of the column
+        :return: numpy array for int64 and float64 columns, StringColumn for strings, list for JSON columns
+        """
+        if dtype in ('int64', 'float64'):
+            return self._map(f"{index}.bin", dtype, self.rows)
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64), self._map(f"{index}.off", np.int64, self.rows)])
+        values = StringColumn(self._map(f"{index}.bin", np.uint8, int(offsets[-1])), offsets)
+        if dtype == 'string':
+            return values
+        return [json.loads(value) for value in values[:]]
+
+
+def get_append_log(datasource):
+    """Get the append log of a datasource.
+    :param Datasource datasource: The datasource
+    :return: The log, or None if no rows were appended
+    :rtype: AppendLog
+    """
+    if not datasource.append_log or not datasource.log_rows:
+        return None
+    return AppendLog(datasource.append_log, datasource.log_rows, datasource.log_lengths)
+
+
+class ChainedColumn:
+    """Read access to the values of a column stored in several parts"""
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            values = []
+            for part in self.parts:
+                if stop > 0 and start < len(part):
+                    values.extend(part[max(start, 0):min(stop, len(part))])
+                start -= len(part)
+                stop -= len(part)
+            return values
+        if index < 0:
+            index += len(self)
+        for part in self.parts:
+            if index < len(part):
+                return part[index]
+            index -= len(part)
+        raise IndexError("Column index out of range")
+
+
+class AppendedCanonicalData(CanonicalData):
+    """Canonical form of stored content combined with the rows of an append log.
+    Profiles of the combination are stored in the log.
+    """
+
+    def __init__(self, canonical, log):
+        super().__init__(log.path, dict(canonical.schema, rows=canonical.rows + log.rows))
+        self.canonical = canonical
+        self.log = log
+        self._indices = {column['name']: index for index, column in enumerate(canonical.schema['columns'])}
+
+    def column(self, name):
+        index = self._indices[name]
+        dtype = self.schema['columns'][index]['dtype']
+        stored = self.canonical.column(name)
+        appended = self.log.column(index, dtype)
+        if dtype in ('int64', 'float64'):
+            return np.concatenate([stored, appended])
+        if dtype == 'string':
+            return ChainedColumn([stored, appended])
+        return stored + appended
+
+
+def load_datasource_canonical(datasource):
+    """Open the canonical form of an uploaded datasource, including appended rows.
+    :param Datasource datasource: The datasource
+    :return: The canonical data, or None if the datasource has none
+    :rtype: CanonicalData
+    """
+    if datasource.stored_file_id is None:
+        return None
+    canonical = load_canonical(datasource.source)
+    log = get_append_log(datasource)
+    if canonical is None or log is None:
+        return canonical
+    return AppendedCanonicalData(canonical, log)
+
+def iter_datasource_content(datasource):
+    """Iterate over the content of an uploaded datasource in chunks, including appended rows.
+    :param Datasource datasource: The datasource
+    :rtype: iterator of bytes
+    """
+    last = b''
+    with open_datasource_file(datasource.source) as file:
+        for chunk in iter(lambda: file.read(COPY_BUFFER_SIZE), b''):
+            last = chunk[-1:]
+            yield chunk
+    log = get_append_log(datasource)
+    if log is None:
+        return
+    if last not in (b'\n', b'\r'):
+        # The rows of the log end with the line terminator of the content
+        with log.path.joinpath(ROWS_FILE).open('rb') as rows_file:
+            rows_file.seek(max(0, log.lengths[ROWS_FILE] - 2))
+            end = rows_file.read(min(2, log.lengths[ROWS_FILE]))
+        yield b'\r\n' if end == b'\r\n' else end[-1:]
+    yield from log.iter_file(ROWS_FILE)
+
+@contextmanager
+def materialize_pive_source(datasource):
+    """Provide the content of a datasource with appended rows as plain file for pive, see iter_datasource_content.
+    The file is written next to the append log and removed afterwards.
+    :param Datasource datasource: The datasource, with rows appended
+    :return: Path of the file
+    :rtype: Path
+    """
+    log = get_append_log(datasource)
+    temp_path = log.path.with_name(f".{log.path.name}.{uuid4().hex}.plain")
+    try:
+        with temp_path.open('wb') as target:
+            for chunk in iter_datasource_content(datasource):
+                target.write(chunk)
+        yield temp_path
+    finally:
+        temp_path.unlink(missing_ok=True)
@@ -1,6 +1,6 @@
 from django.apps import AppConfig
 from pive.environment import Environment
-from .util import get_code_base_path
+from .util import get_code_base_path, clear_code_cache, refresh_code_versions
 
 from django.db.utils import IntegrityError
 
@@ -15,6 +15,8 @@ class PlatformapiConfig(AppConfig):
     name = 'platformAPI'
 
     def ready(self):
+        # Register signal handlers
+        from . import signals
 
         if os.environ.get("RUN_SERVER") is not None:
             # Generate boot users
@@ -48,3 +50,6 @@ class PlatformapiConfig(AppConfig):
             folder.mkdir(parents=True, exist_ok=True)
             with folder.joinpath(f"{name}.js").open("w") as outfile:
                 outfile.write(visualisations[name].get_js_code())
+        # Files were rewritten, drop any cached copies and pick up new versions
+        clear_code_cache()
+        refresh_code_versions()
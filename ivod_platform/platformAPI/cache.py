@@ -0,0 +1,146 @@
+"""In-process cache for small file artifacts, such as chart configs."""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+
+class ArtifactCache:
+    """Thread safe LRU cache of values loaded from files, bounded by the total size in bytes.
+    Entries are validated against modification time, inode and size of their file on every access,
+    so replaced or rewritten files are never served stale.
+    Entries are accounted with the estimated size of the loaded value in memory, not the size of the file.
+    Lists and dicts are copied on every access, so callers may modify what they get.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, loader, variant=None, sizeof=None):
+        """Get the value loaded from a file, loading it on a miss.
+        :param Path path: The file
+        :param callable loader: Function turning the file content (bytes) into the cached value
+        :param str variant: Distinguishes different values loaded from the same file
+        :param callable sizeof: Function (value, content) -> accounted size in bytes. Defaults to estimate_size(value)
+        :raises OSError: If the file can not be read
+        """
+        key = (str(path), variant)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy_value(entry[1])
+            self.misses += 1
+
+        with open(path, 'rb') as file:
+            # Signature of the file actually read, it might have been replaced in between
+            stat = os.fstat(file.fileno())
+            content = file.read()
+        value = loader(content)
+        size = sizeof(value, content) if sizeof else estimate_size(value)
+        if size <= self.max_entry_bytes:
+            self._put(key, (stat.st_mtime_ns, stat.st_ino, stat.st_size), value, size)
+            return copy_value(value)
+        return value
+
+    def _put(self, key, signature, value, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[2]
+            self._entries[key] = (signature, value, size)
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted[2]
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get the counters and the current fill level of the cache.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'max_entry_bytes': self.max_entry_bytes,
+            }
+
+
+def estimate_size(value):
+    """Estimate the memory used by a value in bytes, including everything reachable through lists, tuples and dicts.
+    Works iteratively, so deeply nested values can not exhaust the stack.
+    :param value: The value, e.g. parsed JSON
+    :rtype: int
+    """
+    size = 0
+    seen = set()
+    pending = [value]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+    return size
+
+def copy_value(value):
+    """Copy all lists and dicts in a value, everything else (str, bytes, numbers) is immutable and shared.
+    :param value: The value, e.g. parsed JSON
+    """
+    if not isinstance(value, (dict, list)):
+        return value
+    root = type(value)(value)
+    pending = [root]
+    while pending:
+        container = pending.pop()
+        items = container.items() if isinstance(container, dict) else enumerate(container)
+        for key, item in items:
+            if isinstance(item, (dict, list)):
+                item = type(item)(item)
+                container[key] = item
+                pending.append(item)
+    return root
+
+
+_artifact_cache = None
+_artifact_cache_lock = threading.Lock()
+
+def get_artifact_cache():
+    """Get the process wide artifact cache, configured by ARTIFACT_CACHE_MAX_BYTES and ARTIFACT_CACHE_MAX_ENTRY_BYTES.
+    :rtype: ArtifactCache
+    """
+    global _artifact_cache
+    if _artifact_cache is None:
+        with _artifact_cache_lock:
+            if _artifact_cache is None:
+                _artifact_cache = ArtifactCache(
+                    max_bytes=getattr(settings, "ARTIFACT_CACHE_MAX_BYTES", 32 * 1024 * 1024),
+                    max_entry_bytes=getattr(settings, "ARTIFACT_CACHE_MAX_ENTRY_BYTES", 256 * 1024),
+                )
+    return _artifact_cache
@@ -0,0 +1,493 @@
+"""Canonical form of uploaded datasources, converted once at ingest.
+
+Next to the stored content <sha256>, the directory <sha256>.canonical holds
+- schema.json: format of the original, row count and the columns with their types
+- per int64 or float64 column a memory mappable .npy file
+- per string column the UTF-8 data (.bin) and the offsets of all values (.npy)
+- per column of mixed types a JSON list (.json)
+The canonical form serves reads of the platform itself, like profiles and previews. Its typing is not the one of
+pive, so pive always loads the original content.
+Only CSV files and JSON lists of flat objects are converted. For other content, schema.json has format null.
+Conversion streams the content: rows are parsed one at a time into a temporary file of value lists, from which the
+columns are written in groups once their types are known. Memory use does not depend on the size of the content.
+"""
+import csv
+import io
+import json
+import os
+import re
+import sys
+from pathlib import Path
+from shutil import rmtree
+from uuid import uuid4
+
+import numpy as np
+
+from .compression import open_datasource_file
+
+CANONICAL_SUFFIX = '.canonical'
+SCHEMA_FILE = 'schema.json'
+# Bytes of a CSV file used to detect its dialect
+CSV_SNIFF_SIZE = 64 * 1024
+# Characters read at once while searching for the next JSON value
+JSON_READ_SIZE = 16 * 1024
+# Temporary file with the value lists of all rows during conversion
+ROWS_FILE = 'rows.jsonl'
+# Columns written from one pass over the rows, and values of a column group buffered before they are written
+CONVERT_COLUMN_GROUP_SIZE = 256
+CONVERT_BATCH_VALUES = 256 * 1024
+# CSV values written like JSON numbers are typed as numbers
+CSV_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?')
+
+def get_canonical_path(content_path):
+    """Get the directory of the canonical form of stored datasource content.
+    :param Path content_path: The stored content
+    :rtype: Path
+    """
+    content_path = Path(content_path)
+    return content_path.with_name(f"{content_path.name}{CANONICAL_SUFFIX}")
+
+def parse_csv_value(value):
+    """Type a CSV value: int if it is written as an integer, float if it is written as a JSON number with fraction
+    or exponent, str otherwise. Values like '007', '+1', 'nan' or 'inf' stay strings, typing them would change them.
+    """
+    match = CSV_NUMBER.fullmatch(value)
+    if match is None:
+        return value
+    if match.group(1) is None and match.group(2) is None:
+        return int(value)
+    number = float(value)
+    # Out of range for float64
+    if number in (float('inf'), float('-inf')):
+        return value
+    return number
+
+def read_csv_sample(text):
+    """Read the head of a CSV text stream for detecting its dialect, which is done on complete lines only.
+    The rest of the last line is read on, but at most CSV_SNIFF_SIZE characters of it. If the line does not end
+    within them, the sample is cut after the last line end instead.
+    :param text: Text stream positioned at the start of the content, opened without newline translation
+    :return: The text read from the stream, and the complete lines at its start
+    :rtype: (str, str)
+    :raises csv.Error: If no line ends within the text read
+    """
+    sample = text.read(CSV_SNIFF_SIZE)
+    rest = text.readline(CSV_SNIFF_SIZE)
+    sample += rest
+    # A shorter rest ended with the line or the content
+    if len(rest) < CSV_SNIFF_SIZE or rest.endswith(('\n', '\r')):
+        return sample, sample
+    end = max(sample.rfind('\n'), sample.rfind('\r'))
+    if end < 0:
+        raise csv.Error(f"No line end within the first {len(sample)} characters")
+    return sample, sample[:end + 1]
+
+def open_csv_reader(text):
+    """Open a CSV text stream with header, detecting its dialect from the head of the stream.
+    The stream is read only once, so it does not need to be seekable.
+    :param text: Text stream positioned at the start of the content, opened without newline translation
+    :raises csv.Error: If the content is not CSV
+    :rtype: csv.DictReader
+    """
+    sample, lines = read_csv_sample(text)
+    dialect = csv.Sniffer().sniff(lines)
+    return csv.DictReader(_iter_lines(sample, text), dialect=dialect)
+
+def _iter_lines(sample, text):
+    """Iterate over the lines of the sample read by read_csv_sample and then of the rest of the stream.
+    A line the sample ends within is completed from the stream."""
+    lines = io.StringIO(sample, newline='').readlines()
+    partial = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+    yield from lines
+    if partial:
+        yield partial + text.readline()
+    yield from text
+
+class JSONStreamReader:
+    """Incremental reader of JSON values from a text stream, for reading the elements of large arrays one at a time"""
+
+    def __init__(self, text):
+        self.text = text
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Read more content into the buffer, dropping everything already consumed.
+        Reads at least as much as is left unconsumed, so large values are not decoded over and over again.
+        """
+        chunk = self.text.read(max(JSON_READ_SIZE, len(self.buffer) - self.position))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def peek(self):
+        """Get the next character that is not whitespace, without consuming it. Empty at the end of the stream."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position:self.position + 1]
+            self._fill()
+
+    def expect(self, character):
+        """Consume the next character that is not whitespace.
+        :raises ValueError: If it is not the expected one
+        """
+        if self.peek() != character:
+            raise ValueError(f"Expected '{character}' in JSON content")
+        self.position += 1
+
+    def value(self):
+        """Decode the next value.
+        :raises ValueError: If the content is no valid JSON
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer might continue in the stream
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_list(self):
+        """Iterate over the elements of a list making up the rest of the stream.
+        :raises ValueError: If the content is no valid JSON list
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.expect(']')
+        else:
+            while True:
+                yield self.value()
+                if self.peek() == ']':
+                    self.expect(']')
+                    break
+                self.expect(',')
+        if self.peek() != '':
+            raise ValueError("Extra data after JSON content")
+
+def open_text(content_path):
+    """Open stored datasource content, plain or compressed, as text stream without newline translation.
+    :param Path content_path: The stored content
+    """
+    return io.TextIOWrapper(open_datasource_file(content_path), encoding='utf-8', newline='')
+
+def iter_csv_rows(text):
+    """Iterate over the rows of a CSV text stream with header, typed with parse_csv_value.
+    :raises csv.Error: If the content is not CSV
+    :raises TypeError: If a row has fewer values than the header
+    """
+    reader = open_csv_reader(text)
+    header = reader.fieldnames
+    if header is None:
+        return
+    for row in reader:
+        yield {key: parse_csv_value(row[key]) for key in header}
+
+
+class NotConvertible(Exception):
+    """The content is valid, but not a list of flat objects with the same keys"""
+
+
+class _ColumnTypes:
+    """Types of the values of a column, collected while streaming the rows"""
+
+    def __init__(self):
+        self.types = set()
+        self.low = 0
+        self.high = 0
+
+    def add(self, value):
+        value_type = type(value)
+        self.types.add(value_type)
+        if value_type == int:
+            if value < self.low:
+                self.low = value
+            elif value > self.high:
+                self.high = value
+
+    @property
+    def dtype(self):
+        """Most compact storage type fitting all values"""
+        if self.types == {int}:
+            # Integers out of range would lose precision as float64
+            return 'int64' if -2 ** 63 <= self.low and self.high < 2 ** 63 else 'json'
+        if self.types and self.types <= {int, float}:
+            try:
+                float(self.low), float(self.high)
+                return 'float64'
+            except OverflowError:
+                return 'json'
+        if self.types == {str}:
+            return 'string'
+        return 'json'
+
+def _write_rows(temp_path, rows):
+    """Write the value lists of all rows into ROWS_FILE, collecting the column types.
+    :param Path temp_path: Directory of the canonical form being written
+    :param rows: Iterable of the rows
+    :return: The column names, their types and the number of rows
+    :rtype: ([str], [_ColumnTypes], int)
+    :raises NotConvertible: If the rows are no flat objects with the same keys
+    """
+    keys = None
+    types = None
+    count = 0
+    with temp_path.joinpath(ROWS_FILE).open('w', encoding='utf-8') as rows_file:
+        for row in rows:
+            if not isinstance(row, dict):
+                raise NotConvertible()
+            if keys is None:
+                keys = list(row.keys())
+                types = [_ColumnTypes() for _ in keys]
+            elif list(row.keys()) != keys:
+                raise NotConvertible()
+            values = list(row.values())
+            for column_types, value in zip(types, values):
+                if isinstance(value, (dict, list)):
+                    raise NotConvertible()
+                column_types.add(value)
+            rows_file.write(json.dumps(values, separators=(',', ':')))
+            rows_file.write('\n')
+            count += 1
+    if count == 0 or not keys:
+        raise NotConvertible()
+    return keys, types, count
+
+def _write_npy_header(file, dtype, length):
+    """Write the header of a one dimensional .npy file, the data follows in native byte order."""
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (length,)}
+    try:
+        np.lib.format.write_array_header_1_0(file, header)
+    except ValueError:
+        np.lib.format.write_array_header_2_0(file, header)
+
+
+class _ColumnWriter:
+    """Writes the values of a column batch by batch into the files of its storage type"""
+
+    def __init__(self, path, index, dtype, length):
+        name = str(index)
+        self.dtype = dtype
+        self._files = []
+        if dtype in ('int64', 'float64'):
+            self.schema = {'dtype': dtype, 'file': f"{name}.npy"}
+            self._data = self._open(path.joinpath(self.schema['file']))
+            _write_npy_header(self._data, dtype, length)
+        elif dtype == 'string':
+            self.schema = {'dtype': dtype, 'file': f"{name}.bin", 'offsets': f"{name}.npy"}
+            self._data = self._open(path.joinpath(self.schema['file']))
+            self._offsets = self._open(path.joinpath(self.schema['offsets']))
+            _write_npy_header(self._offsets, np.int64, length + 1)
+            self._offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+            self._end = 0
+        else:
+            self.schema = {'dtype': 'json', 'file': f"{name}.json"}
+            self._data = self._open(path.joinpath(self.schema['file']))
+            self._data.write(b'[')
+            self._first = True
+
+    def _open(self, path):
+        file = path.open('wb')
+        self._files.append(file)
+        return file
+
+    def write(self, values):
+        """Append a batch of values"""
+        if not values:
+            return
+        if self.dtype in ('int64', 'float64'):
+            self._data.write(np.array(values, dtype=self.dtype).tobytes())
+        elif self.dtype == 'string':
+            encoded = [value.encode('utf-8') for value in values]
+            offsets = self._end + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+            self._end = int(offsets[-1])
+            self._offsets.write(offsets.tobytes())
+            self._data.write(b''.join(encoded))
+        else:
+            content = ','.join(json.dumps(value) for value in values).encode('utf-8')
+            self._data.write(content if self._first else b',' + content)
+            self._first = False
+
+    def close(self):
+        if self.dtype == 'json':
+            self._data.write(b']')
+        for file in self._files:
+            file.close()
+
+def _write_columns(temp_path, types, count):
+    """Write the columns from the value lists in ROWS_FILE. The file is read once per group of columns.
+    :return: Schema entries of the columns
+    :rtype: [dict]
+    """
+    schema = []
+    for group_start in range(0, len(types), CONVERT_COLUMN_GROUP_SIZE):
+        group = range(group_start, min(group_start + CONVERT_COLUMN_GROUP_SIZE, len(types)))
+        writers = [_ColumnWriter(temp_path, index, types[index].dtype, count) for index in group]
+        batch_rows = max(1, CONVERT_BATCH_VALUES // len(writers))
+        try:
+            batches = [[] for _ in writers]
+            with temp_path.joinpath(ROWS_FILE).open('r', encoding='utf-8') as rows_file:
+                for line in rows_file:
+                    values = json.loads(line)
+                    for batch, index in zip(batches, group):
+                        batch.append(values[index])
+                    if len(batches[0]) >= batch_rows:
+                        for writer, batch in zip(writers, batches):
+                            writer.write(batch)
+                        batches = [[] for _ in writers]
+            for writer, batch in zip(writers, batches):
+                writer.write(batch)
+        finally:
+            for writer in writers:
+                writer.close()
+        schema.extend(writer.schema for writer in writers)
+    return schema
+
+def _convert(content_path, temp_path, source_format):
+    """Convert content in the given format into the canonical form in temp_path.
+    :return: The schema
+    :rtype: dict
+    :raises ValueError: If the content is not valid JSON, in case of JSON
+    :raises csv.Error: If the content is not valid CSV, in case of CSV
+    :raises NotConvertible: If the content is no list of flat objects
+    """
+    with open_text(content_path) as text:
+        rows = JSONStreamReader(text).iter_list() if source_format == 'json' else iter_csv_rows(text)
+        keys, types, count = _write_rows(temp_path, rows)
+    columns = _write_columns(temp_path, types, count)
+    temp_path.joinpath(ROWS_FILE).unlink()
+    for column, key in zip(columns, keys):
+        column['name'] = key
+    return {'format': source_format, 'rows': count, 'columns': columns}
+
+def _clear_directory(path):
+    """Remove everything inside a directory"""
+    rmtree(path)
+    path.mkdir()
+
+def write_canonical(content_path):
+    """Convert stored datasource content into its canonical form. Does nothing if it exists already.
+    JSON lists are recognised by their first character, content that is no valid JSON is tried as CSV.
+    Conversion errors are reported and leave the datasource without canonical form.
+    :param Path content_path: The stored content
+    """
+    canonical_path = get_canonical_path(content_path)
+    if canonical_path.exists():
+        return
+    temp_path = canonical_path.with_name(f".{canonical_path.name}.{uuid4().hex}.tmp")
+    try:
+        temp_path.mkdir(parents=True)
+        with open_datasource_file(content_path) as file:
+            start = file.read(CSV_SNIFF_SIZE).lstrip()[:1]
+        schema = {'format': None, 'rows': 0, 'columns': []}
+        try:
+            if start == b'{':
+                # JSON objects are not converted
+                raise NotConvertible()
+            try:
+                if start != b'[':
+                    raise ValueError("Content is no JSON list")
+                schema = _convert(content_path, temp_path, 'json')
+            except ValueError:
+                _clear_directory(temp_path)
+                try:
+                    schema = _convert(content_path, temp_path, 'csv')
+                except (csv.Error, TypeError, ValueError):
+                    raise NotConvertible()
+        except NotConvertible:
+            _clear_directory(temp_path)
+        with temp_path.joinpath(SCHEMA_FILE).open('w') as file:
+            json.dump(schema, file)
+        # Another process might have converted the same content in between, then its result is kept
+        try:
+            os.rename(temp_path, canonical_path)
+        except OSError:
+            pass
+    except Exception as e:
+        print(e, file=sys.stderr)
+    finally:
+        rmtree(temp_path, ignore_errors=True)
+
+def remove_canonical(content_path):
+    """Delete the canonical form of stored datasource content.
+    :param Path content_path: The stored content
+    """
+    rmtree(get_canonical_path(content_path), ignore_errors=True)
+
+
+class StringColumn:
+    """Memory mapped column of strings, decoded on access"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+
+class CanonicalData:
+    """Read access to the canonical form of a datasource. Columns are memory mapped, nothing is parsed upfront."""
+
+    def __init__(self, canonical_path, schema):
+        self.path = canonical_path
+        self.schema = schema
+        self._columns = {column['name']: column for column in schema['columns']}
+
+    @property
+    def rows(self):
+        return self.schema['rows']
+
+    @property
+    def columns(self):
+        return list(self._columns.keys())
+
+    def column(self, name):
+        """Get the values of a column.
+        :param str name: Name of the column
+        :return: numpy array for int64 and float64 columns, StringColumn for strings, list for mixed columns
+        :raises KeyError: If there is no such column
+        """
+        column = self._columns[name]
+        if column['dtype'] in ('int64', 'float64'):
+            return np.load(self.path.joinpath(column['file']), mmap_mode='r')
+        if column['dtype'] == 'string':
+            offsets = np.load(self.path.joinpath(column['offsets']), mmap_mode='r')
+            # Empty files can not be mapped
+            if offsets[-1] == 0:
+                return StringColumn(np.zeros(0, dtype=np.uint8), offsets)
+            return StringColumn(np.memmap(self.path.joinpath(column['file']), dtype=np.uint8, mode='r'), offsets)
+        with self.path.joinpath(column['file']).open('r') as file:
+            return json.load(file)
+
+def load_canonical(content_path):
+    """Open the canonical form of stored datasource content.
+    :param Path content_path: The stored content
+    :return: The canonical data, or None if the content was not converted
+    :rtype: CanonicalData
+    """
+    canonical_path = get_canonical_path(content_path)
+    try:
+        with canonical_path.joinpath(SCHEMA_FILE).open('r') as file:
+            schema = json.load(file)
+    except FileNotFoundError:
+        return None
+    if schema['format'] is None:
+        return None
+    return CanonicalData(canonical_path, schema)
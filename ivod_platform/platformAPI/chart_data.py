@@ -0,0 +1,299 @@
+"""Derived representations of the processed data of a chart (data.json)"""
+import json
+import os
+import struct
+from pathlib import Path
+from shutil import rmtree
+from uuid import uuid4
+
+import numpy as np
+from django.conf import settings
+
+DOWNSAMPLE_DIRECTORY = 'downsampled'
+COLUMNAR_FILE = 'data.col'
+COLUMNAR_CONTENT_TYPE = 'application/vnd.ivod.columnar'
+# File layout: magic, header length (uint32 LE), JSON header, padding to 8 bytes, column buffers
+COLUMNAR_MAGIC = b'IVODCOL1'
+COLUMNAR_ALIGNMENT = 8
+# One JSON encoded row per line, and the byte offsets of all lines plus the end of file as uint64 LE
+ROWS_FILE = 'data.rows'
+ROW_INDEX_FILE = 'data.idx'
+
+
+class UnsupportedData(Exception):
+    """The data of a chart is valid, but can not be served in the requested representation"""
+
+
+def load_rows(chart_path):
+    """Load the processed data rows of a chart.
+    :param Path chart_path: Directory of the rendered chart
+    :return: List of data rows
+    :rtype: [dict]
+    """
+    with Path(chart_path).joinpath('data.json').open('rb') as data_file:
+        return json.load(data_file)
+
+def is_tabular(rows):
+    """Check if chart data is a list of row dictionaries. Some chart types (e.g. hive plots) use other structures."""
+    return isinstance(rows, list) and all(isinstance(row, dict) for row in rows)
+
+def _numeric_column(rows, key):
+    """Convert a column to a float array. Returns None if the column is not numeric."""
+    values = [row.get(key) if isinstance(row, dict) else None for row in rows]
+    if not all(value is None or (type(value) in (int, float)) for value in values):
+        return None
+    if all(value is None for value in values):
+        return None
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+def lttb_indices(x, y, max_points):
+    """Select rows with the Largest-Triangle-Three-Buckets algorithm.
+    Triangle areas of all series are summed up, so each selected row is representative for all of its series.
+    :param numpy.ndarray x: x values of shape (n,), sorted ascending
+    :param numpy.ndarray y: y values of shape (n, series), normalized to comparable ranges
+    :param int max_points: Number of rows to select, at least 3
+    :return: Sorted indices of the selected rows
+    :rtype: numpy.ndarray
+    """
+    n = len(x)
+    if max_points >= n:
+        return np.arange(n)
+    # First and last point are always kept, the inner points are split into equally sized buckets
+    bucket_count = max_points - 2
+    edges = np.linspace(1, n - 1, bucket_count + 1).astype(np.int64)
+    counts = np.diff(edges)
+    x_average = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    y_average = np.add.reduceat(y[:n - 1], edges[:-1], axis=0) / counts[:, None]
+    # The third corner of a triangle is the average of the following bucket, or the last point for the last bucket
+    next_x = np.append(x_average[1:], x[-1])
+    next_y = np.vstack((y_average[1:], y[-1:]))
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(bucket_count):
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs(
+            (x[a] - next_x[i]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end])[:, None] * (next_y[i] - y[a])
+        ).sum(axis=1)
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+def downsample_rows(rows, max_points):
+    """Reduce the data rows of a chart to at most max_points rows. Selected rows are kept unchanged.
+    The first numeric column is used as x axis if it is sorted, otherwise the row index is used.
+    :param [dict] rows: Data rows, as found in data.json
+    :param int max_points: Maximal number of rows to return, at least 3
+    :rtype: [dict]
+    """
+    if len(rows) <= max_points:
+        return rows
+    keys = list(rows[0].keys()) if isinstance(rows[0], dict) else []
+    columns = [column for column in (_numeric_column(rows, key) for key in keys) if column is not None]
+
+    x = np.arange(len(rows), dtype=np.float64)
+    if columns and not np.isnan(columns[0]).any() and np.all(np.diff(columns[0]) >= 0):
+        x = columns.pop(0)
+    if not columns:
+        # Nothing to preserve the shape of, keep evenly spaced rows
+        indices = np.unique(np.linspace(0, len(rows) - 1, max_points).astype(np.int64))
+        return [rows[i] for i in indices]
+
+    y = np.column_stack(columns)
+    minimum = np.nanmin(y, axis=0)
+    value_range = np.nanmax(y, axis=0) - minimum
+    value_range[value_range == 0] = 1
+    y = np.nan_to_num((y - minimum) / value_range)
+    x_range = x[-1] - x[0]
+    x = (x - x[0]) / (x_range if x_range else 1)
+    return [rows[i] for i in lttb_indices(x, y, max_points)]
+
+def get_downsampled_data(chart_path, max_points):
+    """Get the serialized, downsampled data of a chart. Results are cached on disk until the chart is rendered again.
+    :param Path chart_path: Directory of the rendered chart
+    :param int max_points: Maximal number of rows to return, at least 3
+    :raises UnsupportedData: If the data of the chart is not a list of rows
+    :return: JSON encoded data rows
+    :rtype: bytes
+    """
+    cache_path = Path(chart_path).joinpath(DOWNSAMPLE_DIRECTORY)
+    cache_file = cache_path.joinpath(f"{max_points}.json")
+    try:
+        with cache_file.open('rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    rows = load_rows(chart_path)
+    if not isinstance(rows, list):
+        raise UnsupportedData("Data of this chart can not be downsampled")
+    content = json.dumps(downsample_rows(rows, max_points)).encode('utf-8')
+    cache_path.mkdir(exist_ok=True)
+    # Limit the amount of cached variants per chart, as max_points is chosen by the client
+    if len(os.listdir(cache_path)) < getattr(settings, "CHART_DOWNSAMPLE_CACHE_ENTRIES", 16):
+        temp_file = cache_path.joinpath(f".{uuid4().hex}.tmp")
+        with temp_file.open('wb') as file:
+            file.write(content)
+        os.replace(temp_file, cache_file)
+    return content
+
+def _encode_column(values):
+    """Encode the values of one column. Returns the column type and the encoded buffer."""
+    if all(value is None or type(value) in (int, float) for value in values) and any(value is not None for value in values):
+        if all(type(value) == int and -2**31 <= value < 2**31 for value in values):
+            return 'int32', np.array(values, dtype='<i4').tobytes()
+        return 'float64', np.array([np.nan if value is None else value for value in values], dtype='<f8').tobytes()
+    # Strings, mixed or nested values are kept as a JSON array, which is still parsed in one go by the client
+    return 'json', json.dumps(values, separators=(',', ':')).encode('utf-8')
+
+def encode_columnar(rows):
+    """Encode data rows into the columnar format.
+    Numeric columns are stored as little endian typed arrays aligned to 8 bytes, so clients can view them without copying.
+    In float64 columns NaN marks a missing value. All other columns are stored as JSON arrays.
+    :param [dict] rows: Data rows, as found in data.json
+    :raises UnsupportedData: If the rows are not tabular
+    :rtype: bytes
+    """
+    if not is_tabular(rows):
+        raise UnsupportedData("Data of this chart is not tabular")
+    keys = {}
+    for row in rows:
+        for key in row:
+            keys.setdefault(key, None)
+
+    columns = []
+    buffers = []
+    offset = 0
+    for key in keys:
+        column_type, buffer = _encode_column([row.get(key) for row in rows])
+        columns.append({'name': key, 'type': column_type, 'offset': offset, 'length': len(buffer)})
+        padding = -len(buffer) % COLUMNAR_ALIGNMENT
+        buffers.append(buffer + b'\0' * padding)
+        offset += len(buffer) + padding
+
+    header = json.dumps({'rows': len(rows), 'columns': columns}, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-(len(COLUMNAR_MAGIC) + 4 + len(header)) % COLUMNAR_ALIGNMENT)
+    return b''.join([COLUMNAR_MAGIC, struct.pack('<I', len(header)), header] + buffers)
+
+def decode_columnar(content):
+    """Decode the columnar format into columns.
+    :param bytes content: Encoded data
+    :return: Number of rows and a dictionary mapping column names to numpy arrays or lists
+    :rtype: (int, dict)
+    """
+    if content[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar data file")
+    (header_length,) = struct.unpack_from('<I', content, len(COLUMNAR_MAGIC))
+    body_offset = len(COLUMNAR_MAGIC) + 4 + header_length
+    header = json.loads(content[len(COLUMNAR_MAGIC) + 4:body_offset])
+    columns = {}
+    for column in header['columns']:
+        start = body_offset + column['offset']
+        if column['type'] == 'json':
+            columns[column['name']] = json.loads(content[start:start + column['length']])
+        else:
+            dtype = '<i4' if column['type'] == 'int32' else '<f8'
+            columns[column['name']] = np.frombuffer(content, dtype=dtype, count=header['rows'], offset=start)
+    return header['rows'], columns
+
+def get_columnar_data(chart_path):
+    """Get the columnar encoded data of a chart. Charts rendered before the format existed are converted on first use.
+    :param Path chart_path: Directory of the rendered chart
+    :raises UnsupportedData: If the data of the chart is not tabular
+    :rtype: bytes
+    """
+    try:
+        with Path(chart_path).joinpath(COLUMNAR_FILE).open('rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return write_columnar_data(chart_path, load_rows(chart_path))
+
+def write_columnar_data(chart_path, rows):
+    """Write the columnar encoding of the data rows of a chart.
+    :param Path chart_path: Directory of the rendered chart
+    :param [dict] rows: Data rows, as found in data.json
+    :return: The written content
+    :rtype: bytes
+    """
+    content = encode_columnar(rows)
+    temp_file = Path(chart_path).joinpath(f".{uuid4().hex}.tmp")
+    with temp_file.open('wb') as file:
+        file.write(content)
+    os.replace(temp_file, Path(chart_path).joinpath(COLUMNAR_FILE))
+    return content
+
+def write_row_index(chart_path, rows):
+    """Write the data rows of a chart line by line, together with an index of the line offsets.
+    :param Path chart_path: Directory of the rendered chart
+    :param list rows: Data rows, as found in data.json
+    """
+    offsets = np.empty(len(rows) + 1, dtype='<u8')
+    position = 0
+    temp_rows_file = Path(chart_path).joinpath(f".{uuid4().hex}.tmp")
+    with temp_rows_file.open('wb') as file:
+        for i, row in enumerate(rows):
+            line = json.dumps(row, separators=(',', ':')).encode('utf-8') + b'\n'
+            offsets[i] = position
+            file.write(line)
+            position += len(line)
+    offsets[-1] = position
+    temp_index_file = Path(chart_path).joinpath(f".{uuid4().hex}.tmp")
+    with temp_index_file.open('wb') as file:
+        file.write(offsets.tobytes())
+    os.replace(temp_rows_file, Path(chart_path).joinpath(ROWS_FILE))
+    os.replace(temp_index_file, Path(chart_path).joinpath(ROW_INDEX_FILE))
+
+def get_data_page(chart_path, offset, limit, columns=None):
+    """Get a window of the data rows of a chart. Only the index entries and rows of the window are read.
+    Charts rendered before the index existed are indexed on first use.
+    :param Path chart_path: Directory of the rendered chart
+    :param int offset: Index of the first row
+    :param int limit: Maximal number of rows
+    :param [str] columns: If given, only these keys are kept in each row
+    :raises UnsupportedData: If the data of the chart is not a list of rows
+    :return: Total number of rows and the rows of the window
+    :rtype: (int, list)
+    """
+    index_path = Path(chart_path).joinpath(ROW_INDEX_FILE)
+    if not index_path.exists():
+        rows = load_rows(chart_path)
+        if not isinstance(rows, list):
+            raise UnsupportedData("Data of this chart can not be paged")
+        write_row_index(chart_path, rows)
+
+    with index_path.open('rb') as index_file:
+        total = os.fstat(index_file.fileno()).st_size // 8 - 1
+        start = min(offset, total)
+        end = min(offset + limit, total)
+        index_file.seek(start * 8)
+        bounds = np.frombuffer(index_file.read((end - start + 1) * 8), dtype='<u8')
+    with Path(chart_path).joinpath(ROWS_FILE).open('rb') as rows_file:
+        rows_file.seek(int(bounds[0]))
+        chunk = rows_file.read(int(bounds[-1] - bounds[0]))
+
+    rows = [json.loads(line) for line in chunk.splitlines()]
+    if columns is not None:
+        rows = [{key: row[key] for key in columns if key in row} if isinstance(row, dict) else row for row in rows]
+    return total, rows
+
+def clear_derived_data(chart_path):
+    """Remove all data derived from data.json of a chart.
+    :param Path chart_path: Directory of the rendered chart
+    """
+    rmtree(Path(chart_path).joinpath(DOWNSAMPLE_DIRECTORY), ignore_errors=True)
+    for name in (COLUMNAR_FILE, ROW_INDEX_FILE, ROWS_FILE):
+        Path(chart_path).joinpath(name).unlink(missing_ok=True)
+
+def write_derived_data(chart_path):
+    """Replace all data derived from data.json of a chart. Must be called whenever the chart is rendered.
+    :param Path chart_path: Directory of the rendered chart
+    """
+    clear_derived_data(chart_path)
+    rows = load_rows(chart_path)
+    if is_tabular(rows):
+        write_columnar_data(chart_path, rows)
+    if isinstance(rows, list):
+        write_row_index(chart_path, rows)
@@ -0,0 +1,125 @@
+"""Compression of datasource files at rest.
+
+Compressed files keep their name and are recognized by the magic number of their format, so stored paths
+and content hashes stay valid and plain and compressed files can be mixed. CSV and JSON files are UTF-8 text,
+which never starts with one of the magic numbers. Everything reading datasource content opens it with
+open_datasource_file, which decompresses while reading.
+"""
+import gzip
+import io
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Bytes copied at once while compressing or decompressing
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def get_compression():
+    """Get the compression applied to new datasource files. zstd falls back to gzip if zstandard is not installed.
+    :return: COMPRESSION_GZIP, COMPRESSION_ZSTD or None
+    :rtype: str
+    """
+    compression = getattr(settings, "DATASOURCE_COMPRESSION", None)
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        return COMPRESSION_GZIP
+    if compression not in (COMPRESSION_GZIP, COMPRESSION_ZSTD):
+        return None
+    return compression
+
+def get_file_compression(path):
+    """Detect the compression of a file from its magic number.
+    :param Path path: The file
+    :return: COMPRESSION_GZIP, COMPRESSION_ZSTD or None
+    :rtype: str
+    """
+    with Path(path).open('rb') as file:
+        magic = file.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return COMPRESSION_GZIP
+    if magic == ZSTD_MAGIC:
+        return COMPRESSION_ZSTD
+    return None
+
+def open_datasource_file(path):
+    """Open a datasource file for reading, decompressing it on the fly if it is compressed.
+    :param Path path: The file
+    :return: Binary stream of the uncompressed content
+    :raises OSError: If the file can not be read, or is compressed with zstd and zstandard is not installed
+    """
+    compression = get_file_compression(path)
+    if compression == COMPRESSION_GZIP:
+        return gzip.open(path, 'rb')
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise OSError(f"{path} is compressed with zstd, but zstandard is not installed")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(Path(path).open('rb'), closefd=True))
+    return Path(path).open('rb')
+
+def open_compressed_writer(path, compression):
+    """Open a file for writing with the given compression.
+    :param Path path: The file
+    :param str compression: COMPRESSION_GZIP, COMPRESSION_ZSTD or None
+    :return: Binary stream, which compresses everything written to it
+    """
+    if compression == COMPRESSION_GZIP:
+        return gzip.open(path, 'wb', compresslevel=getattr(settings, "DATASOURCE_COMPRESSION_LEVEL_GZIP", 6))
+    if compression == COMPRESSION_ZSTD:
+        compressor = zstandard.ZstdCompressor(level=getattr(settings, "DATASOURCE_COMPRESSION_LEVEL_ZSTD", 10))
+        return compressor.stream_writer(Path(path).open('wb'), closefd=True)
+    return Path(path).open('wb')
+
+def compress_file(path, compression=None):
+    """Compress a datasource file in place. The file is replaced atomically, readers keep the version they opened.
+    Files that are compressed already are left as they are.
+    :param Path path: The file
+    :param str compression: COMPRESSION_GZIP or COMPRESSION_ZSTD, the configured compression if None
+    :return: Size of the file before and after compressing
+    :rtype: (int, int)
+    """
+    path = Path(path)
+    compression = compression or get_compression()
+    size = path.stat().st_size
+    if compression is None or get_file_compression(path) is not None:
+        return size, size
+    temp_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+    try:
+        with path.open('rb') as source, open_compressed_writer(temp_path, compression) as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return size, path.stat().st_size
+
+@contextmanager
+def materialize_datasource_file(path):
+    """Provide a datasource file as plain file, for readers which only take paths like pive.
+    Compressed files are decompressed into a temporary file next to them, which is removed afterwards.
+    :param Path path: The file
+    :return: Path of the plain file
+    :rtype: Path
+    """
+    path = Path(path)
+    if get_file_compression(path) is None:
+        yield path
+        return
+    temp_path = path.with_name(f".{path.name}.{uuid4().hex}.plain")
+    try:
+        with open_datasource_file(path) as source, temp_path.open('wb') as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        yield temp_path
+    finally:
+        temp_path.unlink(missing_ok=True)
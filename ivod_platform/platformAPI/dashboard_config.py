@@ -0,0 +1,281 @@
+"""Helpers to work with dashboard configs.
+A config is a split tree: splits carry an aspect ratio and up to two children 'c1' and 'c2',
+children either contain another 'split' or a generator with its 'args'.
+"""
+import json
+import re
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import DashboardChartReference
+
+CHART_GENERATOR = 'chart'
+SUPPORTED_GENERATORS = ['id', CHART_GENERATOR] #TODO: Get list from config to make adding generators easier
+
+SPLIT_KEYS = {'aspect', 'c1', 'c2', 'horizontal'}
+CHILD_KEYS = {'split', 'generatorName', 'args'}
+NUMBER_TYPES = {int, float}
+CHART_ID = re.compile(r'[0-9]+')
+# Range of DashboardChartReference.chart_id, an IntegerField
+CHART_ID_RANGE = range(-2 ** 31, 2 ** 31)
+
+def validate_config(config, strip_extra=True):
+    """Validate a dashboard config and remove unknown keys. The tree is walked iteratively and bounded by
+    DASHBOARD_MAX_DEPTH nested splits, DASHBOARD_MAX_NODES objects and lists, including those in generator args,
+    and DASHBOARD_MAX_SIZE bytes of serialized JSON.
+    :param config: The config, either parsed or as JSON string
+    :param bool strip_extra: Remove unknown keys instead of failing on them
+    :return: The validated config
+    :rtype: dict
+    :raises ValueError: If the config is invalid or exceeds a limit
+    """
+    max_size = getattr(settings, "DASHBOARD_MAX_SIZE", 256 * 1024)
+    if isinstance(config, (str, bytes)):
+        if len(config) > max_size:
+            raise ValueError(f"Config exceeds {max_size} bytes")
+        try:
+            config = json.loads(config)
+        except (ValueError, RecursionError):
+            raise ValueError("Config must be valid JSON")
+    if not isinstance(config, dict):
+        raise ValueError("Config must be a JSON object")
+
+    _validate_nodes([(config, 'split', 1)], strip_extra)
+    check_config_size(config)
+    return config
+
+def check_config_size(config):
+    """Check the size of a parsed config against DASHBOARD_MAX_SIZE.
+    :param dict config: The parsed config
+    :raises ValueError: If the config is too large
+    """
+    max_size = getattr(settings, "DASHBOARD_MAX_SIZE", 256 * 1024)
+    if len(json.dumps(config, separators=(',', ':'))) > max_size:
+        raise ValueError(f"Config exceeds {max_size} bytes")
+
+def check_config_nodes(config):
+    """Count the nodes of a parsed config against DASHBOARD_MAX_NODES, the same way validation counts them.
+    The structure of the config must have been validated, counting stops once the limit is exceeded.
+    :param dict config: The parsed config
+    :raises ValueError: If the config has too many nodes
+    """
+    max_nodes = getattr(settings, "DASHBOARD_MAX_NODES", 1024)
+    nodes = 0
+    stack = [(config, 'split')]
+    while stack:
+        node, kind = stack.pop()
+        nodes += 1
+        if nodes > max_nodes:
+            raise ValueError(f"Config exceeds {max_nodes} nodes")
+        if kind is None:
+            values = node.values() if isinstance(node, dict) else node
+            stack.extend((value, None) for value in values if isinstance(value, (dict, list)))
+        elif kind == 'split':
+            stack.extend((node[key], 'child') for key in ('c1', 'c2') if key in node)
+        else:
+            if 'split' in node:
+                stack.append((node['split'], 'split'))
+            if isinstance(node.get('args'), (dict, list)):
+                stack.append((node['args'], None))
+
+def _validate_nodes(stack, strip_extra):
+    """Validate subtrees of a config iteratively.
+    :param list stack: Subtrees to validate as (value, kind, depth), kind is 'split', 'child' or None for values in
+                       generator args. Depth counts splits only, nesting within args is bounded by the node limit
+    :param bool strip_extra: Remove unknown keys instead of failing on them
+    :raises ValueError: If a subtree is invalid or exceeds a limit
+    """
+    max_depth = getattr(settings, "DASHBOARD_MAX_DEPTH", 32)
+    max_nodes = getattr(settings, "DASHBOARD_MAX_NODES", 1024)
+    nodes = 0
+    while stack:
+        node, kind, depth = stack.pop()
+        nodes += 1
+        if nodes > max_nodes:
+            raise ValueError(f"Config exceeds {max_nodes} nodes")
+        if depth > max_depth:
+            raise ValueError(f"Config exceeds a depth of {max_depth}")
+
+        if kind is None:
+            values = node.values() if isinstance(node, dict) else node
+            stack.extend((value, None, depth) for value in values if isinstance(value, (dict, list)))
+            continue
+        if not isinstance(node, dict):
+            raise ValueError(f"{kind} must be an object")
+
+        allowed = SPLIT_KEYS if kind == 'split' else CHILD_KEYS
+        extra = set(node.keys()) - allowed
+        if extra:
+            if not strip_extra:
+                raise ValueError(f"Invalid keys: {extra}")
+            for key in extra:
+                del node[key]
+
+        if kind == 'split':
+            aspect = node.get('aspect')
+            if aspect is None:
+                raise ValueError("split must have an aspect ratio")
+            if (not isinstance(aspect, list) or len(aspect) != 2 or type(aspect[0]) not in NUMBER_TYPES or type(aspect[1]) not in NUMBER_TYPES
+                    or aspect[0] < 0 or aspect[1] < 0):
+                raise ValueError("aspect ratio must be a list of exact 2 positive integers")
+            for key in ('c2', 'c1'):
+                if key in node:
+                    stack.append((node[key], 'child', depth))
+        else:
+            if 'split' in node:
+                stack.append((node['split'], 'split', depth + 1))
+            if 'generatorName' in node and node['generatorName'] not in SUPPORTED_GENERATORS:
+                raise ValueError(f"Unsupported generator: {node['generatorName']}")
+            #TODO: Validate args? Those depend on the used generator. Hardcoding this makes changing generators harder
+            if isinstance(node.get('args'), (dict, list)):
+                stack.append((node['args'], None, depth))
+
+def validate_config_paths(config, paths, strip_extra=True):
+    """Validate the parts of a config which changed at the given paths, e.g. after applying a JSON patch.
+    For every path, the innermost split or child containing it is validated together with everything below it,
+    the rest of the config is assumed to be valid. The depth limit applies to the validated parts,
+    the node and size limits to the whole config.
+    :param dict config: The parsed config
+    :param [[str]] paths: Changed paths as JSON pointer tokens
+    :param bool strip_extra: Remove unknown keys instead of failing on them
+    :return: The validated config
+    :rtype: dict
+    :raises ValueError: If a changed part is invalid or a limit is exceeded
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Config must be a JSON object")
+    affected = {}
+    for path in paths:
+        node, kind, depth = config, 'split', 1
+        prefix = ()
+        for token in path:
+            child = node.get(token) if isinstance(node, dict) else None
+            if kind == 'split' and token in ('c1', 'c2') and child is not None:
+                node, kind = child, 'child'
+            elif kind == 'child' and token == 'split' and child is not None:
+                node, kind, depth = child, 'split', depth + 1
+            else:
+                break
+            prefix += (token,)
+        affected[prefix] = (node, kind, depth)
+    # Subtrees below another affected subtree are validated with it
+    roots = [prefix for prefix in affected if not any(prefix[:len(other)] == other for other in affected if other != prefix)]
+    _validate_nodes([affected[prefix] for prefix in roots], strip_extra)
+    # Small patches could otherwise grow a config past the limit step by step
+    check_config_nodes(config)
+    check_config_size(config)
+    return config
+
+def get_chart_ids(config):
+    """Collect the ids of all charts referenced by a dashboard config.
+    :param dict config: The parsed dashboard config
+    :return: Chart ids in order of appearance, without duplicates
+    :rtype: list
+    """
+    chart_ids = {}
+    stack = [config]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        args = node.get('args')
+        if node.get('generatorName') == CHART_GENERATOR and isinstance(args, dict) and 'chartID' in args:
+            chart_id = args['chartID']
+            # Ids may be any JSON value, 1, 1.0 and true must not collapse into one
+            key = (type(chart_id).__name__, json.dumps(chart_id, sort_keys=True))
+            chart_ids.setdefault(key, chart_id)
+        if 'split' in node:
+            stack.append(node['split'])
+        # Push c2 first, so c1 is visited first
+        for key in ('c2', 'c1'):
+            if key in node:
+                stack.append(node[key])
+    return list(chart_ids.values())
+
+def get_layout(config):
+    """Compute the rectangles of all generators of a dashboard config, relative to the size of the dashboard.
+    A split divides its rectangle between c1 and c2 in the ratio of its aspect, horizontal splits place c1 above c2,
+    others place c1 left of c2. Validation must have been done by the caller.
+    :param dict config: The parsed dashboard config
+    :return: Generators in order of appearance with 'rect' (x, y, width and height between 0 and 1),
+             'generatorName' and 'args'
+    :rtype: [dict]
+    """
+    items = []
+    # Entries are (split, rect) or (None, item), children are pushed in reverse to keep the order of appearance
+    stack = [(config, (0.0, 0.0, 1.0, 1.0))]
+    while stack:
+        split, value = stack.pop()
+        if split is None:
+            items.append(value)
+            continue
+        x, y, width, height = value
+        first, second = split['aspect']
+        share = first / (first + second) if first + second > 0 else 0.5
+        if split.get('horizontal'):
+            rects = {'c1': (x, y, width, height * share), 'c2': (x, y + height * share, width, height * (1 - share))}
+        else:
+            rects = {'c1': (x, y, width * share, height), 'c2': (x + width * share, y, width * (1 - share), height)}
+        for key in ('c2', 'c1'):
+            child = split.get(key)
+            if not child:
+                continue
+            if 'split' in child:
+                stack.append((child['split'], rects[key]))
+            elif 'generatorName' in child:
+                rect = dict(zip(('x', 'y', 'width', 'height'), (round(value, 6) for value in rects[key])))
+                stack.append((None, {'rect': rect, 'generatorName': child['generatorName'], 'args': child.get('args', {})}))
+    return items
+
+def parse_chart_id(chart_id):
+    """Parse the id of a chart referenced by a dashboard config. Only integers and strings of digits are accepted,
+    other values like 1.7 or true can never match a chart, nor can ids beyond the range of the id column.
+    :param chart_id: The chartID taken from the config
+    :return: The id or None if it is malformed
+    :rtype: int
+    """
+    if type(chart_id) == int:
+        parsed = chart_id
+    elif isinstance(chart_id, str) and CHART_ID.fullmatch(chart_id):
+        parsed = int(chart_id)
+    else:
+        return None
+    return parsed if parsed in CHART_ID_RANGE else None
+
+def get_referenced_chart_ids(config):
+    """Get the ids of charts referenced by a dashboard config, as stored in the reference table.
+    Malformed ids are left out, see get_malformed_chart_ids.
+    :param dict config: The parsed dashboard config
+    :return: Chart ids in order of appearance, without duplicates
+    :rtype: [int]
+    """
+    chart_ids = {}
+    for chart_id in get_chart_ids(config):
+        chart_id = parse_chart_id(chart_id)
+        if chart_id is not None:
+            chart_ids.setdefault(chart_id, None)
+    return list(chart_ids)
+
+def get_malformed_chart_ids(config):
+    """Get the chart ids of a dashboard config which can never match a chart.
+    :param dict config: The parsed dashboard config
+    :return: The ids as given in the config, in order of appearance
+    :rtype: list
+    """
+    return [chart_id for chart_id in get_chart_ids(config) if parse_chart_id(chart_id) is None]
+
+def update_chart_references(dashboard):
+    """Rebuild the chart references of a dashboard from its config. Nothing is written if they did not change.
+    :param Dashboard dashboard: The saved dashboard
+    """
+    chart_ids = get_referenced_chart_ids(dashboard.config)
+    with transaction.atomic():
+        references = dashboard.chart_references.order_by('position').values_list('chart_id', flat=True)
+        if list(references) == chart_ids:
+            return
+        dashboard.chart_references.all().delete()
+        DashboardChartReference.objects.bulk_create([
+            DashboardChartReference(dashboard=dashboard, chart_id=chart_id, position=position)
+            for position, chart_id in enumerate(chart_ids)
+        ])
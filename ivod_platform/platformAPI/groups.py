@@ -0,0 +1,126 @@
+"""Nested share groups.
+
+Groups may contain other groups as member_groups, users of a member group are members of every group above it. The
+transitive closure of member_groups is kept in ShareGroupClosure, so the groups of a user at any depth are found with
+one indexed query. The closure only stores which groups are reachable and is updated incrementally whenever
+member_groups changes: an added edge connects the ancestors of the parent with the descendants of the child, removed
+edges recompute the descendants of the ancestors of their parents from the remaining edges. Every change holds one
+global lock from the cycle check to the last write. Edges which would create a cycle are rejected.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from .models import ShareGroup, ShareGroupClosure, ShareGroupClosureLock
+
+def get_direct_groups(user):
+    """Get the groups a user is member or admin of.
+    :param User user: The user
+    :return: Queryset of group ids
+    :rtype: QuerySet
+    """
+    return ShareGroup.objects.filter(Q(group_admins=user) | Q(group_members=user)).values('pk')
+
+def get_effective_groups(user):
+    """Get the groups a user belongs to directly or through member groups at any depth, for use as subquery.
+    :param User user: The user
+    :return: Queryset of group ids
+    :rtype: QuerySet
+    """
+    direct = get_direct_groups(user)
+    return ShareGroup.objects.filter(Q(pk__in=direct) | Q(descendant_links__descendant__in=direct)).values('pk')
+
+def lock_closure():
+    """Serialize changes of the closure. Must be called inside a transaction, before the closure is read."""
+    ShareGroupClosureLock.objects.select_for_update().get_or_create(pk=1)
+
+def would_create_cycle(parent_id, child_id):
+    """Check if making a group a member of another group would create a cycle.
+    :param int parent_id: The containing group
+    :param int child_id: The member group
+    :rtype: bool
+    """
+    return parent_id == child_id or ShareGroupClosure.objects.filter(ancestor_id=child_id, descendant_id=parent_id).exists()
+
+def _add_edge(parent_id, child_id):
+    """Connect the parent and its ancestors with the child and its descendants.
+    :param int parent_id: The containing group
+    :param int child_id: The member group
+    """
+    ancestors = set(ShareGroupClosure.objects.filter(descendant_id=parent_id).values_list('ancestor_id', flat=True))
+    ancestors.add(parent_id)
+    descendants = set(ShareGroupClosure.objects.filter(ancestor_id=child_id).values_list('descendant_id', flat=True))
+    descendants.add(child_id)
+    existing = set(ShareGroupClosure.objects.filter(ancestor_id__in=list(ancestors), descendant_id__in=list(descendants))
+                   .values_list('ancestor_id', 'descendant_id'))
+    ShareGroupClosure.objects.bulk_create([
+        ShareGroupClosure(ancestor_id=ancestor_id, descendant_id=descendant_id)
+        for ancestor_id in ancestors for descendant_id in descendants if (ancestor_id, descendant_id) not in existing
+    ])
+
+def _remove_edges(edges):
+    """Recompute the descendants of the parents of removed edges and of their ancestors from the remaining edges.
+    Other groups do not reach a removed edge and keep their descendants.
+    :param [(int, int)] edges: Pairs of containing group and member group, which may still be stored in member_groups
+    """
+    removed = set(edges)
+    parents = {parent_id for parent_id, _ in removed}
+    affected = set(ShareGroupClosure.objects.filter(descendant_id__in=list(parents)).values_list('ancestor_id', flat=True))
+    affected |= parents
+
+    rows = {}
+    for pk, ancestor_id, descendant_id in ShareGroupClosure.objects.filter(ancestor_id__in=list(affected)).values_list('pk', 'ancestor_id', 'descendant_id'):
+        rows.setdefault(ancestor_id, {})[descendant_id] = pk
+    children = {}
+    for parent_id, child_id in ShareGroup.member_groups.through.objects.filter(from_sharegroup_id__in=list(affected)).values_list('from_sharegroup_id', 'to_sharegroup_id'):
+        if (parent_id, child_id) not in removed:
+            children.setdefault(parent_id, set()).add(child_id)
+    unaffected = {child_id for child_ids in children.values() for child_id in child_ids} - affected
+    below = {}
+    for ancestor_id, descendant_id in ShareGroupClosure.objects.filter(ancestor_id__in=list(unaffected)).values_list('ancestor_id', 'descendant_id'):
+        below.setdefault(ancestor_id, set()).add(descendant_id)
+
+    # A group reaches more groups than any of its member groups did, so member groups are recomputed first
+    reachable = {}
+    for group_id in sorted(affected, key=lambda group_id: len(rows.get(group_id, ()))):
+        reached = set()
+        for child_id in children.get(group_id, ()):
+            reached.add(child_id)
+            reached |= reachable[child_id] if child_id in affected else below.get(child_id, set())
+        reachable[group_id] = reached
+    stale = [pk for group_id in affected for descendant_id, pk in rows.get(group_id, {}).items() if descendant_id not in reachable[group_id]]
+    ShareGroupClosure.objects.filter(pk__in=stale).delete()
+
+def add_closure_edges(edges):
+    """Add the closure of new member group edges.
+    :param [(int, int)] edges: Pairs of containing group and member group
+    :raises ValueError: If an edge would create a cycle
+    """
+    with transaction.atomic():
+        lock_closure()
+        for parent_id, child_id in edges:
+            if would_create_cycle(parent_id, child_id):
+                raise ValueError(f"Group {child_id} contains group {parent_id} already")
+            _add_edge(parent_id, child_id)
+
+def remove_closure_edges(edges):
+    """Remove the closure of removed member group edges.
+    :param [(int, int)] edges: Pairs of containing group and member group
+    """
+    if not edges:
+        return
+    with transaction.atomic():
+        lock_closure()
+        _remove_edges(edges)
+
+def rebuild_closure():
+    """Rebuild the whole closure from member_groups, e.g. after groups were changed without signals.
+    :return: Number of closure rows
+    :rtype: int
+    """
+    with transaction.atomic():
+        lock_closure()
+        ShareGroupClosure.objects.all().delete()
+        edges = list(ShareGroup.member_groups.through.objects.values_list('from_sharegroup_id', 'to_sharegroup_id'))
+        for parent_id, child_id in edges:
+            _add_edge(parent_id, child_id)
+        return ShareGroupClosure.objects.count()
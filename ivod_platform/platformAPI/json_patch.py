@@ -0,0 +1,135 @@
+"""JSON Patch (RFC 6902) and JSON Pointer (RFC 6901) for documents parsed from JSON.
+Patches are applied in place, callers keep the original if a patch may fail halfway.
+"""
+import copy
+
+JSON_PATCH_CONTENT_TYPE = 'application/json-patch+json'
+
+OPERATIONS = {'add', 'remove', 'replace', 'move', 'copy', 'test'}
+
+def parse_pointer(pointer):
+    """Split a JSON pointer into its reference tokens.
+    :param str pointer: The pointer, '' refers to the whole document
+    :rtype: [str]
+    :raises ValueError: If the pointer is malformed
+    """
+    if not isinstance(pointer, str):
+        raise ValueError(f"Invalid pointer: {pointer}")
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise ValueError(f"Pointer must start with '/': {pointer}")
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+def _array_index(array, token, allow_end=False):
+    """Resolve a reference token to an index of an array. '-' refers to the end, if allowed."""
+    if allow_end and token == '-':
+        return len(array)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise ValueError(f"Invalid array index: {token}")
+    index = int(token)
+    if index > len(array) or (index == len(array) and not allow_end):
+        raise ValueError(f"Array index out of range: {token}")
+    return index
+
+def _resolve(document, tokens):
+    """Get the value tokens refer to."""
+    value = document
+    for token in tokens:
+        if isinstance(value, dict):
+            if token not in value:
+                raise ValueError(f"Path not found: /{'/'.join(tokens)}")
+            value = value[token]
+        elif isinstance(value, list):
+            value = value[_array_index(value, token)]
+        else:
+            raise ValueError(f"Path not found: /{'/'.join(tokens)}")
+    return value
+
+def _add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_array_index(parent, tokens[-1], allow_end=True), value)
+    else:
+        raise ValueError(f"Can not add to a value: /{'/'.join(tokens)}")
+    return document
+
+def _remove(document, tokens):
+    if not tokens:
+        raise ValueError("The whole document can not be removed")
+    parent = _resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise ValueError(f"Path not found: /{'/'.join(tokens)}")
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(_array_index(parent, tokens[-1]))
+    raise ValueError(f"Path not found: /{'/'.join(tokens)}")
+
+def _json_equal(first, second):
+    """Compare values as JSON does: numbers by value, but booleans are no numbers."""
+    if isinstance(first, bool) or isinstance(second, bool):
+        return type(first) == type(second) and first == second
+    if isinstance(first, (int, float)) and isinstance(second, (int, float)):
+        return first == second
+    if isinstance(first, dict) and isinstance(second, dict):
+        return first.keys() == second.keys() and all(_json_equal(first[key], second[key]) for key in first)
+    if isinstance(first, list) and isinstance(second, list):
+        return len(first) == len(second) and all(_json_equal(a, b) for a, b in zip(first, second))
+    return type(first) == type(second) and first == second
+
+def apply_patch(document, patch):
+    """Apply a JSON patch.
+    :param document: The document, modified in place
+    :param list patch: The operations
+    :return: The patched document, which is a new object if the whole document was replaced
+    :raises ValueError: If the patch is malformed, can not be applied or a test fails
+    """
+    if not isinstance(patch, list):
+        raise ValueError("Patch must be a list of operations")
+    for operation in patch:
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            raise ValueError(f"Invalid operation: {operation}")
+        op = operation['op']
+        tokens = parse_pointer(operation.get('path'))
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise ValueError(f"Operation {op} requires a value")
+        if op == 'add':
+            document = _add(document, tokens, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _remove(document, tokens)
+        elif op == 'replace':
+            _resolve(document, tokens)
+            if tokens:
+                _remove(document, tokens)
+            document = _add(document, tokens, copy.deepcopy(operation['value']))
+        elif op in ('move', 'copy'):
+            from_tokens = parse_pointer(operation.get('from'))
+            if op == 'move':
+                if tokens[:len(from_tokens)] == from_tokens and tokens != from_tokens:
+                    raise ValueError("A value can not be moved into itself")
+                value = _remove(document, from_tokens) if from_tokens else document
+            else:
+                value = copy.deepcopy(_resolve(document, from_tokens))
+            document = _add(document, tokens, value)
+        elif not _json_equal(_resolve(document, tokens), operation['value']):
+            raise ValueError(f"Test failed: {operation.get('path')}")
+    return document
+
+def get_changed_paths(patch):
+    """Get the paths a patch changes. Removed and moved values change their former location.
+    :param list patch: A valid patch
+    :rtype: [[str]]
+    """
+    paths = []
+    for operation in patch:
+        if operation['op'] == 'test':
+            continue
+        paths.append(parse_pointer(operation['path']))
+        if operation['op'] == 'move':
+            paths.append(parse_pointer(operation['from']))
+    return paths
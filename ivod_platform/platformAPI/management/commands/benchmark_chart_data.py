@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from ...chart_data import encode_columnar, decode_columnar, is_tabular
+from pathlib import Path
+from timeit import timeit
+import json
+import gzip
+
+SAMPLE_DATA_PATH = Path(__file__).resolve().parent.parent.parent.joinpath("sample-data").joinpath("data")
+
+class Command(BaseCommand):
+    help = "Compare size and parse time of the JSON and the columnar chart data format"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help="data.json files to compare. Defaults to the sample datasets")
+        parser.add_argument('--repeat', type=int, default=20, help="Number of parse runs per format")
+        parser.add_argument('--synthetic-rows', type=int, default=1000000, help="Rows of an additional synthetic time series, 0 to disable")
+
+    def handle(self, *args, **options):
+        datasets = {}
+        paths = options['files'] or [SAMPLE_DATA_PATH.joinpath(name) for name in ("numerical.json", "simple_series.json", "groupdata.json")]
+        for path in paths:
+            with Path(path).open('rb') as file:
+                datasets[Path(path).name] = file.read()
+        if options['synthetic_rows']:
+            rows = [{'x': i, 'y1': (i * 7919) % 1000, 'y2': i / 3} for i in range(options['synthetic_rows'])]
+            datasets[f"synthetic ({options['synthetic_rows']} rows)"] = json.dumps(rows).encode('utf-8')
+
+        print(f"{'dataset':<32}{'json':>12}{'json.gz':>12}{'columnar':>12}{'col.gz':>12}{'json ms':>10}{'col ms':>10}")
+        for name, json_content in datasets.items():
+            rows = json.loads(json_content)
+            if not is_tabular(rows):
+                print(f"{name:<32} skipped, not tabular")
+                continue
+            columnar_content = encode_columnar(rows)
+            # Parse time into usable columns: JSON needs a full parse and a transposition, the columnar format is viewed in place
+            json_time = timeit(lambda: self.json_to_columns(json_content), number=options['repeat']) / options['repeat']
+            columnar_time = timeit(lambda: decode_columnar(columnar_content), number=options['repeat']) / options['repeat']
+            print(f"{name:<32}{len(json_content):>12}{len(gzip.compress(json_content)):>12}"
+                  f"{len(columnar_content):>12}{len(gzip.compress(columnar_content)):>12}"
+                  f"{json_time * 1000:>10.2f}{columnar_time * 1000:>10.2f}")
+
+    @staticmethod
+    def json_to_columns(content):
+        rows = json.loads(content)
+        return {key: [row.get(key) for row in rows] for key in rows[0]} if rows else {}
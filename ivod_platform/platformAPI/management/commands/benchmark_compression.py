@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from ...compression import compress_file, open_datasource_file, materialize_datasource_file, COMPRESSION_GZIP, COMPRESSION_ZSTD, COPY_BUFFER_SIZE, zstandard
+from ...preview import read_head
+from pathlib import Path
+from shutil import copyfile
+from tempfile import TemporaryDirectory
+from timeit import timeit
+
+class Command(BaseCommand):
+    help = "Compare disk usage and read times of datasource files stored plain and compressed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help="CSV or JSON datasource files to compare")
+        parser.add_argument('--repeat', type=int, default=3, help="Number of read runs per variant")
+        parser.add_argument('--synthetic-rows', type=int, default=200000, help="Rows of an additional synthetic CSV, 0 to disable")
+
+    def handle(self, *args, **options):
+        compressions = [None, COMPRESSION_GZIP] + ([COMPRESSION_ZSTD] if zstandard is not None else [])
+        with TemporaryDirectory() as directory:
+            directory = Path(directory)
+            paths = []
+            for index, path in enumerate(options['files']):
+                paths.append(directory.joinpath(f"{index}-{Path(path).name}"))
+                copyfile(path, paths[-1])
+            if options['synthetic_rows']:
+                paths.append(directory.joinpath(f"synthetic-{options['synthetic_rows']}.csv"))
+                with paths[-1].open('w') as file:
+                    file.write("x,y1,y2,label\n")
+                    for i in range(options['synthetic_rows']):
+                        file.write(f"{i},{(i * 7919) % 1000},{i / 3},L{i % 20}\n")
+
+            print(f"{'dataset':<32}{'mode':>6}{'size':>12}{'ratio':>7}{'compress s':>12}{'read s':>9}{'pive file s':>13}{'head s':>9}")
+            for path in paths:
+                for compression in compressions:
+                    variant = path.with_name(f"{path.name}.{compression or 'plain'}")
+                    copyfile(path, variant)
+                    compress_time = timeit(lambda: compress_file(variant, compression), number=1) if compression else 0.0
+                    size = variant.stat().st_size
+                    read_time = timeit(lambda: self.read_all(variant), number=options['repeat']) / options['repeat']
+                    materialize_time = timeit(lambda: self.materialize(variant), number=options['repeat']) / options['repeat']
+                    head_time = timeit(lambda: self.read_head(variant), number=options['repeat']) / options['repeat']
+                    print(f"{path.name:<32}{compression or 'none':>6}{size:>12}{path.stat().st_size / size:>7.1f}{compress_time:>12.3f}{read_time:>9.3f}{materialize_time:>13.3f}{head_time:>9.4f}")
+                    variant.unlink()
+
+    @staticmethod
+    def read_all(path):
+        """Stream the whole content, as the canonical conversion does"""
+        with open_datasource_file(path) as file:
+            while file.read(COPY_BUFFER_SIZE):
+                pass
+
+    @staticmethod
+    def materialize(path):
+        """Provide the content as plain file, as it is done for pive"""
+        with materialize_datasource_file(path):
+            pass
+
+    @staticmethod
+    def read_head(path):
+        """Read the first rows, as previews do"""
+        with open_datasource_file(path) as file:
+            read_head(file, 10)
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from pive import inputmanager
+from ...canonical import write_canonical, load_canonical
+from pathlib import Path
+from shutil import copyfile
+from tempfile import TemporaryDirectory
+from timeit import timeit
+import numpy as np
+
+class Command(BaseCommand):
+    help = "Compare load times of datasources by pive from the original file and from their canonical form"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help="CSV or JSON datasource files to compare")
+        parser.add_argument('--repeat', type=int, default=3, help="Number of load runs per variant")
+        parser.add_argument('--synthetic-rows', type=int, default=200000, help="Rows of an additional synthetic CSV, 0 to disable")
+
+    def handle(self, *args, **options):
+        with TemporaryDirectory() as directory:
+            directory = Path(directory)
+            paths = []
+            for index, path in enumerate(options['files']):
+                paths.append(directory.joinpath(f"{index}-{Path(path).name}"))
+                copyfile(path, paths[-1])
+            if options['synthetic_rows']:
+                paths.append(directory.joinpath(f"synthetic-{options['synthetic_rows']}.csv"))
+                with paths[-1].open('w') as file:
+                    file.write("x,y1,y2,label\n")
+                    for i in range(options['synthetic_rows']):
+                        file.write(f"{i},{(i * 7919) % 1000},{i / 3},L{i % 20}\n")
+
+            print(f"{'dataset':<32}{'size':>12}{'convert s':>11}{'pive s':>10}{'mmap s':>10}")
+            for path in paths:
+                convert_time = timeit(lambda: write_canonical(path), number=1)
+                canonical = load_canonical(path)
+                if canonical is None:
+                    print(f"{path.name:<32} skipped, not convertible")
+                    continue
+                original_time = self.time_pive(path, options['repeat'])
+                mmap_time = timeit(lambda: self.touch_columns(path), number=options['repeat']) / options['repeat']
+                print(f"{path.name:<32}{path.stat().st_size:>12}{convert_time:>11.3f}{original_time:>10.3f}{mmap_time:>10.4f}")
+
+    @staticmethod
+    def time_pive(path, repeat):
+        """Average time of pive reading and validating a file"""
+        def load():
+            manager = inputmanager.InputManager(mergedata=False, accept_unordered=getattr(settings, "DATA_ALLOW_UNORDERED", False))
+            manager.read(str(path))
+        return timeit(load, number=repeat) / repeat
+
+    @staticmethod
+    def touch_columns(path):
+        """Open the canonical form and reduce every numeric column, as profiling or previews would"""
+        canonical = load_canonical(path)
+        for name in canonical.columns:
+            column = canonical.column(name)
+            if isinstance(column, np.ndarray):
+                column.max()
+            else:
+                len(column)
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...models import Datasource
+from ...compression import compress_file, get_compression, COMPRESSION_GZIP, COMPRESSION_ZSTD, zstandard
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import os
+
+class Command(BaseCommand):
+    help = "Compress existing datasource files at rest. Files compressed already are skipped, so the command can be rerun at any time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compression', choices=[COMPRESSION_GZIP, COMPRESSION_ZSTD], default=None,
+                            help="Compression to apply, DATASOURCE_COMPRESSION by default")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of files compressed in parallel")
+
+    def handle(self, *args, **options):
+        compression = options['compression'] or get_compression()
+        if compression is None:
+            raise CommandError("No compression given and DATASOURCE_COMPRESSION is not set")
+        if compression == COMPRESSION_ZSTD and zstandard is None:
+            raise CommandError("zstd compression requires the zstandard package")
+
+        # Only files referenced by datasources are touched, url datasources and unknown files are left alone
+        paths = set()
+        for source in Datasource.objects.values_list('source', flat=True).distinct():
+            path = Path(source)
+            if not path.is_file():
+                continue
+            paths.add(path)
+
+        total_before = total_after = failed = 0
+        # zlib and zstd release the GIL while compressing, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            futures = {executor.submit(compress_file, path, compression): path for path in paths}
+            for future in as_completed(futures):
+                try:
+                    before, after = future.result()
+                except OSError as e:
+                    failed += 1
+                    print(f"Failed to compress {futures[future]}: {e}")
+                    continue
+                total_before += before
+                total_after += after
+        print(f"Compressed {len(paths) - failed} files with {compression}: {total_before} bytes -> {total_after} bytes")
+        if failed:
+            print(f"{failed} files failed and were left unchanged")
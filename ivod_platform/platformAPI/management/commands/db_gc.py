@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
-from ...models import User
+from ...models import User, UploadSession
+from ...uploads import discard_upload_session
+from django.utils import timezone
 from django.db.models import Q
 from datetime import timedelta, time, datetime
 from django.conf import settings
@@ -14,4 +16,10 @@ class Command(BaseCommand):
         for user in users_to_delete:
             print(f"Deleting user {user}")
             user.delete()
-        print("All stale users deleted")
\ No newline at end of file
+        print("All stale users deleted")
+
+        upload_session_timeout = timezone.now() - getattr(settings, "UPLOAD_SESSION_LIFETIME", timedelta(days=1))
+        for session in UploadSession.objects.filter(modification_time__lte=upload_session_timeout):
+            print(f"Deleting upload session {session.id}")
+            discard_upload_session(session)
+        print("All expired upload sessions deleted")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from ...models import Dashboard
+from ...dashboard_config import update_chart_references
+
+class Command(BaseCommand):
+    help = "Rebuild the chart references of all dashboards from their configs, e.g. for dashboards saved before references were recorded"
+
+    def handle(self, *args, **options):
+        count = 0
+        for dashboard in Dashboard.objects.only('id', 'config').iterator():
+            update_chart_references(dashboard)
+            count += 1
+        print(f"Indexed {count} dashboards")
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from ...groups import rebuild_closure
+
+class Command(BaseCommand):
+    help = "Rebuild the closure of nested share groups from their member groups, e.g. after groups were loaded from fixtures"
+
+    def handle(self, *args, **options):
+        count = rebuild_closure()
+        print(f"Rebuilt closure with {count} rows")
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from ...storage import iter_storage, find_orphans, remove_orphan, read_cursor, write_cursor
+from ...util import get_datasource_base_path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+from pathlib import Path
+from time import monotonic
+import os
+
+class Command(BaseCommand):
+    help = "Find files and directories of charts and datasources no database entry refers to, and delete or quarantine them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--action', choices=['report', 'delete', 'quarantine'], default='report',
+                            help="What to do with orphans, report only by default")
+        parser.add_argument('--quarantine-dir', default=getattr(settings, "STORAGE_QUARANTINE_PATH", None),
+                            help="Directory orphans are moved into, STORAGE_QUARANTINE_PATH by default")
+        parser.add_argument('--min-age', type=float, default=None,
+                            help="Minimum age of orphans in seconds, STORAGE_ORPHAN_MIN_AGE (1 hour) by default")
+        parser.add_argument('--time-budget', type=float, default=None,
+                            help="Stop after this many seconds and resume at the same position on the next run")
+        parser.add_argument('--state-file', default=getattr(settings, "STORAGE_RECONCILE_STATE_FILE", None),
+                            help="File storing the position of an interrupted run")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Entries checked against the database per query")
+        parser.add_argument('--workers', type=int, default=min(32, (os.cpu_count() or 1) * 4), help="Threads listing directories and checking files")
+
+    def handle(self, *args, **options):
+        if options['action'] == 'quarantine' and not options['quarantine_dir']:
+            raise CommandError("Quarantine requires --quarantine-dir or STORAGE_QUARANTINE_PATH")
+        quarantine_path = Path(options['quarantine_dir']) if options['action'] == 'quarantine' else None
+        min_age = options['min_age']
+        if min_age is None:
+            min_age = getattr(settings, "STORAGE_ORPHAN_MIN_AGE", timedelta(hours=1)).total_seconds()
+        state_path = Path(options['state_file'] or get_datasource_base_path().joinpath('.reconcile-state.json'))
+        # Only incremental runs resume, a run without budget always covers everything
+        incremental = options['time_budget'] is not None
+        cursor = read_cursor(state_path) if incremental else None
+        deadline = monotonic() + options['time_budget'] if incremental else None
+
+        scanned = orphaned = removed = 0
+        finished = True
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            entries = iter_storage(executor, after=cursor, ahead=max(1, options['workers']))
+            while True:
+                if deadline is not None and monotonic() >= deadline:
+                    finished = False
+                    break
+                batch = list(islice(entries, max(1, options['batch_size'])))
+                if not batch:
+                    break
+                scanned += len(batch)
+                for orphan in find_orphans(batch, executor, min_age):
+                    orphaned += 1
+                    if options['verbosity'] >= 2:
+                        print(f"Orphaned {orphan.kind}: {orphan.path}")
+                    if options['action'] != 'report' and remove_orphan(orphan, min_age, quarantine_path):
+                        removed += 1
+                cursor = batch[-1].position
+
+        if incremental:
+            write_cursor(state_path, None if finished else cursor)
+        print(f"Scanned {scanned} entries, found {orphaned} orphans, {'deleted' if quarantine_path is None else 'quarantined'} {removed}")
+        if not finished:
+            print("Time budget exhausted, the next run resumes at the current position")
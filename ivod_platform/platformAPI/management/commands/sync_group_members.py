@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...memberships import MEMBERSHIP_ROLES, iter_identifiers, resolve_users, sync_group_members
+from ...models import ShareGroup
+import sys
+
+class Command(BaseCommand):
+    help = "Import or sync members or admins of a group from a CSV or JSON list of emails or ids"
+
+    def add_arguments(self, parser):
+        parser.add_argument('group', type=int, help="ID of the group")
+        parser.add_argument('file', help="CSV file with one user per row or JSON file with a list of users, '-' reads from stdin")
+        parser.add_argument('--role', choices=list(MEMBERSHIP_ROLES), default='members', help="Role of the listed users")
+        parser.add_argument('--format', choices=['csv', 'json'], default=None,
+                            help="Format of the list, by file extension and CSV otherwise by default")
+        parser.add_argument('--add-only', action='store_true', help="Keep users which are not listed")
+        parser.add_argument('--allow-empty', action='store_true', help="Remove all users if the list is empty")
+        parser.add_argument('--batch-size', type=int, default=None, help="Users resolved, inserted or deleted per query")
+
+    def handle(self, *args, **options):
+        try:
+            group = ShareGroup.objects.get(pk=options['group'])
+        except ShareGroup.DoesNotExist:
+            raise CommandError(f"Group {options['group']} does not exist")
+        list_format = options['format'] or ('json' if options['file'].endswith('.json') else 'csv')
+        content_type = 'application/json' if list_format == 'json' else 'text/csv'
+        try:
+            stream = sys.stdin.buffer if options['file'] == '-' else open(options['file'], 'rb')
+        except OSError as e:
+            raise CommandError(f"Can not read {options['file']}: {e}")
+        try:
+            user_ids = resolve_users(iter_identifiers(stream, content_type), options['batch_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+        if not options['add_only'] and not user_ids and not options['allow_empty']:
+            raise CommandError("Empty list would remove all users, confirm with --allow-empty")
+        added, removed = sync_group_members(group, options['role'], user_ids, remove=not options['add_only'],
+                                            batch_size=options['batch_size'])
+        print(f"Added {added} and removed {removed} {options['role']} of group {group.pk}")
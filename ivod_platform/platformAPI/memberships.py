@@ -0,0 +1,127 @@
+"""Bulk import and sync of group memberships.
+
+Lists of users are read as CSV, one user per row in the first column, or as JSON list. Users are given by email or id
+and resolved in batches, so a list of thousands of users takes a few queries. The list is compared with the current
+members of the group and only the difference is written: missing users are bulk inserted into the through table and
+users no longer listed are bulk deleted, both in one transaction.
+"""
+import csv
+import io
+import json
+import uuid
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .canonical import JSONStreamReader
+from .models import ShareGroup, User
+from .util import LimitedStream
+
+# Roles of users in a group and the many to many field holding them
+MEMBERSHIP_ROLES = {
+    'members': 'group_members',
+    'admins': 'group_admins',
+}
+
+# Header cells skipped in the first row of CSV lists
+CSV_HEADERS = {'email', 'id', 'user', 'users'}
+
+def _batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def iter_identifiers(stream, content_type):
+    """Read the user identifiers of a membership list.
+    :param stream: Object with read(size) returning the UTF-8 encoded list
+    :param str content_type: 'application/json' for a JSON list, CSV otherwise
+    :return: Generator of emails and ids, CSV rows and elements of JSON lists are read one at a time
+    :raises ValueError: If the list is malformed or larger than GROUP_MEMBERSHIP_MAX_SIZE
+    """
+    max_size = getattr(settings, "GROUP_MEMBERSHIP_MAX_SIZE", 16 * 1024 * 1024)
+    text = io.TextIOWrapper(io.BufferedReader(LimitedStream(stream, max_size)), encoding='utf-8', newline='')
+    if content_type.startswith('application/json'):
+        reader = JSONStreamReader(text)
+        try:
+            if reader.peek() != '[':
+                raise ValueError("Users must be a list of emails or ids")
+            for identifier in reader.iter_list():
+                if not isinstance(identifier, str):
+                    raise ValueError("Users must be a list of emails or ids")
+                yield identifier
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        return
+    try:
+        for number, row in enumerate(csv.reader(text), start=1):
+            if not row or not row[0].strip():
+                continue
+            identifier = row[0].strip()
+            if number == 1 and identifier.lower() in CSV_HEADERS:
+                continue
+            yield identifier
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid CSV: {e}")
+
+def resolve_users(identifiers, batch_size=None):
+    """Resolve emails and ids of users, one query per batch.
+    :param identifiers: Iterable of emails and ids
+    :param int batch_size: Identifiers per query, GROUP_MEMBERSHIP_BATCH_SIZE by default
+    :return: Ids of the users
+    :rtype: {uuid.UUID}
+    :raises ValueError: If an identifier doesnt refer to any user
+    """
+    batch_size = batch_size or getattr(settings, "GROUP_MEMBERSHIP_BATCH_SIZE", 1000)
+    user_ids = set()
+    for batch in _batches(identifiers, batch_size):
+        emails = set()
+        ids = set()
+        for identifier in batch:
+            if '@' in identifier:
+                emails.add(identifier)
+                continue
+            try:
+                ids.add(uuid.UUID(identifier))
+            except ValueError:
+                raise ValueError(f"{identifier} doesnt refer to any objects")
+        found = User.objects.filter(Q(email__in=emails) | Q(pk__in=ids)).values_list('pk', 'email')
+        found_emails = set()
+        for pk, email in found:
+            user_ids.add(pk)
+            found_emails.add(email)
+        missing = [email for email in emails if email not in found_emails] + [pk for pk in ids if pk not in user_ids]
+        if missing:
+            raise ValueError(f"{missing[0]} doesnt refer to any objects")
+    return user_ids
+
+def sync_group_members(group, role, user_ids, remove=True, batch_size=None):
+    """Make the given users the members or admins of a group, writing only the difference.
+    :param ShareGroup group: The group
+    :param str role: One of MEMBERSHIP_ROLES
+    :param {uuid.UUID} user_ids: Ids of the users
+    :param bool remove: Remove users which are not given, otherwise users are added only
+    :param int batch_size: Rows per insert or delete, GROUP_MEMBERSHIP_BATCH_SIZE by default
+    :return: Number of added and removed users
+    :rtype: (int, int)
+    """
+    batch_size = batch_size or getattr(settings, "GROUP_MEMBERSHIP_BATCH_SIZE", 1000)
+    field = ShareGroup._meta.get_field(MEMBERSHIP_ROLES[role])
+    through = field.remote_field.through
+    group_column = f"{field.m2m_field_name()}_id"
+    user_column = f"{field.m2m_reverse_field_name()}_id"
+    with transaction.atomic():
+        # Concurrent syncs of the same group would compute their differences from the same state otherwise
+        list(ShareGroup.objects.select_for_update().filter(pk=group.pk).values_list('pk', flat=True))
+        current = set(through.objects.filter(**{group_column: group.pk}).values_list(user_column, flat=True))
+        added = user_ids - current
+        removed = current - user_ids if remove else set()
+        through.objects.bulk_create([through(**{group_column: group.pk, user_column: user_id}) for user_id in added],
+                                    batch_size=batch_size, ignore_conflicts=True)
+        for batch in _batches(removed, batch_size):
+            through.objects.filter(**{group_column: group.pk, f"{user_column}__in": batch}).delete()
+    return len(added), len(removed)
@@ -19,6 +19,8 @@ class ShareGroup(models.Model):
     name = models.CharField(max_length=256)
     group_admins = models.ManyToManyField(User, related_name="group_admins", blank=True,)
     group_members = models.ManyToManyField(User, related_name="group_members", blank=True,)
+    # Members and admins of member groups are members of this group, at any depth
+    member_groups = models.ManyToManyField('self', symmetrical=False, related_name="parent_groups", blank=True,)
     is_public = models.BooleanField(default=False)
 
     class Meta:
@@ -26,6 +28,25 @@ class ShareGroup(models.Model):
             models.UniqueConstraint(fields=['owner', 'name'], name='group_unique_user_scope_path'),
         ]
 
+class ShareGroupClosure(models.Model):
+    """Transitive closure of member_groups: the descendant is a member group of the ancestor at any depth.
+    Groups are not stored as their own ancestor. Only reachability is stored, rows are recomputed when an edge is removed.
+    """
+    ancestor = models.ForeignKey(ShareGroup, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(ShareGroup, on_delete=models.CASCADE, related_name="ancestor_links")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='group_closure_unique_ancestor_descendant'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'ancestor'], name='group_closure_descendant'),
+        ]
+
+class ShareGroupClosureLock(models.Model):
+    """Single row locked by every change of the closure, so cycle checks and closure updates are serialized"""
+    pass
+
 
 class ShareableModel(models.Model):
 
@@ -44,8 +65,29 @@ class ShareableModel(models.Model):
     shared_groups = models.ManyToManyField(ShareGroup)
 
 
+class DatasourceFile(models.Model):
+    """Uploaded datasource content, stored once per content hash and shared by all datasources with this content"""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    creation_time = models.DateTimeField(auto_now_add=True)
+
 class Datasource(ShareableModel):
+
+    # Datasources from URLs may be verified in the background
+    STATUS_READY = 0
+    STATUS_PENDING = 1
+    STATUS_UNREACHABLE = 2
+
     source = models.URLField()
+    status = models.IntegerField(default=STATUS_READY)
+    # Set for uploaded datasources, the file is removed with the last datasource referencing it
+    stored_file = models.ForeignKey(DatasourceFile, on_delete=models.PROTECT, related_name="datasources", blank=True, null=True)
+    # Rows appended to uploaded content are kept in an append log, see append_log. Only the committed
+    # lengths of its files are valid, an interrupted append might have left further bytes behind
+    append_log = models.CharField(max_length=1024, blank=True, default="")
+    log_rows = models.BigIntegerField(default=0)
+    log_lengths = models.JSONField(default=dict)
     creation_time = models.DateTimeField(auto_now_add=True)
     modification_time = models.DateTimeField(auto_now=True)
     datasource_name = models.CharField(max_length=256)
@@ -55,6 +97,31 @@ class Datasource(ShareableModel):
             models.UniqueConstraint(fields=['owner', 'datasource_name'],name='datasource_unique_user_datasource_name'),
         ]
 
+class UploadSession(models.Model):
+    """Resumable upload of a datasource file, assembled on disk from numbered chunks"""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="upload_sessions")
+    datasource_name = models.CharField(max_length=256)
+    visibility = models.IntegerField(default=ShareableModel.VISIBILITY_PRIVATE)
+    total_size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    creation_time = models.DateTimeField(auto_now_add=True)
+    modification_time = models.DateTimeField(auto_now=True)
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name="chunks")
+    index = models.IntegerField()
+    sha256 = models.CharField(max_length=64)
+    # Parts of UTF-8 sequences crossing the chunk borders, validated on finalization
+    head = models.BinaryField(max_length=3, default=b"")
+    tail = models.BinaryField(max_length=3, default=b"")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'index'], name='upload_chunk_unique_session_index'),
+        ]
+
 class Chart(ShareableModel):
 
     chart_type = models.CharField(max_length=256)
@@ -63,6 +130,9 @@ class Chart(ShareableModel):
     modification_time = models.DateTimeField(auto_now=True)
     original_datasource = models.ForeignKey(Datasource, on_delete=models.SET_NULL, blank=True, null=True)
     downloadable = models.BooleanField(default=False)
+    # Set on rendering, so serving the code does not need to touch the chart files
+    pive_version = models.CharField(max_length=64, blank=True, default="")
+    js_name = models.CharField(max_length=256, blank=True, default="")
 
     class Meta:
         constraints = [
@@ -75,9 +145,34 @@ class Dashboard(ShareableModel):
     name = models.CharField(max_length=256)
     creation_time = models.DateTimeField(auto_now_add=True)
     modification_time = models.DateTimeField(auto_now=True)
-    config = models.CharField(max_length=1024*16) #TODO: Adequate limit?
+    config = models.JSONField(default=dict)
+    # Incremented on every update, used for optimistic concurrency
+    version = models.IntegerField(default=0)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['owner', 'name'], name='dashboard_unique_user_scope_path'),
-        ]
\ No newline at end of file
+        ]
+
+class DashboardChartReference(models.Model):
+    """Chart embedded in a dashboard config, rebuilt whenever the dashboard is saved.
+    Charts are referenced by id only, so references to deleted charts remain until the dashboard changes.
+    """
+    dashboard = models.ForeignKey(Dashboard, on_delete=models.CASCADE, related_name="chart_references")
+    chart_id = models.IntegerField(db_index=True)
+    # Order of appearance in the config
+    position = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dashboard', 'chart_id'], name='dashboard_chart_reference_unique_dashboard_chart'),
+        ]
+
+class DashboardSnapshot(models.Model):
+    """Pre-rendered document of a public or semi-public dashboard, rebuilt once the dashboard or its charts changed"""
+    dashboard = models.OneToOneField(Dashboard, on_delete=models.CASCADE, primary_key=True, related_name="snapshot")
+    # Fingerprint of the dashboard and chart state the document was built from
+    fingerprint = models.CharField(max_length=64)
+    # Serialized JSON, served as is
+    document = models.TextField()
+    creation_time = models.DateTimeField(auto_now=True)
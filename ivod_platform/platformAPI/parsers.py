@@ -0,0 +1,6 @@
+from rest_framework.parsers import JSONParser
+from .json_patch import JSON_PATCH_CONTENT_TYPE
+
+class JSONPatchParser(JSONParser):
+    """Parser for JSON patch documents (RFC 6902), which are parsed as plain JSON"""
+    media_type = JSON_PATCH_CONTENT_TYPE
@@ -1,6 +1,22 @@
 from rest_framework import permissions
 from .models import Chart, Datasource, ShareGroup, Dashboard, ShareableModel
 from django.contrib.auth.models import AnonymousUser
+from django.db.models import Q
+from .groups import get_effective_groups
+
+def filter_viewable(queryset, request):
+    """Restrict a queryset of shareable objects to those viewable by the requesting user in one query.
+    Equivalent to checking IsOwner | IsShared & IsSharedWithUser | IsSemiPublic on every object.
+    :param QuerySet queryset: Queryset of a ShareableModel
+    :param HttpRequest request: The request
+    :rtype: QuerySet
+    """
+    condition = Q(visibility__gte=ShareableModel.VISIBILITY_SEMI_PUBLIC)
+    user = request.user
+    if user and type(user) != AnonymousUser:
+        condition |= Q(owner=user)
+        condition |= Q(visibility__gte=ShareableModel.VISIBILITY_SHARED) & (Q(shared_users=user) | Q(shared_groups__in=get_effective_groups(user)))
+    return queryset.filter(condition).distinct()
 
 class IsOwner(permissions.BasePermission):
 
@@ -31,13 +47,10 @@ class IsSharedWithUser(permissions.BasePermission):
         #Check if user is in request
         if not user or type(user) == AnonymousUser:
             return False
-        shared_users = obj.shared_users.all()
-        shared_groups = obj.shared_groups.all()
-        group_admin_positions_of_user = user.group_admins.all()
-        group_memberships_of_user = user.group_members.all()
-        union_membership = (group_admin_positions_of_user | group_memberships_of_user)
-        intersection_between_groups = shared_groups & union_membership
-        return user in shared_users or intersection_between_groups
+        # Groups of the user at any depth come from the closure table, so this is one query regardless of nesting
+        return type(obj).objects.filter(pk=obj.pk).filter(
+            Q(shared_users=user) | Q(shared_groups__in=get_effective_groups(user))
+        ).exists()
 
 class IsSemiPublic(permissions.BasePermission):
 
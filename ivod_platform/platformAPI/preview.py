@@ -0,0 +1,162 @@
+"""Preview of the first rows of a datasource.
+
+Only the head of the content is read: from the canonical form if the datasource has one, otherwise by
+parsing the CSV or JSON file incrementally until enough rows are found. Remote content is streamed and
+the connection is closed as soon as the rows are complete.
+"""
+import csv
+import io
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+
+from .append_log import load_datasource_canonical, AppendedCanonicalData
+from .canonical import parse_csv_value, open_csv_reader, JSONStreamReader
+from .compression import open_datasource_file
+from .remote import get_session, get_timeout
+
+# Bytes inspected to tell JSON from CSV
+PREVIEW_READ_SIZE = 16 * 1024
+
+def is_remote_source(source):
+    """Check if the source of a datasource is a URL rather than a local file."""
+    return str(source).startswith(('http://', 'https://'))
+
+def read_csv_head(text, rows):
+    """Parse the first rows of a CSV text stream with header.
+    :param text: Text stream positioned at the start of the content
+    :param int rows: Number of rows to read
+    :raises csv.Error: If the content is not CSV
+    :rtype: [dict]
+    """
+    reader = open_csv_reader(text)
+    header = reader.fieldnames
+    if header is None:
+        return []
+    return [{key: parse_csv_value(row[key]) for key in header} for row in islice(reader, rows)]
+
+
+def read_json_head(text, rows):
+    """Read the first rows of JSON content. Supported are arrays of rows and objects with the rows in "data",
+    as the metadata format of pive uses them.
+    :param text: Text stream positioned at the start of the content
+    :param int rows: Number of rows to read
+    :raises ValueError: If the content is no JSON in a supported format
+    :rtype: list
+    """
+    reader = JSONStreamReader(text)
+    if reader.peek() == '{':
+        reader.expect('{')
+        while True:
+            if reader.peek() == '}':
+                raise ValueError("JSON object without data")
+            key = reader.value()
+            reader.expect(':')
+            if key == 'data' and reader.peek() == '[':
+                break
+            reader.value()
+            if reader.peek() == ',':
+                reader.expect(',')
+    reader.expect('[')
+    result = []
+    while len(result) < rows and reader.peek() != ']':
+        result.append(reader.value())
+        if reader.peek() == ',':
+            reader.expect(',')
+    return result
+
+def read_head(stream, rows):
+    """Read the first rows of CSV or JSON content from a binary stream.
+    :param stream: Binary stream of the content
+    :param int rows: Number of rows to read
+    :return: Name of the format and the typed rows
+    :rtype: (str, list)
+    :raises ValueError: If the content is neither CSV nor JSON
+    """
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    start = stream.peek(PREVIEW_READ_SIZE).lstrip()[:1]
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if start in (b'[', b'{'):
+        return 'json', read_json_head(text, rows)
+    try:
+        return 'csv', read_csv_head(text, rows)
+    except csv.Error as e:
+        raise ValueError(f"Content is neither CSV nor JSON: {e}")
+
+def read_canonical_head(canonical, rows):
+    """Read the first rows from the memory mapped columns of a canonical form.
+    :param CanonicalData canonical: The canonical form
+    :param int rows: Number of rows to read
+    :rtype: [dict]
+    """
+    columns = {}
+    for name in canonical.columns:
+        values = canonical.column(name)[:rows]
+        columns[name] = values.tolist() if hasattr(values, 'tolist') else list(values)
+    return [{name: values[index] for name, values in columns.items()} for index in range(min(rows, canonical.rows))]
+
+
+_preview_cache = OrderedDict()
+_preview_cache_lock = threading.Lock()
+
+def _cache_key(datasource, rows):
+    """Key of a preview, which changes with the datasource. Uploaded content never changes, so its hash and
+    the state of the append log are enough."""
+    if datasource.stored_file_id is not None:
+        return ('content', Path(datasource.source).name, datasource.append_log, datasource.log_rows, rows)
+    return ('datasource', datasource.id, datasource.modification_time, datasource.source, rows)
+
+def get_preview(datasource, rows):
+    """Get the first rows of a datasource. Previews are cached until the datasource changes,
+    those of remote datasources at most for PREVIEW_REMOTE_CACHE_SECONDS.
+    :param Datasource datasource: The datasource
+    :param int rows: Number of rows
+    :return: Dictionary with the format and the rows
+    :rtype: dict
+    :raises ValueError: If the content is neither CSV nor JSON
+    :raises OSError: If the content could not be read
+    :raises requests.RequestException: If remote content could not be loaded
+    """
+    key = _cache_key(datasource, rows)
+    now = time.monotonic()
+    with _preview_cache_lock:
+        entry = _preview_cache.get(key)
+        if entry is not None and (entry[0] is None or entry[0] > now):
+            _preview_cache.move_to_end(key)
+            return entry[1]
+
+    expires = None
+    canonical = load_datasource_canonical(datasource)
+    # The head of content with appended rows is usually found in the content alone
+    if isinstance(canonical, AppendedCanonicalData) and canonical.canonical.rows >= rows:
+        canonical = canonical.canonical
+    if canonical is not None:
+        preview = {'format': canonical.schema['format'], 'rows': read_canonical_head(canonical, rows)}
+    elif is_remote_source(datasource.source):
+        with get_session().get(datasource.source, stream=True, timeout=get_timeout()) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            source_format, head = read_head(response.raw, rows)
+        preview = {'format': source_format, 'rows': head}
+        expires = now + getattr(settings, "PREVIEW_REMOTE_CACHE_SECONDS", 60)
+    else:
+        with open_datasource_file(datasource.source) as file:
+            source_format, head = read_head(file, rows)
+        preview = {'format': source_format, 'rows': head}
+
+    with _preview_cache_lock:
+        _preview_cache[key] = (expires, preview)
+        _preview_cache.move_to_end(key)
+        while len(_preview_cache) > getattr(settings, "PREVIEW_CACHE_ENTRIES", 256):
+            _preview_cache.popitem(last=False)
+    return preview
+
+def clear_preview_cache():
+    """Forget all cached previews."""
+    with _preview_cache_lock:
+        _preview_cache.clear()
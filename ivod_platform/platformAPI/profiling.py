@@ -0,0 +1,346 @@
+"""Schema and statistics of datasources, computed from their canonical form."""
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+import pive
+
+from .append_log import ChainedColumn, load_datasource_canonical
+from .canonical import load_canonical
+
+PROFILE_FILE = 'profile.json'
+# Column kinds, approximating how pive classifies columns
+KIND_NUMBER = 'number'
+KIND_STRING = 'string'
+KIND_TIME = 'time'
+# Padded bytes of string values processed at once
+STRING_BATCH_BYTES = 4 * 1024 * 1024
+STRING_BATCH_VALUES = 64 * 1024
+# ASCII bytes which can not be part of a number as float() reads it, other bytes may be digits of other scripts
+_NON_NUMBER_BYTES = np.zeros(256, dtype=bool)
+_NON_NUMBER_BYTES[:0x80] = True
+_NON_NUMBER_BYTES[np.frombuffer(b"\x000123456789+-._eEinfatyINFATY \t\n\r\x0b\x0c", dtype=np.uint8)] = False
+_HASH_PRIME = np.uint64(1099511628211)
+
+def _is_number(value):
+    """Check if pive treats a value as number"""
+    try:
+        float(value)
+    except (ValueError, TypeError):
+        return False
+    return True
+
+def _plain(value):
+    """Convert numpy scalars for JSON"""
+    return value.item() if isinstance(value, np.generic) else value
+
+def _iter_string_batches(values):
+    """Iterate over a string column in batches of values, as matrices of their bytes padded with zeros.
+    :param values: StringColumn, or ChainedColumn of them
+    :return: iterator of lengths of the values and matrix with a row per value
+    :rtype: iterator of (numpy.ndarray, numpy.ndarray)
+    """
+    parts = values.parts if isinstance(values, ChainedColumn) else [values]
+    for part in parts:
+        offsets = np.asarray(part.offsets)
+        lengths = np.diff(offsets)
+        pending = [(start, min(start + STRING_BATCH_VALUES, len(lengths))) for start in range(0, len(lengths), STRING_BATCH_VALUES)]
+        while pending:
+            start, stop = pending.pop(0)
+            batch_lengths = lengths[start:stop]
+            width = max(int(batch_lengths.max()), 1)
+            if (stop - start) * width > STRING_BATCH_BYTES and stop - start > 1:
+                # A few long values make the whole batch wide, split it
+                middle = (start + stop) // 2
+                pending[:0] = [(start, middle), (middle, stop)]
+                continue
+            rows = np.repeat(np.arange(stop - start), batch_lengths)
+            columns = np.arange(len(rows)) - np.repeat(offsets[start:stop] - offsets[start], batch_lengths)
+            matrix = np.zeros((stop - start, width), dtype=np.uint8)
+            matrix[rows, columns] = part.data[offsets[start]:offsets[stop]]
+            yield batch_lengths, matrix
+
+def _hash_rows(lengths, matrix):
+    """Hash the values of a padded byte matrix, with their lengths to tell apart trailing zero bytes"""
+    powers = np.cumprod(np.full(matrix.shape[1], _HASH_PRIME, dtype=np.uint64))
+    return (matrix.astype(np.uint64) * powers).sum(axis=1, dtype=np.uint64) * _HASH_PRIME + lengths.astype(np.uint64)
+
+def _parse_numbers(matrix):
+    """Parse the rows of a padded byte matrix as numbers.
+    :return: Mask of the rows which are numbers and their values
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    strings = np.ascontiguousarray(matrix).view(f"S{matrix.shape[1]}").ravel()
+    try:
+        return np.ones(len(strings), dtype=bool), strings.astype(np.float64)
+    except ValueError:
+        pass
+    # Some rows are no numbers, or numbers in other scripts, parse one by one
+    values = [value.decode('utf-8') for value in strings]
+    mask = np.array([_is_number(value) for value in values], dtype=bool)
+    return mask, np.array([float(value) for value, number in zip(values, mask) if number], dtype=np.float64)
+
+def _profile_strings(values):
+    """Compute nulls, numbers and cardinality of a string column on its bytes.
+    :param values: StringColumn, or ChainedColumn of them
+    :return: Number of empty values, whether any and all values are numbers, the numbers if all are and the cardinality
+    :rtype: (int, bool, bool, numpy.ndarray, int)
+    """
+    nulls = 0
+    any_numeric = False
+    all_numeric = True
+    numbers = []
+    hashes = []
+    for lengths, matrix in _iter_string_batches(values):
+        nulls += int(np.count_nonzero(lengths == 0))
+        hashes.append(_hash_rows(lengths, matrix))
+        candidates = ~(_NON_NUMBER_BYTES[matrix].any(axis=1) | (lengths == 0))
+        if not candidates.all():
+            all_numeric = False
+        # Rows with bytes beyond ASCII are parsed apart, so the others stay vectorized
+        non_ascii = (matrix >= 0x80).any(axis=1)
+        for rows in (candidates & ~non_ascii, candidates & non_ascii):
+            if rows.any():
+                mask, parsed = _parse_numbers(matrix[rows])
+                any_numeric = any_numeric or bool(mask.any())
+                all_numeric = all_numeric and bool(mask.all())
+                if all_numeric:
+                    numbers.append(parsed)
+    cardinality = int(np.unique(np.concatenate(hashes)).size) if hashes else 0
+    numbers = (np.concatenate(numbers) if numbers else np.zeros(0)) if all_numeric else None
+    return nulls, any_numeric, all_numeric, numbers, cardinality
+
+def profile_column(name, dtype, values):
+    """Compute kind and statistics of a column. String columns are processed vectorized on their bytes.
+    'numeric' tells if all values are numbers, which unlike the kind is no guess.
+    :param str name: Name of the column
+    :param str dtype: Storage type of the column in the canonical form
+    :param values: numpy array for numeric columns, StringColumn or ChainedColumn for strings, list of values otherwise
+    :rtype: dict
+    """
+    profile = {'name': name, 'dtype': dtype}
+    cardinality = None
+    if dtype in ('int64', 'float64'):
+        numbers = values
+        nulls = int(np.isnan(values).sum()) if dtype == 'float64' else 0
+        kind = KIND_NUMBER
+    elif dtype == 'string':
+        nulls, any_numeric, all_numeric, numbers, cardinality = _profile_strings(values)
+        if all_numeric:
+            kind = KIND_NUMBER
+        elif not any_numeric:
+            kind = KIND_STRING
+        else:
+            # Inconsistent columns are rejected by pive
+            kind = None
+    else:
+        values = values[:] if not isinstance(values, list) else values
+        nulls = sum(1 for value in values if value is None or value == "")
+        try:
+            if any(value is None for value in values):
+                raise TypeError("None is no number")
+            numbers = np.array(values, dtype=np.float64)
+            kind = KIND_NUMBER
+        except (ValueError, TypeError):
+            numeric = [_is_number(value) for value in values]
+            if not any(numeric) and all(isinstance(value, str) for value in values):
+                kind, numbers = KIND_STRING, None
+            else:
+                # Inconsistent columns are rejected by pive
+                kind, numbers = None, None
+    profile['numeric'] = numbers is not None
+    # Columns named like dates are taken as time, a guess at pive's detection
+    if str(name).endswith("date") or str(name).endswith("time"):
+        kind = KIND_TIME
+    profile['kind'] = kind
+    profile['nulls'] = nulls
+    if numbers is not None and len(numbers) > 0 and not np.isnan(numbers).all():
+        profile['min'] = _plain(np.nanmin(numbers))
+        profile['max'] = _plain(np.nanmax(numbers))
+        profile['cardinality'] = int(np.unique(numbers).size)
+    else:
+        profile['min'] = profile['max'] = None
+        profile['cardinality'] = cardinality if cardinality is not None else len(set(values))
+    return profile
+
+def _is_ordered(values):
+    """Check if values are strictly ascending or descending, as pive requires for some chart types"""
+    if len(values) < 2:
+        return False
+    if isinstance(values, np.ndarray):
+        differences = np.diff(values)
+        return bool((differences > 0).all() or (differences < 0).all())
+    values = values[:]
+    try:
+        return all(a < b for a, b in zip(values, values[1:])) or all(a > b for a, b in zip(values, values[1:]))
+    except TypeError:
+        return False
+
+def compute_profile(canonical):
+    """Profile a datasource from its canonical form. Numeric columns are processed vectorized on the mapped files.
+    :param CanonicalData canonical: The canonical form
+    :rtype: dict
+    """
+    columns = [profile_column(column['name'], column['dtype'], canonical.column(column['name'])) for column in canonical.schema['columns']]
+    # pive only checks the order of number or time abscissas
+    ordered = bool(columns) and columns[0]['kind'] in (KIND_NUMBER, KIND_TIME) and _is_ordered(canonical.column(columns[0]['name']))
+    return {
+        'rows': canonical.rows,
+        'columns': columns,
+        'consistent': all(column['kind'] is not None for column in columns),
+        'ordered': ordered,
+    }
+
+def get_profile(content_path):
+    """Get the profile of stored datasource content, computing it if it is not stored yet.
+    :param Path content_path: The stored content
+    :return: The profile, or None if the content has no canonical form
+    :rtype: dict
+    """
+    canonical = load_canonical(content_path)
+    if canonical is None:
+        return None
+    return get_canonical_profile(canonical)
+
+def get_canonical_profile(canonical):
+    """Get the profile of a canonical form, computing it if it is not stored with the form yet.
+    A stored profile with another number of rows belongs to an earlier state of an append log and is replaced.
+    :param CanonicalData canonical: The canonical form
+    :rtype: dict
+    """
+    profile_path = canonical.path.joinpath(PROFILE_FILE)
+    try:
+        with profile_path.open('r') as file:
+            profile = json.load(file)
+        if profile['rows'] == canonical.rows:
+            return profile
+    except FileNotFoundError:
+        pass
+    profile = compute_profile(canonical)
+    temp_path = profile_path.with_name(f".{PROFILE_FILE}.{uuid4().hex}.tmp")
+    try:
+        with temp_path.open('w') as file:
+            json.dump(profile, file)
+        os.replace(temp_path, profile_path)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        temp_path.unlink(missing_ok=True)
+    return profile
+
+def get_datasource_profile(datasource):
+    """Get the profile of a datasource. Only uploaded datasources with a canonical form are profiled.
+    Rows appended to the datasource are profiled together with its content.
+    :param Datasource datasource: The datasource
+    :return: The profile or None
+    :rtype: dict
+    """
+    canonical = load_datasource_canonical(datasource)
+    if canonical is None:
+        return None
+    return get_canonical_profile(canonical)
+
+
+_chart_requirements = None
+_chart_requirements_lock = threading.Lock()
+
+def get_chart_requirements():
+    """Read the data requirements of the chart types from the pive configuration.
+    Chart types without configuration are missing and can not be checked upfront.
+    :return: Dictionary of chart type to its requirements
+    :rtype: dict
+    """
+    global _chart_requirements
+    if _chart_requirements is None:
+        with _chart_requirements_lock:
+            requirements = {}
+            config_path = Path(pive.__file__).parent.joinpath('visualization').joinpath('config')
+            for config_file in config_path.glob('*.json'):
+                try:
+                    with config_file.open('r') as file:
+                        config = json.load(file)
+                    requirements[config['title']] = config
+                except (OSError, ValueError, KeyError) as e:
+                    print(e, file=sys.stderr)
+            _chart_requirements = requirements
+    return _chart_requirements
+
+def is_chart_type_possible(profile, chart_type):
+    """Check a chart type against the profile of a datasource, with rules approximating how pive maps data to chart types.
+    The result is a hint only, pive decides which chart types it renders, see get_chart_types_for_datasource.
+    Only mismatches by these rules count, anything not covered is taken as possible.
+    :param dict profile: The profile of the datasource
+    :param str chart_type: The chart type
+    :rtype: bool
+    """
+    requirements = get_chart_requirements().get(chart_type)
+    if requirements is None or not profile['consistent']:
+        return True
+    try:
+        rows = profile['rows']
+        if rows < requirements.get('min_datapoints', 0):
+            return False
+        if requirements.get('max_datapoints', 'inf') != 'inf' and rows > requirements['max_datapoints']:
+            return False
+        kinds = [column['kind'] for column in profile['columns']]
+        if KIND_TIME in kinds and not requirements.get('datesupport', True):
+            return False
+        if requirements.get('lexical_required', False) and not profile['ordered']:
+            return False
+        required = [list(vistype.values())[0] for vistype in requirements['vistypes']]
+        required = [allowed if isinstance(allowed, list) else [allowed] for allowed in required]
+        if len(kinds) < len(required):
+            return False
+        if any(kind not in allowed for kind, allowed in zip(kinds, required)):
+            return False
+        if len(kinds) > len(required):
+            # Further columns repeat the last required one
+            if not requirements.get('multiple_data', False):
+                return False
+            if len(required) > 1 and (len(kinds) - 1) % (len(required) - 1) != 0:
+                return False
+            if len(set(kinds[len(required) - 1:])) > 1:
+                return False
+    except (KeyError, TypeError, AttributeError, IndexError):
+        return True
+    return True
+
+def is_chart_type_impossible(profile, chart_type):
+    """Check if the profile of a datasource proves that a chart type can not fit its data. Unlike is_chart_type_possible
+    no rules are approximated: a chart type is impossible if it requires more number columns than the datasource has
+    columns with numbers only, as pive maps columns to the required ones by position.
+    :param dict profile: The profile of the datasource
+    :param str chart_type: The chart type
+    :rtype: bool
+    """
+    requirements = get_chart_requirements().get(chart_type)
+    if requirements is None:
+        return False
+    try:
+        required = [list(vistype.values())[0] for vistype in requirements['vistypes']]
+        number_columns = sum(1 for allowed in required if allowed == KIND_NUMBER or allowed == [KIND_NUMBER])
+        # Profiles stored before 'numeric' was added prove nothing
+        if any('numeric' not in column for column in profile['columns']):
+            return False
+        return sum(1 for column in profile['columns'] if column['numeric']) < number_columns
+    except (KeyError, TypeError, AttributeError, IndexError):
+        return False
+
+def get_impossible_chart_types(profile):
+    """Get the chart types the profile of a datasource proves impossible, see is_chart_type_impossible.
+    :param dict profile: The profile of the datasource
+    :rtype: [str]
+    """
+    return sorted(chart_type for chart_type in get_chart_requirements() if is_chart_type_impossible(profile, chart_type))
+
+def get_unlikely_chart_types(profile):
+    """Get the chart types which, judging by the profile of a datasource, will probably not fit its data. A hint only,
+    chart types proven impossible are listed by get_impossible_chart_types instead.
+    :param dict profile: The profile of the datasource
+    :rtype: [str]
+    """
+    return sorted(chart_type for chart_type in get_chart_requirements()
+                  if not is_chart_type_possible(profile, chart_type) and not is_chart_type_impossible(profile, chart_type))
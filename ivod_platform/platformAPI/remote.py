@@ -0,0 +1,106 @@
+"""Access to remote datasources over a shared, connection pooled HTTP session."""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.db import connection
+
+from .models import Datasource
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Get the process wide HTTP session. Connections to the same host are pooled and reused.
+    :rtype: requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                pool_size = getattr(settings, "REMOTE_POOL_SIZE", 10)
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+def get_timeout():
+    """Get connect and read timeout in seconds for remote requests.
+    :rtype: (float, float)
+    """
+    return getattr(settings, "REMOTE_TIMEOUT", (3.05, 10))
+
+
+_check_cache = OrderedDict()
+_check_cache_lock = threading.Lock()
+
+def check_url(url):
+    """Check if a URL is reachable. Results are cached per URL for REMOTE_CHECK_CACHE_SECONDS.
+    :param str url: The URL
+    :return: True, if the URL answered without error status
+    :rtype: bool
+    """
+    now = time.monotonic()
+    with _check_cache_lock:
+        entry = _check_cache.get(url)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+    try:
+        response = get_session().head(url, allow_redirects=True, timeout=get_timeout())
+        reachable = response.status_code < 400
+    except requests.RequestException:
+        reachable = False
+    with _check_cache_lock:
+        _check_cache[url] = (now + getattr(settings, "REMOTE_CHECK_CACHE_SECONDS", 60), reachable)
+        _check_cache.move_to_end(url)
+        while len(_check_cache) > getattr(settings, "REMOTE_CHECK_CACHE_ENTRIES", 1024):
+            _check_cache.popitem(last=False)
+    return reachable
+
+def clear_check_cache():
+    """Forget all cached URL checks."""
+    with _check_cache_lock:
+        _check_cache.clear()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """Get the thread pool running background checks.
+    :rtype: ThreadPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, "REMOTE_CHECK_WORKERS", 4), thread_name_prefix="remote-check")
+    return _executor
+
+def verify_datasource(datasource_id, url):
+    """Check the URL of a pending datasource and mark it ready or unreachable.
+    :param int datasource_id: Database id of the datasource
+    :param str url: URL of the datasource
+    """
+    try:
+        status = Datasource.STATUS_READY if check_url(url) else Datasource.STATUS_UNREACHABLE
+        Datasource.objects.filter(pk=datasource_id, status=Datasource.STATUS_PENDING).update(status=status)
+    except Exception as e:
+        print(e, file=sys.stderr)
+    finally:
+        # Threads of the pool are not managed by Django, their connections have to be closed explicitly
+        connection.close()
+
+def verify_datasource_async(datasource_id, url):
+    """Check the URL of a pending datasource in the background.
+    :param int datasource_id: Database id of the datasource
+    :param str url: URL of the datasource
+    """
+    get_executor().submit(verify_datasource, datasource_id, url)
@@ -0,0 +1,15 @@
+from rest_framework.renderers import BaseRenderer
+from .chart_data import COLUMNAR_CONTENT_TYPE
+
+class ColumnarRenderer(BaseRenderer):
+    """Renderer for the columnar chart data format. Views hand over already encoded content."""
+    media_type = COLUMNAR_CONTENT_TYPE
+    format = 'columnar'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, bytes):
+            return data
+        # Error messages
+        return str(data).encode('utf-8')
@@ -1,20 +1,21 @@
-import json
-
-import requests
 from rest_framework import serializers
-from .models import Chart, Datasource, ShareGroup, User, Dashboard, ShareableModel
-from base64 import b64decode
-from uuid import uuid4
+from django.db import transaction
+from .models import Chart, Datasource, ShareGroup, User, Dashboard, ShareableModel, UploadSession
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 
-from .util import get_chart_types_for_datasource, generate_chart, get_chart_base_path, modify_chart, get_datasource_base_path
+from .uploads import DatasourceWriter, write_base64, create_uploaded_datasource, get_chunk_count, get_missing_chunks, UPLOAD_SESSION_MIN_CHUNK_SIZE
+from .remote import check_url, verify_datasource_async
+from .profiling import get_datasource_profile, is_chart_type_impossible
+from .util import get_chart_types_for_datasource, generate_chart, modify_chart, remove_chart_files
+from .dashboard_config import validate_config
 
 class ChartSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Chart
         fields = '__all__'
-        read_only_fields = ['chart_type', 'id', 'owner', 'original_datasource', 'creation_time', 'modification_time']
+        read_only_fields = ['chart_type', 'id', 'owner', 'original_datasource', 'creation_time', 'modification_time', 'pive_version', 'js_name']
         extra_kwargs = {
             'config': {'required': False},
             'downloadable': {'required': False},
@@ -44,6 +45,12 @@ class ChartSerializer(serializers.ModelSerializer):
         if self.context['request'].user == None or type(self.context['request'].user) == AnonymousUser:
             raise serializers.ValidationError("Only users may create Charts")
 
+        if data["datasource"].status != Datasource.STATUS_READY:
+            raise serializers.ValidationError("Datasource is not available")
+        # Chart types the profile rules out are rejected without invoking pive
+        profile = get_datasource_profile(data["datasource"])
+        if profile is not None and is_chart_type_impossible(profile, data["chart_type"]):
+            raise serializers.ValidationError("Chart type not supported for this datasource, it has not enough number columns")
         supported = get_chart_types_for_datasource(data["datasource"])
         if data["chart_type"] not in supported:
             raise serializers.ValidationError(f"Chart type not supported for this datasource. Supported types are: {supported}")
@@ -61,13 +68,11 @@ class ChartSerializer(serializers.ModelSerializer):
             visibility=validated_data.get('visibility', ShareableModel.VISIBILITY_PRIVATE)
         )
         try:
-            generate_chart(datasource=validated_data["datasource"], chart_id=chart.id, chart_type=validated_data["chart_type"], request=self.context['request'], config=validated_data["config"])
+            chart.pive_version, chart.js_name = generate_chart(datasource=validated_data["datasource"], chart_id=chart.id, chart_type=validated_data["chart_type"], request=self.context['request'], config=validated_data["config"])
+            chart.save(update_fields=['pive_version', 'js_name'])
         except Exception as e:
-            # Try to erase file system artifacts
-            try:
-                get_chart_base_path().joinpath(str(chart.id)).rmdir()
-            except:
-                pass
+            # Erase file system artifacts, a failed render might have left files behind
+            remove_chart_files(chart.id)
             # Remove stale db entry and reraise exception
             chart.delete()
             raise e
@@ -80,7 +85,7 @@ class ChartSerializer(serializers.ModelSerializer):
 
         # TODO: Could there be a case where modification fails halfway through?
         # Especially file access is not atomic, keep a backup and restore from that?
-        modify_chart(chart_id=instance.id, request=self.context['request'], config=validated_data.get('config',None))
+        instance.pive_version, instance.js_name = modify_chart(chart_id=instance.id, request=self.context['request'], config=validated_data.get('config',None))
 
         instance.save()
         return instance
@@ -90,8 +95,9 @@ class DatasourceSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Datasource
-        fields = '__all__'
-        read_only_fields = ['creation_time', 'modification_time']
+        # Shared content and append logs are implementation details and not exposed
+        exclude = ['stored_file', 'append_log', 'log_rows', 'log_lengths']
+        read_only_fields = ['creation_time', 'modification_time', 'status']
         extra_kwargs = {
             'source': {'required': False, 'write_only': True},
             'owner': {'required': False, 'read_only': True},
@@ -108,6 +114,11 @@ class DatasourceSerializer(serializers.ModelSerializer):
             unvalidated_data.pop('source')
         return unvalidated_data
 
+    @staticmethod
+    def verify_async(data):
+        """Check if a url should be accepted right away and verified in the background"""
+        return str(data.get('verify_async', getattr(settings, "DATASOURCE_VERIFY_ASYNC", False))).lower() in ('true', '1')
+
     def validate_create(self, data):
         """Validation step required on creation only."""
 
@@ -117,9 +128,10 @@ class DatasourceSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Neither data nor url specified")
         if 'url' in data and 'data' in data:
             raise serializers.ValidationError("data and url must not be used together")
-        if 'url' in data:
+        if 'url' in data and not self.verify_async(data):
             # Test if url is reachable
-            _ = requests.head(data['url'], allow_redirects=True)
+            if not check_url(data['url']):
+                raise serializers.ValidationError("url is not reachable")
         if self.context['request'].user is None or type(self.context['request'].user) == AnonymousUser:
             raise serializers.ValidationError("Only users may create Charts")
         return data
@@ -128,19 +140,20 @@ class DatasourceSerializer(serializers.ModelSerializer):
         validated_data = self.validate_create(validated_data)
         user = self.context['request'].user
         if 'url' in validated_data:
-            datasource = Datasource.objects.create(source=validated_data['url'], datasource_name=validated_data['datasource_name'], owner=user, visibility=validated_data.get('visibility', ShareableModel.VISIBILITY_PRIVATE))
+            verify_async = self.verify_async(validated_data)
+            datasource = Datasource.objects.create(source=validated_data['url'], datasource_name=validated_data['datasource_name'], owner=user, visibility=validated_data.get('visibility', ShareableModel.VISIBILITY_PRIVATE),
+                                                   status=Datasource.STATUS_PENDING if verify_async else Datasource.STATUS_READY)
+            if verify_async:
+                transaction.on_commit(lambda: verify_datasource_async(datasource.id, datasource.source))
         else:
-            data = b64decode(validated_data['data'])
-            file_path = get_datasource_base_path().joinpath(uuid4().hex)
-            with file_path.open("w") as file:
-                file.write(data.decode('utf-8'))
+            writer = DatasourceWriter()
             try:
-                datasource = Datasource.objects.create(source=file_path, datasource_name=validated_data['datasource_name'], owner=user, visibility=validated_data.get('visibility', ShareableModel.VISIBILITY_PRIVATE))
-            except Exception as e:
-                #Clean up files
-                file_path.unlink(missing_ok=True)
-                #and reraise exception
-                raise e
+                write_base64(writer, validated_data['data'])
+                datasource = create_uploaded_datasource(writer, user, validated_data['datasource_name'], validated_data.get('visibility', ShareableModel.VISIBILITY_PRIVATE))
+            except ValueError as e:
+                raise serializers.ValidationError(str(e))
+            finally:
+                writer.abort()
         return datasource
 
     def update(self, instance, validated_data):
@@ -149,6 +162,48 @@ class DatasourceSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    chunk_count = serializers.SerializerMethodField()
+    missing_chunks = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'datasource_name', 'visibility', 'total_size', 'chunk_size', 'chunk_count', 'missing_chunks', 'creation_time', 'modification_time']
+        read_only_fields = ['id', 'creation_time', 'modification_time']
+        extra_kwargs = {
+            'visibility': {'required': False},
+            'chunk_size': {'required': False},
+        }
+
+    def get_chunk_count(self, obj):
+        return get_chunk_count(obj)
+
+    def get_missing_chunks(self, obj):
+        return get_missing_chunks(obj)
+
+    def validate_total_size(self, value):
+        max_size = getattr(settings, "DATASOURCE_MAX_UPLOAD_SIZE", 1024 ** 3)
+        if not 0 < value <= max_size:
+            raise serializers.ValidationError(f"total_size must be between 1 and {max_size}")
+        return value
+
+    def validate_chunk_size(self, value):
+        max_size = getattr(settings, "UPLOAD_SESSION_MAX_CHUNK_SIZE", 64 * 1024 * 1024)
+        if not UPLOAD_SESSION_MIN_CHUNK_SIZE <= value <= max_size:
+            raise serializers.ValidationError(f"chunk_size must be between {UPLOAD_SESSION_MIN_CHUNK_SIZE} and {max_size}")
+        return value
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        # Fail before anything is uploaded, instead of on finalization
+        if Datasource.objects.filter(owner=user, datasource_name=validated_data['datasource_name']).exists():
+            raise serializers.ValidationError("A datasource with this datasource_name already exists")
+        return UploadSession.objects.create(owner=user,
+                                            datasource_name=validated_data['datasource_name'],
+                                            visibility=validated_data.get('visibility', ShareableModel.VISIBILITY_PRIVATE),
+                                            total_size=validated_data['total_size'],
+                                            chunk_size=validated_data.get('chunk_size', getattr(settings, "UPLOAD_SESSION_CHUNK_SIZE", 8 * 1024 * 1024)))
+
 class ShareGroupSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -158,6 +213,7 @@ class ShareGroupSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'group_admins': {'required': False},
             'group_members': {'required': False},
+            'member_groups': {'required': False, 'read_only': True},
             'is_public': {'required': False}
         }
 
@@ -281,7 +337,7 @@ class DashboardSerializer(serializers.ModelSerializer):
     class Meta:
         model = Dashboard
         fields = '__all__'
-        read_only_fields = ['id', 'owner', 'creation_time', 'modification_time']
+        read_only_fields = ['id', 'owner', 'creation_time', 'modification_time', 'version']
         extra_kwargs = {
             'name': {'required': False},
             'config': {'required': False},
@@ -291,55 +347,10 @@ class DashboardSerializer(serializers.ModelSerializer):
         }
 
     def parse_config(self, config, strip_extra=True):
-        supported_generators = ['id', 'chart'] #TODO: Get list from config to make adding generators easier
-
-        numberTypes = {int, float}
-
-        def parse_split(c):
-            keys = set(c.keys())
-            if 'aspect' not in c:
-                raise serializers.ValidationError("split must have an aspect ratio")
-            elif (len(c['aspect']) != 2 or type(c['aspect'][0]) not in numberTypes  or type(c['aspect'][1]) not in numberTypes or c['aspect'][0]<0  or c['aspect'][1]<0):
-                raise serializers.ValidationError("aspect ratio must be a list of exact 2 positive integers")
-            else:
-                keys.remove('aspect')
-            if 'c1' in c:
-                keys.remove('c1')
-                parse_child(c['c1'])
-            if 'c2' in c:
-                keys.remove('c2')
-                parse_child(c['c2'])
-            if 'horizontal' in c:
-                keys.remove('horizontal')
-            for key in keys:
-                if strip_extra:
-                    _ = c.pop(key)
-                else:
-                    raise serializers.ValidationError(f"Invalid keys: {keys}")
-            return c
-
-        def parse_child(c):
-            keys = set(c.keys())
-            if 'split' in keys:
-                keys.remove('split')
-                parse_split(c['split'])
-            if 'generatorName' in keys:
-                keys.remove('generatorName')
-                if c['generatorName'] not in supported_generators:
-                    raise serializers.ValidationError(f"Unsupported generator: {c['generatorName']}")
-            if 'args' in c:
-                keys.remove('args')
-                #TODO: Validate args? Those depend on the used generator. Hardcoding this makes changing generators harder
-            for key in keys:
-                if strip_extra:
-                    _ = c.pop(key)
-                else:
-                    raise serializers.ValidationError(f"Invalid keys: {keys}")
-            return c
-
-        config_object = json.loads(config)
-        config_object = parse_split(config_object)
-        return json.dumps(config_object)
+        try:
+            return validate_config(config, strip_extra)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
 
     def validate(self, data):
         unvalidated_data = self.context['request'].data
@@ -348,10 +359,7 @@ class DashboardSerializer(serializers.ModelSerializer):
         if 'owner' in unvalidated_data:
             unvalidated_data.pop('owner')
         if 'config' in unvalidated_data:
-            try:
-                unvalidated_data['config'] = self.parse_config(unvalidated_data['config'])
-            except json.decoder.JSONDecodeError:
-                raise serializers.ValidationError("Config must be valid JSON")
+            unvalidated_data['config'] = self.parse_config(unvalidated_data['config'])
         return unvalidated_data
 
     def validate_create(self, data):
@@ -373,6 +381,7 @@ class DashboardSerializer(serializers.ModelSerializer):
         instance.name = validated_data.get('name', instance.name)
         instance.config = validated_data.get('config', instance.config)
         instance.visibility = validated_data.get('visibility', instance.visibility)
+        instance.version += 1
 
         instance.save()
         return instance
@@ -0,0 +1,117 @@
+"""Sharing many objects with many users and groups at once.
+
+Shares are rows of the through tables of shared_users and shared_groups. The selected objects and the principals are
+combined into all pairs by the database: every through table gets a single INSERT ... SELECT, existing shares are
+skipped by the backend's conflict handling, so no rows are read into Python.
+"""
+from django.db import connection
+from django.db.models import F
+from django.db.models.constants import OnConflict
+
+from .models import Chart, Datasource, Dashboard
+
+SHAREABLE_TYPES = {
+    'chart': Chart,
+    'datasource': Datasource,
+    'dashboard': Dashboard,
+}
+
+# Fields objects may be selected by, besides their ids
+SELECTION_FIELDS = {
+    'chart': {'chart_type', 'visibility', 'original_datasource', 'downloadable'},
+    'datasource': {'visibility', 'status'},
+    'dashboard': {'visibility'},
+}
+
+def get_selection(object_type, user, ids=None, filters=None):
+    """Select objects of the user to share, by ids and/or field values.
+    :param str object_type: One of SHAREABLE_TYPES
+    :param User user: The owner of the objects
+    :param list ids: Ids of the objects, all of them must exist and be owned by the user
+    :param dict filters: Field values the objects must have, fields are limited to SELECTION_FIELDS
+    :return: The selected objects
+    :rtype: QuerySet
+    :raises ValueError: If the selection is invalid or refers to missing objects
+    :raises PermissionError: If objects of other users are selected by id
+    """
+    if object_type not in SHAREABLE_TYPES:
+        raise ValueError(f"Unknown type: {object_type}")
+    if ids is None and filters is None:
+        raise ValueError("Objects must be selected by ids or filter")
+    model = SHAREABLE_TYPES[object_type]
+    selection = model.objects.filter(owner=user)
+    if filters is not None:
+        if not isinstance(filters, dict):
+            raise ValueError("Filter must be an object")
+        unknown = set(filters.keys()) - SELECTION_FIELDS[object_type]
+        if unknown:
+            raise ValueError(f"Can not select by: {unknown}")
+        selection = selection.filter(**filters)
+    if ids is not None:
+        if not isinstance(ids, list):
+            raise ValueError("Ids must be a list")
+        owners = dict(model.objects.filter(pk__in=ids).values_list('pk', 'owner_id'))
+        found = {str(pk) for pk in owners}
+        missing = [pk for pk in ids if str(pk) not in found]
+        if missing:
+            raise ValueError(f"{missing[0]} doesnt refer to any objects")
+        if any(owner_id != user.id for owner_id in owners.values()):
+            raise PermissionError("Only own objects can be shared")
+        selection = selection.filter(pk__in=ids)
+    return selection
+
+def _share_with(selection, field_name, principals):
+    """Insert the shares of all selected objects with all principals with a single statement.
+    :param QuerySet selection: The selected objects
+    :param str field_name: Many to many field of the shares, 'shared_users' or 'shared_groups'
+    :param QuerySet principals: Users or groups to share with
+    :return: Number of created shares
+    :rtype: int
+    """
+    field = selection.model._meta.get_field(field_name)
+    through = field.remote_field.through._meta
+    source_column = through.get_field(field.m2m_field_name()).column
+    target_column = through.get_field(field.m2m_reverse_field_name()).column
+    objects_sql, objects_params = selection.order_by().values(share_object=F('pk')).query.sql_with_params()
+    principals_sql, principals_params = principals.order_by().values(share_principal=F('pk')).query.sql_with_params()
+
+    ops = connection.ops
+    statement = (
+        f"{ops.insert_statement(on_conflict=OnConflict.IGNORE)} {ops.quote_name(through.db_table)} "
+        f"({ops.quote_name(source_column)}, {ops.quote_name(target_column)}) "
+        f"SELECT {ops.quote_name('share_objects')}.{ops.quote_name('share_object')}, {ops.quote_name('share_principals')}.{ops.quote_name('share_principal')} "
+        f"FROM ({objects_sql}) {ops.quote_name('share_objects')} CROSS JOIN ({principals_sql}) {ops.quote_name('share_principals')} "
+        f"{ops.on_conflict_suffix_sql([], OnConflict.IGNORE, None, None)}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(statement, objects_params + principals_params)
+        return max(cursor.rowcount, 0)
+
+def share_objects(selection, users, groups):
+    """Share all selected objects with all given users and groups. Existing shares are kept.
+    Must be called inside a transaction, so shares are created for users and groups or not at all.
+    :param QuerySet selection: The selected objects
+    :param QuerySet users: Users to share with
+    :param QuerySet groups: Groups to share with
+    :return: Number of created shares
+    :rtype: int
+    """
+    return _share_with(selection, 'shared_users', users) + _share_with(selection, 'shared_groups', groups)
+
+def unshare_objects(selection, users, groups):
+    """Remove the shares of all selected objects with the given users and groups.
+    :param QuerySet selection: The selected objects
+    :param QuerySet users: Users to remove
+    :param QuerySet groups: Groups to remove
+    :return: Number of removed shares
+    :rtype: int
+    """
+    removed = 0
+    for field_name, principals in (('shared_users', users), ('shared_groups', groups)):
+        field = selection.model._meta.get_field(field_name)
+        through = field.remote_field.through
+        removed += through.objects.filter(**{
+            f"{field.m2m_field_name()}__in": selection.order_by().values('pk'),
+            f"{field.m2m_reverse_field_name()}__in": principals.order_by().values('pk'),
+        }).delete()[0]
+    return removed
@@ -0,0 +1,66 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from pathlib import Path
+from shutil import rmtree
+from .models import Chart, Dashboard, Datasource, ShareGroup
+from .dashboard_config import update_chart_references
+from .groups import add_closure_edges, remove_closure_edges
+from .uploads import release_datasource_file
+from .util import get_datasource_base_path, remove_chart_files
+
+@receiver(post_delete, sender=Datasource)
+def release_stored_file(sender, instance, **kwargs):
+    """Remove uploaded content together with the last datasource using it, and the append log of the datasource"""
+    if instance.stored_file_id is not None:
+        release_datasource_file(instance.stored_file_id)
+    elif get_datasource_base_path() in Path(instance.source).parents:
+        # Files of datasources created before content addressed storage belong to a single datasource
+        source = Path(instance.source)
+        transaction.on_commit(lambda: source.unlink(missing_ok=True))
+    if instance.append_log:
+        append_log = Path(instance.append_log)
+        transaction.on_commit(lambda: rmtree(append_log, ignore_errors=True))
+
+@receiver(post_delete, sender=Chart)
+def remove_chart_directory(sender, instance, **kwargs):
+    """Remove the rendered files of a chart, once its deletion is committed"""
+    chart_id = instance.id
+    transaction.on_commit(lambda: remove_chart_files(chart_id))
+
+@receiver(post_save, sender=Dashboard)
+def index_chart_references(sender, instance, **kwargs):
+    """Keep the charts referenced by a dashboard in sync with its config"""
+    if kwargs.get('raw'):
+        # Fixtures load references on their own
+        return
+    update_chart_references(instance)
+
+@receiver(m2m_changed, sender=ShareGroup.member_groups.through)
+def update_group_closure(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep the closure of nested groups in sync with member_groups.
+    Adding a member group which contains the group already raises a ValueError, callers inside a transaction wrap the
+    addition in transaction.atomic() to roll back just the addition.
+    """
+    if action == 'pre_clear':
+        # The cleared edges are unknown after clearing
+        field = 'to_sharegroup_id' if reverse else 'from_sharegroup_id'
+        edges = sender.objects.filter(**{field: instance.pk}).values_list('from_sharegroup_id', 'to_sharegroup_id')
+        remove_closure_edges(list(edges))
+        return
+    if action not in ('post_add', 'post_remove'):
+        return
+    if reverse:
+        edges = [(pk, instance.pk) for pk in pk_set]
+    else:
+        edges = [(instance.pk, pk) for pk in pk_set]
+    if action == 'post_add':
+        add_closure_edges(edges)
+    else:
+        remove_closure_edges(edges)
+
+@receiver(pre_delete, sender=ShareGroup)
+def remove_nested_group(sender, instance, **kwargs):
+    """Remove the paths through a deleted group, its edges are deleted without m2m signals otherwise"""
+    instance.member_groups.clear()
+    instance.parent_groups.clear()
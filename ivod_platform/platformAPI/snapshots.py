@@ -0,0 +1,104 @@
+"""Pre-rendered snapshots of public and semi-public dashboards.
+
+A snapshot is one JSON document with the layout rectangles of all items of a dashboard and the bundles of its charts,
+including small data. As it is served to everyone, only charts which are public or semi-public themselves are included.
+Snapshots are rebuilt lazily: the fingerprint of the dashboard and its charts is computed with one query on every
+request and compared to the one the stored snapshot was built from. It also serves as ETag.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .dashboard_config import get_layout, get_malformed_chart_ids
+from .models import Chart, DashboardSnapshot, ShareableModel
+from .util import resolve_chart_bundles
+
+# Changing the document format invalidates all snapshots
+SNAPSHOT_FORMAT = 1
+
+def get_snapshot_charts(dashboard):
+    """Get the charts referenced by a dashboard, which may be included in its snapshot.
+    :param Dashboard dashboard: The dashboard
+    :return: Referenced chart ids in order of appearance and the includable charts by id
+    :rtype: ([int], dict)
+    """
+    chart_ids = list(dashboard.chart_references.order_by('position').values_list('chart_id', flat=True))
+    charts = Chart.objects.filter(id__in=chart_ids, visibility__gte=ShareableModel.VISIBILITY_SEMI_PUBLIC)
+    return chart_ids, {chart.id: chart for chart in charts}
+
+def get_chart_state(chart):
+    """Get the state of a chart a snapshot depends on.
+    :param Chart chart: The chart
+    :rtype: [str]
+    """
+    return [chart.modification_time.isoformat(), chart.pive_version, chart.js_name]
+
+def get_snapshot_fingerprint(dashboard, chart_ids, charts):
+    """Compute the fingerprint of the state a snapshot of a dashboard depends on.
+    :param Dashboard dashboard: The dashboard
+    :param [int] chart_ids: Referenced chart ids
+    :param dict charts: The includable charts by id
+    :rtype: str
+    """
+    state = [
+        SNAPSHOT_FORMAT,
+        str(dashboard.id),
+        dashboard.modification_time.isoformat(),
+        # Code upgrades only change pive version and js name, not the modification time
+        [(chart_id, get_chart_state(charts[chart_id]) if chart_id in charts else None) for chart_id in chart_ids],
+    ]
+    return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+
+def build_snapshot(dashboard, chart_ids, charts, request):
+    """Build the snapshot document of a dashboard.
+    :param Dashboard dashboard: The dashboard
+    :param [int] chart_ids: Referenced chart ids
+    :param dict charts: The includable charts by id
+    :param HttpRequest request: Request object, used to build absolute urls
+    :return: Serialized JSON document
+    :rtype: str
+    """
+    max_bytes = getattr(settings, "DASHBOARD_SNAPSHOT_MAX_BYTES", 1024 * 1024)
+    items = get_layout(dashboard.config)
+    budget = max_bytes - len(json.dumps(dashboard.config)) - len(json.dumps(items))
+    resolved, truncated, unavailable = resolve_chart_bundles(chart_ids, charts, request, budget)
+    return json.dumps({
+        'id': str(dashboard.id),
+        'name': dashboard.name,
+        'config': dashboard.config,
+        'items': items,
+        'charts': resolved,
+        'truncated': truncated,
+        'unavailable': get_malformed_chart_ids(dashboard.config) + unavailable,
+        'generation_time': timezone.now().isoformat(),
+    })
+
+def get_snapshot(dashboard, request):
+    """Get the snapshot of a dashboard, building it if it is missing or outdated.
+    :param Dashboard dashboard: The dashboard, its visibility must have been checked by the caller
+    :param HttpRequest request: Request object, used to build absolute urls
+    :return: Fingerprint and a callable returning the serialized document, so it is only loaded if needed
+    :rtype: (str, callable)
+    """
+    chart_ids, charts = get_snapshot_charts(dashboard)
+    fingerprint = get_snapshot_fingerprint(dashboard, chart_ids, charts)
+
+    def get_document():
+        snapshot = DashboardSnapshot.objects.filter(dashboard=dashboard, fingerprint=fingerprint).only('document').first()
+        if snapshot is not None:
+            return snapshot.document
+        # The fingerprint was taken before building, so changes made meanwhile cause another rebuild
+        document = build_snapshot(dashboard, chart_ids, charts, request)
+        try:
+            with transaction.atomic():
+                DashboardSnapshot.objects.update_or_create(dashboard=dashboard, defaults={'fingerprint': fingerprint, 'document': document})
+        except IntegrityError:
+            # A concurrent request stored the first snapshot meanwhile or the dashboard was deleted,
+            # the document built here is just as fresh
+            pass
+        return document
+
+    return fingerprint, get_document
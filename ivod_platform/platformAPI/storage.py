@@ -0,0 +1,266 @@
+"""Reconciliation of the chart and datasource storage with the database.
+
+Both trees are scanned in a fixed order: chart directories by id, then the files at the top of the datasource
+directory, then the shards of the content addressed store. The position of an entry in this order is used as
+cursor, so a scan can be interrupted and resumed. Only names the platform creates are considered, anything else
+is left alone. Entries are checked against the database in batches. Orphans have to be older than a minimum age,
+so files of uploads and renders whose rows are not committed yet are never touched.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from uuid import UUID
+
+from .models import Chart, Datasource, DatasourceFile, UploadSession
+from .append_log import APPEND_LOG_SUFFIX
+from .canonical import CANONICAL_SUFFIX
+from .uploads import UPLOAD_TEMP_PREFIX, UPLOAD_SESSION_PREFIX
+from .util import get_chart_base_path, get_datasource_base_path
+
+TREE_CHARTS = 'charts'
+TREE_DATASOURCES = 'datasources'
+
+KIND_CHART = 'chart'
+KIND_CONTENT = 'content'
+KIND_CANONICAL = 'canonical'
+KIND_LEGACY = 'legacy'
+KIND_APPEND_LOG = 'append_log'
+KIND_SESSION = 'session'
+KIND_TEMP = 'temp'
+
+CHART_NAME = re.compile(r'^[0-9]+$')
+SHARD_NAME = re.compile(r'^[0-9a-f]{2}$')
+CONTENT_NAME = re.compile(r'^[0-9a-f]{64}$')
+CANONICAL_NAME = re.compile(r'^([0-9a-f]{64})' + re.escape(CANONICAL_SUFFIX) + r'$')
+# Files of datasources created before content addressed storage are named by a uuid
+LEGACY_NAME = re.compile(r'^[0-9a-f]{32}$')
+APPEND_LOG_NAME = re.compile(r'^[0-9a-f]{32}' + re.escape(APPEND_LOG_SUFFIX) + r'$')
+SESSION_NAME = re.compile(r'^' + re.escape(UPLOAD_SESSION_PREFIX) + r'([0-9a-f]{32})$')
+# Unfinished uploads and temporary files of canonical conversion, profiling and compression
+TEMP_NAME = re.compile(r'^(' + re.escape(UPLOAD_TEMP_PREFIX) + r'[0-9a-f]{32}|\..+\.[0-9a-f]{32}\.(tmp|plain))$')
+
+
+class StorageEntry:
+    """A file or directory in the storage, with its position in the scan order"""
+    __slots__ = ('position', 'tree', 'kind', 'key', 'path')
+
+    def __init__(self, position, tree, kind, key, path):
+        self.position = position
+        self.tree = tree
+        self.kind = kind
+        self.key = key
+        self.path = path
+
+
+def _list_directory(path):
+    """List names of a directory with their type, sorted by name. A missing directory is empty.
+    :rtype: [(str, bool)]
+    """
+    try:
+        with os.scandir(path) as entries:
+            return sorted((entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries)
+    except FileNotFoundError:
+        return []
+
+def _classify_datasource_entry(shard, name, is_dir):
+    """Determine kind and database key of an entry of the datasource directory.
+    :return: Kind and key, or (None, None) for unknown entries
+    :rtype: (str, object)
+    """
+    if TEMP_NAME.match(name):
+        return KIND_TEMP, None
+    if shard is None:
+        if not is_dir and LEGACY_NAME.match(name):
+            return KIND_LEGACY, name
+        if is_dir and APPEND_LOG_NAME.match(name):
+            return KIND_APPEND_LOG, name
+        match = SESSION_NAME.match(name)
+        if match and not is_dir:
+            return KIND_SESSION, UUID(match.group(1))
+        return None, None
+    if not is_dir and CONTENT_NAME.match(name) and name.startswith(shard):
+        return KIND_CONTENT, name
+    match = CANONICAL_NAME.match(name)
+    if match and is_dir:
+        return KIND_CANONICAL, match.group(1)
+    return None, None
+
+def iter_chart_entries(after=None):
+    """Iterate the chart directories in order of their id.
+    :param list after: Position to resume after
+    :rtype: iterator of StorageEntry
+    """
+    base_path = get_chart_base_path()
+    # Test setups on some systems share one directory for everything, content shards are no charts
+    shared = base_path == get_datasource_base_path()
+    ids = sorted(int(name) for name, is_dir in _list_directory(base_path)
+                 if is_dir and CHART_NAME.match(name) and not (shared and SHARD_NAME.match(name)))
+    for chart_id in ids:
+        position = [0, '', chart_id]
+        if after is not None and position <= after:
+            continue
+        yield StorageEntry(position, TREE_CHARTS, KIND_CHART, chart_id, base_path.joinpath(str(chart_id)))
+
+def iter_datasource_entries(executor, after=None, ahead=4):
+    """Iterate the entries of the datasource directory: its top level, then the shards in order.
+    Shards are listed ahead in parallel. Shards before the resume position are not listed at all.
+    :param Executor executor: Pool to list shards with
+    :param list after: Position to resume after
+    :param int ahead: Number of shards listed ahead
+    :rtype: iterator of StorageEntry
+    """
+    base_path = get_datasource_base_path()
+    top_level = _list_directory(base_path)
+    shards = []
+    for name, is_dir in top_level:
+        if is_dir and SHARD_NAME.match(name):
+            if after is None or [1, name] >= after[:2]:
+                shards.append(name)
+            continue
+        kind, key = _classify_datasource_entry(None, name, is_dir)
+        position = [1, '', name]
+        if kind is None or (after is not None and position <= after):
+            continue
+        yield StorageEntry(position, TREE_DATASOURCES, kind, key, base_path.joinpath(name))
+
+    pending = deque()
+    shards = iter(shards)
+    for shard in shards:
+        pending.append((shard, executor.submit(_list_directory, base_path.joinpath(shard))))
+        if len(pending) >= ahead:
+            break
+    while pending:
+        shard, listing = pending.popleft()
+        next_shard = next(shards, None)
+        if next_shard is not None:
+            pending.append((next_shard, executor.submit(_list_directory, base_path.joinpath(next_shard))))
+        for name, is_dir in listing.result():
+            kind, key = _classify_datasource_entry(shard, name, is_dir)
+            position = [1, shard, name]
+            if kind is None or (after is not None and position <= after):
+                continue
+            yield StorageEntry(position, TREE_DATASOURCES, kind, key, base_path.joinpath(shard).joinpath(name))
+
+def iter_storage(executor, after=None, ahead=4):
+    """Iterate all entries of the storage in scan order.
+    :param Executor executor: Pool to list directories with
+    :param list after: Position to resume after
+    :param int ahead: Number of directories listed ahead
+    :rtype: iterator of StorageEntry
+    """
+    yield from iter_chart_entries(after)
+    yield from iter_datasource_entries(executor, after, ahead)
+
+
+def _referenced_keys(kind, entries):
+    """Get the keys of entries of one kind, which are referenced by the database, with a single query.
+    :rtype: set
+    """
+    if kind == KIND_CHART:
+        return set(Chart.objects.filter(pk__in=[entry.key for entry in entries]).values_list('pk', flat=True))
+    if kind in (KIND_CONTENT, KIND_CANONICAL):
+        return set(DatasourceFile.objects.filter(sha256__in=[entry.key for entry in entries]).values_list('sha256', flat=True))
+    if kind == KIND_LEGACY:
+        # Their datasources refer to them by path
+        referenced = set(Datasource.objects.filter(source__in=[str(entry.path) for entry in entries]).values_list('source', flat=True))
+        return set(entry.key for entry in entries if str(entry.path) in referenced)
+    if kind == KIND_APPEND_LOG:
+        referenced = set(Datasource.objects.filter(append_log__in=[str(entry.path) for entry in entries]).values_list('append_log', flat=True))
+        return set(entry.key for entry in entries if str(entry.path) in referenced)
+    if kind == KIND_SESSION:
+        return set(UploadSession.objects.filter(pk__in=[entry.key for entry in entries]).values_list('pk', flat=True))
+    return set()
+
+def get_age(path):
+    """Get seconds since the last modification of a file or directory, None if it is gone.
+    :rtype: float
+    """
+    try:
+        return time.time() - os.lstat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def find_orphans(entries, executor, min_age):
+    """Select the entries no database row refers to and which are older than min_age.
+    :param [StorageEntry] entries: A batch of entries
+    :param Executor executor: Pool to check the age of files with
+    :param float min_age: Minimum age in seconds
+    :rtype: [StorageEntry]
+    """
+    by_kind = {}
+    for entry in entries:
+        by_kind.setdefault(entry.kind, []).append(entry)
+    candidates = []
+    for kind, kind_entries in by_kind.items():
+        referenced = _referenced_keys(kind, kind_entries)
+        # Temporary files have no key, they are orphans once they are old enough
+        candidates.extend(entry for entry in kind_entries if entry.key is None or entry.key not in referenced)
+    ages = executor.map(get_age, [entry.path for entry in candidates])
+    return [entry for entry, age in zip(candidates, ages) if age is not None and age >= min_age]
+
+def remove_orphan(entry, min_age, quarantine_path=None):
+    """Delete an orphan, or move it into quarantine. Its database row and age are checked once more right before,
+    as content might have been stored again at the same path since it was found.
+    :param StorageEntry entry: The orphan
+    :param float min_age: Minimum age in seconds
+    :param Path quarantine_path: Directory to move orphans into instead of deleting them
+    :return: True, if the orphan was removed
+    :rtype: bool
+    """
+    if entry.key is not None and _referenced_keys(entry.kind, [entry]):
+        return False
+    age = get_age(entry.path)
+    if age is None or age < min_age:
+        return False
+    try:
+        if quarantine_path is not None:
+            base_path = get_chart_base_path() if entry.tree == TREE_CHARTS else get_datasource_base_path()
+            target = Path(quarantine_path).joinpath(entry.tree).joinpath(entry.path.relative_to(base_path))
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(entry.path), str(target))
+        elif entry.path.is_dir() and not entry.path.is_symlink():
+            shutil.rmtree(entry.path)
+        else:
+            entry.path.unlink()
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return False
+    return True
+
+
+def read_cursor(state_path):
+    """Read the position an interrupted scan stopped at.
+    :param Path state_path: The state file
+    :return: The position or None to start from the beginning
+    :rtype: list
+    """
+    try:
+        with Path(state_path).open('r') as file:
+            return json.load(file).get('cursor')
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return None
+
+def write_cursor(state_path, cursor):
+    """Store the position a scan stopped at. None removes the state, so the next scan starts from the beginning.
+    :param Path state_path: The state file
+    :param list cursor: The position
+    """
+    state_path = Path(state_path)
+    if cursor is None:
+        state_path.unlink(missing_ok=True)
+        return
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = state_path.with_name(f".{state_path.name}.tmp")
+    with temp_path.open('w') as file:
+        json.dump({'cursor': cursor}, file)
+    os.replace(temp_path, state_path)
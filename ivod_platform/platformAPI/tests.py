@@ -1,15 +1,37 @@
+import io
+import os
 import json
+import csv
+import gzip
+import hashlib
+import tempfile
+import time
+from unittest import mock
+from contextlib import redirect_stdout
 
 from rest_framework.test import APITestCase
 from django.shortcuts import reverse
-from .models import Datasource, Chart, ShareGroup, ShareableModel
+from django.db import IntegrityError
+from .models import Datasource, Chart, ShareGroup, ShareGroupClosure, ShareableModel, Dashboard, DashboardChartReference, DashboardSnapshot, DatasourceFile
 from .models import User
 from pathlib import Path
 from shutil import rmtree
-from .util import generate_chart, get_chart_base_path, get_datasource_base_path, get_code_base_path, get_config_for_chart
+from .chart_data import decode_columnar, clear_derived_data, COLUMNAR_CONTENT_TYPE
+from .cache import get_artifact_cache
+from .append_log import load_datasource_canonical, iter_datasource_content, materialize_pive_source
+from .canonical import load_canonical, open_csv_reader, read_csv_sample, CSV_SNIFF_SIZE
+from .dashboard_config import get_referenced_chart_ids, get_malformed_chart_ids
+from .compression import get_file_compression, open_datasource_file, COMPRESSION_GZIP
+from .remote import check_url
+from .uploads import wait_for_preparations
+from .util import generate_chart, open_datasource_load_source, AbsoluteUrlBuilder, get_chart_base_path, get_datasource_base_path, get_code_base_path, get_config_for_chart
 from base64 import b64encode
 from json import loads, load
 from django.conf import settings
+from django.test import override_settings, RequestFactory
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
 
 class PlatformAPITestCase(APITestCase):
 
@@ -272,6 +294,75 @@ class PlatformAPITestCase(APITestCase):
         self.assertNotEqual(response.content.decode('utf-8'), "")
         self.assertNotEqual(response.content.decode('utf-8'), "{}")
 
+    def test_chart_data_downsampled(self):
+        # Request a downsampled version of large data -> First and last row are kept
+        url = reverse("chart-data", kwargs={'pk': self.chart5.id})
+        response = self.client.get(url, {'max_points': 100})
+        self.assertEquals(response.status_code, 200)
+        downsampled = loads(response.content.decode('utf-8'))
+        with get_chart_base_path().joinpath(str(self.chart5.id)).joinpath('data.json').open('r') as data_file:
+            data = load(data_file)
+        self.assertEquals(len(downsampled), 100)
+        self.assertEquals(downsampled[0], data[0])
+        self.assertEquals(downsampled[-1], data[-1])
+
+        # Cached result is returned on the next request
+        response = self.client.get(url, {'max_points': 100})
+        self.assertEquals(loads(response.content.decode('utf-8')), downsampled)
+
+        response = self.client.get(url, {'max_points': 'many'})
+        self.assertEquals(response.status_code, 400)
+        response = self.client.get(url, {'max_points': 2})
+        self.assertEquals(response.status_code, 400)
+
+    def test_chart_data_corrupt(self):
+        # Request derived data of a chart whose stored data can not be decoded -> Server error, not a client error
+        chart_path = get_chart_base_path().joinpath(str(self.chart5.id))
+        clear_derived_data(chart_path)
+        chart_path.joinpath('data.json').write_text('[{"x": 1')
+        url = reverse("chart-data", kwargs={'pk': self.chart5.id})
+        with redirect_stdout(io.StringIO()), mock.patch('sys.stderr', io.StringIO()):
+            self.assertEquals(self.client.get(url, {'max_points': 10}).status_code, 500)
+            self.assertEquals(self.client.get(url, {'limit': 10}).status_code, 500)
+            self.assertEquals(self.client.get(url, HTTP_ACCEPT=COLUMNAR_CONTENT_TYPE).status_code, 500)
+
+    def test_chart_data_columnar(self):
+        # Request data in the columnar format -> Same values as in data.json
+        url = reverse("chart-data", kwargs={'pk': self.chart5.id})
+        response = self.client.get(url, HTTP_ACCEPT=COLUMNAR_CONTENT_TYPE)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], COLUMNAR_CONTENT_TYPE)
+        rows, columns = decode_columnar(response.content)
+        with get_chart_base_path().joinpath(str(self.chart5.id)).joinpath('data.json').open('r') as data_file:
+            data = load(data_file)
+        self.assertEquals(rows, len(data))
+        for key in data[0]:
+            self.assertEquals(list(columns[key]), [row[key] for row in data])
+
+        # Without the header JSON is returned
+        response = self.client.get(url)
+        self.assertEquals(loads(response.content.decode('utf-8')), data)
+
+    def test_chart_data_paged(self):
+        # Request a window of the data -> Only the requested rows and columns are returned
+        url = reverse("chart-data", kwargs={'pk': self.chart5.id})
+        with get_chart_base_path().joinpath(str(self.chart5.id)).joinpath('data.json').open('r') as data_file:
+            data = load(data_file)
+        response = self.client.get(url, {'offset': 10, 'limit': 5})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(loads(response.content.decode('utf-8')), data[10:15])
+        self.assertEquals(int(response['X-Total-Count']), len(data))
+
+        column = list(data[0].keys())[0]
+        response = self.client.get(url, {'offset': len(data) - 2, 'limit': 5, 'columns': column})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(loads(response.content.decode('utf-8')), [{column: row[column]} for row in data[-2:]])
+
+        response = self.client.get(url, {'offset': -1})
+        self.assertEquals(response.status_code, 400)
+        response = self.client.get(url, {'offset': 0, 'max_points': 10})
+        self.assertEquals(response.status_code, 400)
+
     def test_chart_code_read(self):
         # Access a chart directly by its key, with it being owned -> Success
         data = {}
@@ -288,6 +379,85 @@ class PlatformAPITestCase(APITestCase):
         with get_code_base_path().joinpath(version).joinpath(name).open('rb') as code_file:
             self.assertEquals(b''.join(response.streaming_content), code_file.read())
 
+    def test_chart_code_fingerprinted(self):
+        # Code is redirected to a fingerprinted url, which may be cached forever
+        url = reverse("chart-code", kwargs={'pk': self.chart2.id})
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 302)
+        code_url = response['Location']
+        self.client.logout()
+
+        config = get_config_for_chart(self.chart2)
+        with get_chart_base_path().joinpath(str(self.chart2.id)).joinpath('persisted.json').open('r') as file:
+            name = load(file)['chart_name'].lower() + ".js"
+        with get_code_base_path().joinpath(config['version']).joinpath(name).open('rb') as code_file:
+            code = code_file.read()
+
+        response = self.client.get(code_url)
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEquals(b''.join(response.streaming_content), code)
+
+        response = self.client.get(code_url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Encoding'], 'gzip')
+        self.assertEquals(gzip.decompress(b''.join(response.streaming_content)), code)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        gzip_etag = response['ETag']
+
+        # gzip explicitly refused by q=0 gets the plain representation with its own ETag
+        response = self.client.get(code_url, HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEquals(b''.join(response.streaming_content), code)
+        self.assertNotEquals(response['ETag'], gzip_etag)
+
+        response = self.client.get(code_url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Unknown fingerprints are not served
+        url = reverse("code-get", kwargs={'version': config['version'], 'name': name.replace('.js', '.0000000000000000.js')})
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 404)
+
+    def test_chart_code_info_stored(self):
+        # Rendering stores pive version and code name on the chart, the code endpoint uses them
+        chart = Chart.objects.get(id=self.chart2.id)
+        config = get_config_for_chart(chart)
+        with get_chart_base_path().joinpath(str(chart.id)).joinpath('persisted.json').open('r') as file:
+            name = load(file)['chart_name'].lower() + ".js"
+        self.assertEquals(chart.pive_version, config['version'])
+        self.assertEquals(chart.js_name, name)
+
+        # Unknown versions are rejected
+        Chart.objects.filter(id=chart.id).update(pive_version='0.0.0')
+        url = reverse("chart-code", kwargs={'pk': chart.id})
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 409)
+
+    def test_chart_bundle_read(self):
+        # Get config, code and data of a chart in one request
+        url = reverse("chart-bundle", kwargs={'pk': self.chart2.id})
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.get(url, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['config'], get_config_for_chart(self.chart2))
+        with get_chart_base_path().joinpath(str(self.chart2.id)).joinpath('data.json').open('r') as data_file:
+            self.assertEquals(response.data['data'], load(data_file))
+        code = self.client.get(response.data['code_url'])
+        self.assertEquals(code.status_code, 200)
+
+        response = self.client.get(url, {'inline_data': 'false'}, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('data', response.data)
+
+        # Same permissions as the other chart endpoints
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        response = self.client.get(url, format='json')
+        self.assertEquals(response.status_code, 403)
+
     def test_chart_config_read(self):
         # Access a chart directly by its key, with it being owned -> Success
         data = {}
@@ -299,6 +469,30 @@ class PlatformAPITestCase(APITestCase):
         config = get_config_for_chart(self.chart2)
         self.assertEquals(loads(response.content), config)
 
+    def test_chart_config_read_cached(self):
+        # Repeated config reads are served from the artifact cache
+        url = reverse("chart-config", kwargs={'pk': self.chart5.id})
+        self.client.get(url, format='json')
+        hits = get_artifact_cache().stats()['hits']
+        response = self.client.get(url, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(loads(response.content), get_config_for_chart(self.chart5))
+        self.assertGreater(get_artifact_cache().stats()['hits'], hits)
+
+        # Callers get copies, modifying them does not change the cached value
+        config = get_config_for_chart(self.chart5)
+        config['version'] = 'modified'
+        self.assertNotEquals(get_config_for_chart(self.chart5)['version'], 'modified')
+
+        # Counters are only visible to admins
+        url = reverse("cache-stats")
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        self.assertEquals(self.client.get(url, format='json').status_code, 403)
+        self.assertTrue(self.client.login(email='admin@localhost', password=getattr(settings, "ADMIN_PASS")))
+        response = self.client.get(url, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('misses', response.data)
+
     def test_chart_file_read_whitelisted(self):
         # Access a chart directly by its key, with it being owned -> Success
         data = {}
@@ -515,6 +709,366 @@ class PlatformAPITestCase(APITestCase):
         datasource = Datasource.objects.get(id=response.data['id'])
         self.assertIsNotNone(datasource)
 
+    def test_create_datasource_verify_async(self):
+        # Create a url datasource verified in the background -> Accepted as pending, unusable until verified
+        url = 'http://localhost:1/unreachable.csv'
+        self.assertFalse(check_url(url))
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(reverse("datasource-add"), {'url': url, 'datasource_name': '/test/create/pending'}, format='json')
+        self.assertEquals(response.status_code, 400)
+        response = self.client.post(reverse("datasource-add"), {'url': url, 'datasource_name': '/test/create/pending', 'verify_async': True}, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response.data['status'], Datasource.STATUS_PENDING)
+        datasource_id = response.data['id']
+
+        response = self.client.get(reverse("datasource-charttypes", kwargs={'pk': datasource_id}))
+        self.assertEquals(response.status_code, 409)
+        data = {'config': '{}', 'chart_name': '/test/create/pending', 'chart_type': 'barchart', 'datasource': datasource_id}
+        response = self.client.post(reverse("chart-add"), data, format='json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_create_datasource_streamed(self):
+        # Upload datasource files as multipart form and as raw body -> Files stored unchanged, invalid uploads leave nothing behind
+        content = "x,y\n1,äöü\n2,ß\n".encode('utf-8')
+        url = reverse("datasource-upload")
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(url, {'datasource_name': '/test/upload/multipart', 'file': SimpleUploadedFile('data.csv', content)}, format='multipart')
+        self.assertEquals(response.status_code, 201)
+        with Path(Datasource.objects.get(id=response.data['id']).source).open('rb') as file:
+            self.assertEquals(file.read(), content)
+
+        response = self.client.post(f"{url}?datasource_name=/test/upload/raw", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        with Path(Datasource.objects.get(id=response.data['id']).source).open('rb') as file:
+            self.assertEquals(file.read(), content)
+
+        response = self.client.post(f"{url}?datasource_name=/test/upload/invalid", content[:-2], content_type='text/csv')
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(list(get_datasource_base_path().glob('.upload-*')), [])
+
+    def test_datasource_deduplicated(self):
+        # Upload the same content as two users -> Content stored once, removed with the last datasource
+        content = "x,y\n1,2\n".encode('utf-8')
+        datasources = []
+        for user in ('user1@localhost', 'user2@localhost'):
+            self.assertTrue(self.client.login(email=user, password='00000000'))
+            response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/dedup", content, content_type='text/csv')
+            self.assertEquals(response.status_code, 201)
+            datasources.append(Datasource.objects.get(id=response.data['id']))
+            self.client.logout()
+        self.assertEquals(datasources[0].source, datasources[1].source)
+        self.assertEquals(datasources[0].stored_file, datasources[1].stored_file)
+        content_path = Path(datasources[0].source)
+        self.assertEquals(content_path.name, hashlib.sha256(content).hexdigest())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            datasources[0].delete()
+        self.assertTrue(content_path.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            datasources[1].delete()
+        self.assertFalse(content_path.exists())
+        self.assertFalse(DatasourceFile.objects.filter(sha256=content_path.name).exists())
+
+    def test_datasource_canonical(self):
+        # Upload a CSV datasource -> Typed canonical form next to the original, other formats are left to pive
+        content = "x,y,label\n1,2.5,a\n2,3,b\n".encode('utf-8')
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/canonical", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        datasource = Datasource.objects.get(id=response.data['id'])
+        canonical = load_canonical(datasource.source)
+        self.assertEquals(canonical.rows, 2)
+        self.assertEquals(canonical.columns, ['x', 'y', 'label'])
+        self.assertEquals(canonical.column('x').tolist(), [1, 2])
+        self.assertEquals(canonical.column('y').tolist(), [2.5, 3.0])
+        self.assertEquals(canonical.column('label')[:], ['a', 'b'])
+        # pive loads the original content
+        with open_datasource_load_source(datasource) as source:
+            with open(source, 'rb') as file:
+                self.assertEquals(file.read(), content)
+        self.assertIsNone(load_canonical(self.datasource1.source))
+
+        # Values which are no plain numbers stay strings
+        content = "code,value\n007,nan\n1,inf\n".encode('utf-8')
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/canonical/strings", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        canonical = load_canonical(Datasource.objects.get(id=response.data['id']).source)
+        self.assertEquals(canonical.column('code')[:], ['007', '1'])
+        self.assertEquals(canonical.column('value')[:], ['nan', 'inf'])
+
+        # JSON lists are converted as well
+        content = json.dumps([{'x': 1, 'label': 'a'}, {'x': 2, 'label': 'b'}]).encode('utf-8')
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/canonical/json", content, content_type='application/json')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        canonical = load_canonical(Datasource.objects.get(id=response.data['id']).source)
+        self.assertEquals(canonical.schema['format'], 'json')
+        self.assertEquals(canonical.column('x').tolist(), [1, 2])
+        self.assertEquals(canonical.column('label')[:], ['a', 'b'])
+
+    def test_csv_sample_bounded(self):
+        # Detect the dialect of CSV with very long lines -> Head read up to a bound, sniffed on complete lines
+        text = io.StringIO("a;b\n1;" + "x" * (3 * CSV_SNIFF_SIZE) + "\n", newline='')
+        sample, lines = read_csv_sample(text)
+        self.assertEquals(len(sample), 2 * CSV_SNIFF_SIZE)
+        self.assertEquals(lines, "a;b\n")
+        with self.assertRaises(csv.Error):
+            read_csv_sample(io.StringIO("x" * (3 * CSV_SNIFF_SIZE), newline=''))
+        self.assertEquals(read_csv_sample(io.StringIO("a,b\n1,2", newline='')), ("a,b\n1,2", "a,b\n1,2"))
+        # The line cut off by the sample is completed from the stream
+        long_row = {'a': "1", 'b': "x" * CSV_SNIFF_SIZE, 'c': "y" * CSV_SNIFF_SIZE}
+        reader = open_csv_reader(io.StringIO(f"a;b;c\n{';'.join(long_row.values())}\n2;3;4\n", newline=''))
+        self.assertEquals(list(reader), [long_row, {'a': "2", 'b': "3", 'c': "4"}])
+
+    def test_datasource_profile(self):
+        # Read the profile of an uploaded CSV -> Schema and column statistics, no profile for formats without canonical form
+        with Path(__file__).resolve().parent.joinpath("sample-data", "data", "csv", "numerical.csv").open("rb") as source_file:
+            content = source_file.read()
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/profile", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        response = self.client.get(reverse("datasource-profile", kwargs={'pk': response.data['id']}))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['rows'], len(content.decode('utf-8').strip().split('\n')) - 1)
+        self.assertTrue(response.data['consistent'])
+        self.assertTrue(response.data['ordered'])
+        self.assertIsInstance(response.data['unlikely_chart_types'], list)
+        self.assertEquals([column['name'] for column in response.data['columns']], ['x', 'y1', 'y2', 'y3', 'y4', 'y5', 'y6'])
+        x = response.data['columns'][0]
+        self.assertEquals((x['kind'], x['min'], x['max'], x['cardinality'], x['nulls']), ('number', 1, response.data['rows'], response.data['rows'], 0))
+
+        response = self.client.get(reverse("datasource-profile", kwargs={'pk': self.datasource1.id}))
+        self.assertEquals(response.status_code, 404)
+
+    def test_datasource_profile_impossible_chart_types(self):
+        # Profile a CSV without number columns -> Chart types requiring numbers listed as impossible and rejected on creation
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/profile/strings", b"label,code\na,007\nb,x\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        datasource_id = response.data['id']
+        response = self.client.get(reverse("datasource-profile", kwargs={'pk': datasource_id}))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([column['numeric'] for column in response.data['columns']], [False, False])
+        self.assertEquals(response.data['columns'][1]['cardinality'], 2)
+        self.assertIn("linechart", response.data['impossible_chart_types'])
+        self.assertFalse(set(response.data['impossible_chart_types']) & set(response.data['unlikely_chart_types']))
+        data = {'config': '{}', 'chart_name': '/test/impossible', 'chart_type': 'linechart', 'datasource': datasource_id}
+        response = self.client.post(reverse("chart-add"), data, format='json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_datasource_preview(self):
+        # Preview the first rows of a CSV and of a JSON datasource -> Typed rows, limited number of rows
+        with Path(__file__).resolve().parent.joinpath("sample-data", "data", "csv", "numerical.csv").open("rb") as source_file:
+            content = source_file.read()
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/preview", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        response = self.client.get(f"{reverse('datasource-preview', kwargs={'pk': response.data['id']})}?rows=2")
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['format'], 'csv')
+        self.assertEquals(response.data['rows'], [
+            {'x': 1, 'y1': 59, 'y2': 7, 'y3': 401, 'y4': 577, 'y5': 127, 'y6': 102},
+            {'x': 2, 'y1': 64, 'y2': 50, 'y3': 327, 'y4': 276, 'y5': 8, 'y6': 157},
+        ])
+
+        response = self.client.get(f"{reverse('datasource-preview', kwargs={'pk': self.datasource1.id})}?rows=3")
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, {'format': 'json', 'rows': [[12, "A"], [9, "B"], [11, "C"]]})
+
+        response = self.client.get(f"{reverse('datasource-preview', kwargs={'pk': self.datasource1.id})}?rows=0")
+        self.assertEquals(response.status_code, 400)
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        response = self.client.get(reverse('datasource-preview', kwargs={'pk': self.datasource1.id}))
+        self.assertEquals(response.status_code, 403)
+
+    @override_settings(DATASOURCE_COMPRESSION='gzip')
+    def test_datasource_compressed(self):
+        # Upload a datasource with compression at rest -> Files stored compressed, content read transparently
+        with Path(__file__).resolve().parent.joinpath("sample-data", "data", "csv", "numerical.csv").open("rb") as source_file:
+            content = source_file.read()
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/compressed", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        datasource = Datasource.objects.get(id=response.data['id'])
+        self.assertEquals(get_file_compression(datasource.source), COMPRESSION_GZIP)
+        with open_datasource_file(datasource.source) as file:
+            self.assertEquals(file.read(), content)
+        self.assertEquals(datasource.stored_file.sha256, hashlib.sha256(content).hexdigest())
+
+        response = self.client.get(f"{reverse('datasource-preview', kwargs={'pk': datasource.id})}?rows=1")
+        self.assertEquals(response.data['rows'], [{'x': 1, 'y1': 59, 'y2': 7, 'y3': 401, 'y4': 577, 'y5': 127, 'y6': 102}])
+        response = self.client.get(reverse("datasource-charttypes", kwargs={'pk': datasource.id}))
+        self.assertEquals(response.status_code, 200)
+        self.assertIn("linechart", response.data)
+
+    def test_datasource_append(self):
+        # Append rows to an uploaded CSV -> Rows in the append log in the format of the file, canonical form and profile extended
+        with Path(__file__).resolve().parent.joinpath("sample-data", "data", "csv", "numerical.csv").open("rb") as source_file:
+            content = source_file.read()
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/append", content, content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        datasource_id = response.data['id']
+        stored_file_id = Datasource.objects.get(id=datasource_id).stored_file_id
+        rows = load_canonical(Datasource.objects.get(id=datasource_id).source).rows
+
+        url = reverse("datasource-append", kwargs={'pk': datasource_id})
+        response = self.client.post(url, b"x,y1,y2,y3,y4,y5,y6\n6401,1,2,3,4,5,6\n6402,7,8,9,10,11,12\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['appended_rows'], 2)
+        datasource = Datasource.objects.get(id=datasource_id)
+        # The stored content is left unchanged
+        self.assertEquals(datasource.stored_file_id, stored_file_id)
+        with Path(datasource.source).open('rb') as file:
+            self.assertEquals(file.read(), content)
+        expected = content + b"6401,1,2,3,4,5,6\r\n6402,7,8,9,10,11,12\r\n"
+        self.assertEquals(b''.join(iter_datasource_content(datasource)), expected)
+        canonical = load_datasource_canonical(datasource)
+        self.assertEquals(canonical.rows, rows + 2)
+        self.assertEquals(canonical.column('y6')[-2:].tolist(), [6, 12])
+        # pive loads the content followed by the appended rows
+        with materialize_pive_source(datasource) as path:
+            with path.open('rb') as file:
+                self.assertEquals(file.read(), expected)
+        response = self.client.get(reverse("datasource-profile", kwargs={'pk': datasource_id}))
+        self.assertEquals(response.data['rows'], rows + 2)
+        self.assertEquals(response.data['columns'][0]['max'], 6402)
+
+        # Further appends continue the log
+        response = self.client.post(url, b"6403,1,2,3,4,5,6\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 200)
+        datasource = Datasource.objects.get(id=datasource_id)
+        self.assertEquals(datasource.log_rows, 3)
+        self.assertEquals(load_datasource_canonical(datasource).column('x')[-3:].tolist(), [6401, 6402, 6403])
+
+        # Rows not fitting the columns are rejected as a whole
+        response = self.client.post(url, b"6404,1,2,3,4,5,6\n6405,a,2,3,4,5,6\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 400)
+        response = self.client.post(url, b"6404,1,2\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(Datasource.objects.get(id=datasource_id).log_rows, 3)
+        self.assertEquals(Datasource.objects.get(id=datasource_id).log_lengths, datasource.log_lengths)
+
+        response = self.client.post(reverse("datasource-append", kwargs={'pk': self.datasource1.id}), b"1,2\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 400)
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        response = self.client.post(url, b"6404,1,2,3,4,5,6\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 403)
+
+    def test_absolute_url_builder(self):
+        # Build urls for background rendering -> Same urls as the request would build
+        request = RequestFactory().get('/charts/1', secure=True)
+        builder = AbsoluteUrlBuilder.from_request(request)
+        path = reverse("chart-data", kwargs={'pk': 1})
+        self.assertEquals(builder.build_absolute_uri(path), request.build_absolute_uri(path))
+
+    def test_datasource_append_strings(self):
+        # Append numbers to a string column -> Kept as text
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(f"{reverse('datasource-upload')}?datasource_name=/test/append/strings", b"label,value\na,1\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 201)
+        wait_for_preparations()
+        datasource_id = response.data['id']
+        response = self.client.post(reverse("datasource-append", kwargs={'pk': datasource_id}), b"123,2\n007,3\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 200)
+        canonical = load_datasource_canonical(Datasource.objects.get(id=datasource_id))
+        self.assertEquals(canonical.column('label')[:], ['a', '123', '007'])
+        self.assertEquals(canonical.column('value').tolist(), [1, 2, 3])
+
+    def test_reconcile_storage(self):
+        # Reconcile storage with orphans and referenced files -> Old orphans removed or quarantined, everything else kept
+        chart_orphan = get_chart_base_path().joinpath("999999")
+        chart_orphan.mkdir(parents=True, exist_ok=True)
+        chart_orphan.joinpath("data.json").write_text("[]")
+        datasource_base_path = get_datasource_base_path()
+        content_orphan = datasource_base_path.joinpath("ab", "ab" * 32)
+        content_orphan.parent.mkdir(parents=True, exist_ok=True)
+        content_orphan.write_text("x,y\n1,2\n")
+        canonical_orphan = datasource_base_path.joinpath("ab", f"{'ab' * 32}.canonical")
+        canonical_orphan.mkdir(exist_ok=True)
+        legacy_orphan = datasource_base_path.joinpath("f" * 32)
+        legacy_orphan.write_text("x,y\n1,2\n")
+        young_orphan = datasource_base_path.joinpath("e" * 32)
+        young_orphan.write_text("x,y\n1,2\n")
+        unknown_file = datasource_base_path.joinpath("unknown")
+        unknown_file.write_text("x")
+        referenced = Path(self.datasource1.source)
+        old = time.time() - 7200
+        for path in (content_orphan, canonical_orphan, legacy_orphan, unknown_file, referenced):
+            os.utime(path, (old, old))
+
+        with redirect_stdout(io.StringIO()):
+            call_command('reconcile_storage', '--action', 'report')
+        self.assertTrue(content_orphan.exists())
+        with redirect_stdout(io.StringIO()):
+            call_command('reconcile_storage', '--action', 'delete')
+        for path in (content_orphan, canonical_orphan, legacy_orphan):
+            self.assertFalse(path.exists())
+        for path in (chart_orphan, young_orphan, unknown_file, referenced):
+            self.assertTrue(path.exists())
+
+        quarantine_path = get_datasource_base_path().parent.joinpath("quarantine")
+        rmtree(quarantine_path, ignore_errors=True)
+        with redirect_stdout(io.StringIO()):
+            call_command('reconcile_storage', '--action', 'quarantine', '--quarantine-dir', str(quarantine_path), '--min-age', '0', '--time-budget', '60')
+        self.assertFalse(chart_orphan.exists())
+        self.assertTrue(quarantine_path.joinpath("charts", "999999", "data.json").exists())
+        self.assertTrue(quarantine_path.joinpath("datasources", "e" * 32).exists())
+        self.assertTrue(referenced.exists())
+        rmtree(quarantine_path)
+        unknown_file.unlink()
+
+    def test_create_datasource_resumable(self):
+        # Upload a datasource in chunks out of order, with a character crossing the chunk border -> Datasource with the unchanged file
+        content = ("x" + "ä" * 700).encode('utf-8')
+        chunks = [content[:1024], content[1024:]]
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.post(reverse("upload-add"), {'datasource_name': '/test/upload/resumable', 'total_size': len(content), 'chunk_size': 1024}, format='json')
+        self.assertEquals(response.status_code, 201)
+        session_id = response.data['id']
+        self.assertEquals(response.data['missing_chunks'], [0, 1])
+
+        chunk_url = reverse("upload-chunk", kwargs={'pk': session_id, 'index': 1})
+        response = self.client.put(chunk_url, chunks[1], content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=hashlib.sha256(chunks[0]).hexdigest())
+        self.assertEquals(response.status_code, 400)
+        response = self.client.put(chunk_url, chunks[1], content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=hashlib.sha256(chunks[1]).hexdigest())
+        self.assertEquals(response.status_code, 204)
+        response = self.client.post(reverse("upload-finalize", kwargs={'pk': session_id}))
+        self.assertEquals(response.status_code, 409)
+        self.assertEquals(response.data['missing_chunks'], [0])
+
+        # A failed retry of an accepted chunk drops it, it has to be sent again
+        response = self.client.put(chunk_url, b"y" * len(chunks[1]), content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=hashlib.sha256(chunks[1]).hexdigest())
+        self.assertEquals(response.status_code, 400)
+        response = self.client.put(chunk_url, chunks[1][:10], content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=hashlib.sha256(chunks[1][:10]).hexdigest())
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(self.client.get(reverse("upload-get", kwargs={'pk': session_id})).data['missing_chunks'], [0, 1])
+        response = self.client.put(chunk_url, chunks[1], content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=hashlib.sha256(chunks[1]).hexdigest())
+        self.assertEquals(response.status_code, 204)
+
+        chunk_url = reverse("upload-chunk", kwargs={'pk': session_id, 'index': 0})
+        response = self.client.put(chunk_url, chunks[0], content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=hashlib.sha256(chunks[0]).hexdigest())
+        self.assertEquals(response.status_code, 204)
+
+        # A name taken in the meantime keeps the session, it can be finalized once the name is free again
+        taken = Datasource.objects.create(source='http://localhost/taken.csv', datasource_name='/test/upload/resumable', owner=self.user1)
+        response = self.client.post(reverse("upload-finalize", kwargs={'pk': session_id}))
+        self.assertEquals(response.status_code, 409)
+        self.assertEquals(self.client.get(reverse("upload-get", kwargs={'pk': session_id})).status_code, 200)
+        taken.delete()
+
+        response = self.client.post(reverse("upload-finalize", kwargs={'pk': session_id}))
+        self.assertEquals(response.status_code, 201)
+        with Path(Datasource.objects.get(id=response.data['id']).source).open('rb') as file:
+            self.assertEquals(file.read(), content)
+        self.assertEquals(self.client.get(reverse("upload-get", kwargs={'pk': session_id})).status_code, 404)
+
     def test_create_chart(self):
         # Create a new chart with a datasource user has access too -> Chart in Database
         data = {'config': '{}',
@@ -1029,6 +1583,125 @@ class PlatformAPITestCase(APITestCase):
         self.assertNotIn(self.user3.id, group.group_members.all())
         self.assertNotIn(self.user3.id, group.group_admins.all())
 
+    def test_bulk_share(self):
+        # Share all linecharts of user2 with a user and a group at once -> Shares exist once, other objects are refused
+        url = reverse("share-bulk")
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        data = {'type': 'chart', 'filter': {'chart_type': 'linechart'}, 'users': [self.user3.id], 'groups': [self.group1.id]}
+        response = self.client.post(url, data, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, {'objects': 3, 'created': 6})
+        for chart in (self.chart3, self.chart4, self.chart5):
+            self.assertIn(self.user3, chart.shared_users.all())
+            self.assertIn(self.group1, chart.shared_groups.all())
+        response = self.client.post(url, data, format='json')
+        self.assertEquals(response.data, {'objects': 3, 'created': 0})
+
+        # Missing and foreign objects fail as a whole
+        response = self.client.post(url, {'type': 'chart', 'ids': [self.chart3.id, self.chart2.id], 'users': [self.user1.id]}, format='json')
+        self.assertEquals(response.status_code, 403)
+        response = self.client.post(url, {'type': 'chart', 'ids': [self.chart3.id, 999999], 'users': [self.user1.id]}, format='json')
+        self.assertEquals(response.status_code, 400)
+        response = self.client.post(url, {'type': 'chart', 'ids': [self.chart3.id], 'users': [self.user1.id], 'groups': [999999]}, format='json')
+        self.assertEquals(response.status_code, 400)
+        response = self.client.post(url, {'type': 'chart', 'filter': {'chart_name': '/linechart1'}, 'users': [self.user1.id]}, format='json')
+        self.assertEquals(response.status_code, 400)
+        self.assertNotIn(self.user1, self.chart3.shared_users.all())
+
+        response = self.client.delete(url, {'type': 'chart', 'ids': [self.chart3.id], 'users': [self.user3.id]}, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, {'objects': 1, 'removed': 1})
+        self.assertNotIn(self.user3, self.chart3.shared_users.all())
+        self.assertIn(self.user3, self.chart4.shared_users.all())
+
+    def test_nested_share_groups(self):
+        # Nest groups group1 > group_b > group_c -> Members of group_c see objects shared with group1, cycles are refused
+        group_b = self.create_group("user1@localhost", "00000000", "group_b")
+        group_c = self.create_group("user2@localhost", "00000000", "group_c", members=[self.user3.id])
+        chart_url = reverse("chart-get", kwargs={'pk': self.chart2.id})
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        self.assertEquals(self.client.get(chart_url, format='json').status_code, 403)
+
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        url = reverse("sharegroup-properties", kwargs={'pk': self.group1.id})
+        response = self.client.patch(url, {'member_groups': [group_b.id]}, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['member_groups'], [group_b.id])
+        url = reverse("sharegroup-properties", kwargs={'pk': group_b.id})
+        self.assertEquals(self.client.patch(url, {'member_groups': [group_c.id]}, format='json').status_code, 200)
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        self.assertEquals(self.client.get(chart_url, format='json').status_code, 200)
+
+        # group1 contains group_c already, so it can not become a member of group_c
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        url = reverse("sharegroup-properties", kwargs={'pk': group_c.id})
+        response = self.client.patch(url, {'member_groups': [self.group1.id]}, format='json')
+        self.assertEquals(response.status_code, 400)
+        self.assertFalse(group_c.member_groups.exists())
+
+        # A second path keeps the closure row when one path is removed
+        self.group1.member_groups.add(group_c)
+        closure = set(ShareGroupClosure.objects.values_list('ancestor', 'descendant'))
+        with redirect_stdout(io.StringIO()):
+            call_command('rebuild_group_closure')
+        self.assertEquals(set(ShareGroupClosure.objects.values_list('ancestor', 'descendant')), closure)
+        self.group1.member_groups.remove(group_b)
+        self.assertEquals(set(ShareGroupClosure.objects.values_list('ancestor', 'descendant')), {(self.group1.id, group_c.id), (group_b.id, group_c.id)})
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        self.assertEquals(self.client.get(chart_url, format='json').status_code, 200)
+
+        # Deleting the last link revokes access
+        group_c.parent_groups.clear()
+        self.assertEquals(set(ShareGroupClosure.objects.values_list('ancestor', 'descendant')), set())
+        self.assertEquals(self.client.get(chart_url, format='json').status_code, 403)
+
+    def test_sync_group_members(self):
+        # Sync members from CSV and JSON lists -> Only the difference is applied, unknown users change nothing
+        url = reverse("sharegroup-members", kwargs={'pk': self.group1.id})
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        response = self.client.put(url, "email\nuser3@localhost\n\nuser4@localhost\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, {'role': 'members', 'added': 1, 'removed': 0, 'count': 2})
+        response = self.client.put(url, json.dumps([str(self.user3.id)]), content_type='application/json')
+        self.assertEquals(response.data, {'role': 'members', 'added': 0, 'removed': 1, 'count': 1})
+        self.assertEquals(list(self.group1.group_members.all()), [self.user3])
+
+        response = self.client.post(url, "user4@localhost\nnobody@localhost\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 400)
+        response = self.client.post(url + "?role=owners", "user4@localhost\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(list(self.group1.group_members.all()), [self.user3])
+        response = self.client.post(url + "?role=admins", "user4@localhost\n", content_type='text/csv')
+        self.assertEquals(response.data, {'role': 'admins', 'added': 1, 'removed': 0, 'count': 2})
+
+        # An empty list removes everyone on PUT only if confirmed
+        for body, content_type in (("", 'text/csv'), ("email\n", 'text/csv'), ("[]", 'application/json')):
+            response = self.client.put(url, body, content_type=content_type)
+            self.assertEquals(response.status_code, 400)
+        self.assertEquals(list(self.group1.group_members.all()), [self.user3])
+        response = self.client.put(url + "?role=admins&allow_empty=1", "[]", content_type='application/json')
+        self.assertEquals(response.data, {'role': 'admins', 'added': 0, 'removed': 2, 'count': 0})
+        response = self.client.post(url + "?role=admins", "user2@localhost\nuser4@localhost\n", content_type='text/csv')
+        self.assertEquals(response.status_code, 200)
+
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        self.assertEquals(self.client.put(url, "user3@localhost\n", content_type='text/csv').status_code, 403)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            json.dump(['user1@localhost', 'user3@localhost'], file)
+            file.flush()
+            with redirect_stdout(io.StringIO()):
+                call_command('sync_group_members', self.group1.id, file.name)
+        self.assertEquals(set(self.group1.group_members.all()), {self.user1, self.user3})
+        with self.assertRaises(CommandError):
+            call_command('sync_group_members', self.group1.id, file.name)
+
+        # JSON lists are read element by element, anything but a list of strings is rejected
+        self.assertTrue(self.client.login(email='user1@localhost', password='00000000'))
+        for body in ['{"users": []}', '["user3@localhost", 1]', '["user3@localhost"', '["user3@localhost"] []']:
+            self.assertEquals(self.client.put(url, body, content_type='application/json').status_code, 400)
+        self.assertEquals(set(self.group1.group_members.all()), {self.user1, self.user3})
+
     def test_create_dashboard_anonymous(self):
         data = {'name': 'new_dashboard', 'config': self.valid_dashboard_config}
         url = reverse("dashboard-add")
@@ -1055,6 +1728,171 @@ class PlatformAPITestCase(APITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEquals(response.status_code, 400)
 
+    def test_dashboard_resolved(self):
+        # Resolve all charts of a dashboard in one request -> Only charts visible to the user are included
+        config = {
+            'horizontal': False,
+            'aspect': [1, 1],
+            'c1': {'generatorName': 'chart', 'args': {'chartID': self.chart2.id}},
+            'c2': {'split': {
+                'aspect': [1, 1],
+                'c1': {'generatorName': 'chart', 'args': {'chartID': self.chart3.id}},
+                'c2': {'split': {
+                    'aspect': [1, 1],
+                    'c1': {'generatorName': 'chart', 'args': {'chartID': self.chart1.id}},
+                    'c2': {'split': {
+                        'aspect': [1, 1],
+                        'c1': {'generatorName': 'chart', 'args': {'chartID': self.chart2.id + 0.5}},
+                        'c2': {'generatorName': 'chart', 'args': {'chartID': True}},
+                    }},
+                }},
+            }},
+        }
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        response = self.client.post(reverse("dashboard-add"), {'name': 'resolved', 'config': json.dumps(config)}, format='json')
+        self.assertEquals(response.status_code, 201)
+
+        url = reverse("dashboard-resolved", kwargs={'pk': response.data['id']})
+        response = self.client.get(url, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(set(response.data['charts'].keys()), {self.chart2.id, self.chart3.id})
+        self.assertEquals(response.data['charts'][self.chart2.id]['config'], get_config_for_chart(self.chart2))
+        self.assertIn('data', response.data['charts'][self.chart2.id])
+        # Malformed ids never match a chart and are reported as given
+        self.assertEquals(response.data['unavailable'], [self.chart2.id + 0.5, True, self.chart1.id])
+
+    def test_dashboard_chart_references(self):
+        # Charts of a dashboard are recorded on save -> Dashboards embedding a chart are listed, if visible to the caller
+        def config(*chart_ids):
+            children = [{'generatorName': 'chart', 'args': {'chartID': chart_id}} for chart_id in chart_ids]
+            return {'aspect': [1, 1], 'c1': children[0], 'c2': {'split': {'aspect': [1, 1], 'c1': children[1], 'c2': children[2]}}}
+
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        response = self.client.post(reverse("dashboard-add"), {'name': 'embedding', 'config': config(self.chart3.id, self.chart2.id, self.chart3.id)}, format='json')
+        self.assertEquals(response.status_code, 201)
+        dashboard_id = response.data['id']
+        references = DashboardChartReference.objects.filter(dashboard_id=dashboard_id).order_by('position')
+        self.assertEquals(list(references.values_list('chart_id', flat=True)), [self.chart3.id, self.chart2.id])
+
+        response = self.client.get(reverse("chart-dashboards", kwargs={'pk': self.chart2.id}), format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([dashboard['id'] for dashboard in response.data], [dashboard_id])
+
+        # Only integers and strings of digits are chart ids
+        self.assertEquals(get_referenced_chart_ids(config(str(self.chart3.id), 1.7, True)), [self.chart3.id])
+        self.assertEquals(get_referenced_chart_ids(config([1], {'a': 1}, '1.0')), [])
+        # Ids beyond the range of the reference table are malformed as well
+        self.assertEquals(get_referenced_chart_ids(config("99999999999999999999", 2 ** 31, self.chart3.id)), [self.chart3.id])
+        self.assertEquals(get_malformed_chart_ids(config("99999999999999999999", 2 ** 31, self.chart3.id)), ["99999999999999999999", 2 ** 31])
+
+        response = self.client.patch(reverse("dashboard-get", kwargs={'pk': dashboard_id}), {'config': config(self.chart3.id, self.chart5.id, 'x')}, format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(list(references.values_list('chart_id', flat=True)), [self.chart3.id, self.chart5.id])
+        response = self.client.get(reverse("chart-dashboards", kwargs={'pk': self.chart2.id}), format='json')
+        self.assertEquals(response.data, [])
+
+        # The private dashboard is not listed for others, private charts can not be looked up by others
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        response = self.client.get(reverse("chart-dashboards", kwargs={'pk': self.chart5.id}), format='json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, [])
+        response = self.client.get(reverse("chart-dashboards", kwargs={'pk': self.chart3.id}), format='json')
+        self.assertEquals(response.status_code, 403)
+
+    def test_dashboard_snapshot(self):
+        # Snapshots are served for semi-public dashboards only -> Only semi-public charts are included, changes rebuild them
+        config = {
+            'horizontal': True,
+            'aspect': [3, 1],
+            'c1': {'generatorName': 'chart', 'args': {'chartID': self.chart5.id}},
+            'c2': {'generatorName': 'chart', 'args': {'chartID': self.chart3.id}},
+        }
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        response = self.client.post(reverse("dashboard-add"), {'name': 'snapshot', 'config': config}, format='json')
+        self.assertEquals(response.status_code, 201)
+        dashboard_id = response.data['id']
+        url = reverse("dashboard-snapshot", kwargs={'pk': dashboard_id})
+        self.assertTrue(self.client.login(email='user3@localhost', password='00000000'))
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 403)
+
+        dashboard = Dashboard.objects.get(id=dashboard_id)
+        dashboard.visibility = Dashboard.VISIBILITY_SEMI_PUBLIC
+        dashboard.save()
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        snapshot = json.loads(response.content)
+        self.assertEquals([item['rect'] for item in snapshot['items']],
+                          [{'x': 0, 'y': 0, 'width': 1, 'height': 0.75}, {'x': 0, 'y': 0.75, 'width': 1, 'height': 0.25}])
+        self.assertEquals(list(snapshot['charts'].keys()), [str(self.chart5.id)])
+        self.assertEquals(snapshot['charts'][str(self.chart5.id)]['config'], get_config_for_chart(self.chart5))
+        self.assertEquals(snapshot['unavailable'], [self.chart3.id])
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.chart5.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+
+        # Code upgrades leave the modification time untouched, but still rebuild the snapshot
+        etag = response['ETag']
+        Chart.objects.filter(pk=self.chart5.pk).update(pive_version='0.0.0-upgraded')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+
+        # A concurrent request stored its snapshot first -> The freshly built document is served
+        Chart.objects.filter(pk=self.chart5.pk).update(pive_version=self.chart5.pive_version)
+        with mock.patch.object(DashboardSnapshot.objects, 'update_or_create', side_effect=IntegrityError):
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(list(json.loads(response.content)['charts'].keys()), [str(self.chart5.id)])
+
+    def test_dashboard_json_patch(self):
+        # Configs are patched with JSON patch -> Updates based on an outdated version fail, invalid results are rejected
+        config = {
+            'aspect': [1, 1],
+            'c1': {'generatorName': 'chart', 'args': {'chartID': self.chart3.id}},
+            'c2': {'generatorName': 'chart', 'args': {'chartID': self.chart5.id}},
+        }
+        self.assertTrue(self.client.login(email='user2@localhost', password='00000000'))
+        response = self.client.post(reverse("dashboard-add"), {'name': 'patched', 'config': config}, format='json')
+        self.assertEquals(response.status_code, 201)
+        url = reverse("dashboard-get", kwargs={'pk': response.data['id']})
+        response = self.client.get(url)
+        self.assertEquals(response['ETag'], '"0"')
+
+        def patch(operations, etag=None):
+            headers = {} if etag is None else {'HTTP_IF_MATCH': etag}
+            return self.client.patch(url, json.dumps(operations), content_type='application/json-patch+json', **headers)
+
+        response = patch([
+            {'op': 'test', 'path': '/c2/args/chartID', 'value': self.chart5.id},
+            {'op': 'replace', 'path': '/c2/args/chartID', 'value': self.chart2.id},
+            {'op': 'add', 'path': '/c1/extra', 'value': 'Extra data should be stripped'},
+        ], '"0"')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['ETag'], '"1"')
+        dashboard = Dashboard.objects.get(id=response.data['id'])
+        self.assertEquals(dashboard.version, 1)
+        self.assertEquals(dashboard.config['c2']['args']['chartID'], self.chart2.id)
+        self.assertNotIn('extra', dashboard.config['c1'])
+        self.assertEquals(list(dashboard.chart_references.order_by('position').values_list('chart_id', flat=True)), [self.chart3.id, self.chart2.id])
+
+        # Outdated version, failed test, invalid subtree and invalid path leave the dashboard unchanged
+        self.assertEquals(patch([{'op': 'remove', 'path': '/c1'}], '"0"').status_code, 412)
+        self.assertEquals(patch([{'op': 'test', 'path': '/c2/args/chartID', 'value': self.chart5.id}, {'op': 'remove', 'path': '/c1'}]).status_code, 400)
+        self.assertEquals(patch([{'op': 'replace', 'path': '/c1', 'value': {'generatorName': 'unknown'}}]).status_code, 400)
+        self.assertEquals(patch([{'op': 'remove', 'path': '/c3'}]).status_code, 400)
+        self.assertEquals(Dashboard.objects.get(id=dashboard.id).config, dashboard.config)
+
+        # Plain updates increment the version as well
+        response = self.client.patch(url, {'name': 'renamed'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['version'], 2)
+
     def test_create_dashboard_extra_data_stripping(self):
         self.assertTrue(self.client.login(email='user4@localhost', password='00000000'))
         url = reverse("dashboard-add")
@@ -1069,6 +1907,46 @@ class PlatformAPITestCase(APITestCase):
         self.assertNotIn('extra',response.data['config'])
         #TODO: Make sure extra key was stripped
 
+    @override_settings(DASHBOARD_MAX_DEPTH=3, DASHBOARD_MAX_NODES=16)
+    def test_dashboard_config_limits(self):
+        # Config is stored as JSON object, given as object or string -> Configs exceeding depth or node limits are rejected
+        self.assertTrue(self.client.login(email='user4@localhost', password='00000000'))
+        url = reverse("dashboard-add")
+
+        def nested(depth):
+            config = {'aspect': [1, 1], 'c1': {'generatorName': 'chart', 'args': {'chartID': 1}}}
+            for _ in range(depth - 1):
+                config = {'aspect': [1, 1], 'c1': {'split': config}}
+            return config
+
+        response = self.client.post(url, {'name': 'object', 'config': nested(3)}, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(Dashboard.objects.get(id=response.data['id']).config, nested(3))
+        response = self.client.post(url, {'name': 'string', 'config': json.dumps(nested(3))}, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response.data['config'], nested(3))
+
+        response = self.client.post(url, {'name': 'deep', 'config': nested(4)}, format='json')
+        self.assertEquals(response.status_code, 400)
+        wide = {'aspect': [1, 1], 'c1': {'generatorName': 'chart', 'args': {'values': [[i] for i in range(16)]}}}
+        response = self.client.post(url, {'name': 'wide', 'config': wide}, format='json')
+        self.assertEquals(response.status_code, 400)
+        # Nesting beyond what the JSON parser handles is rejected as well
+        response = self.client.post(url, {'name': 'deeper', 'config': '{"aspect": [1, 1], "c1": {"split": ' * 5000 + '{}' + '}}' * 5000}, format='json')
+        self.assertEquals(response.status_code, 400)
+
+        # Patches adding a few nodes each can not grow a config past the node limit
+        response = self.client.post(url, {'name': 'growing', 'config': {'aspect': [1, 1], 'c1': {'generatorName': 'chart', 'args': {'values': []}}}}, format='json')
+        self.assertEquals(response.status_code, 201)
+        patch_url = reverse("dashboard-get", kwargs={'pk': response.data['id']})
+        statuses = []
+        for i in range(16):
+            operations = [{'op': 'add', 'path': '/c1/args/values/-', 'value': [i]}]
+            statuses.append(self.client.patch(patch_url, json.dumps(operations), content_type='application/json-patch+json').status_code)
+        # split, child, args, values and 12 value lists
+        self.assertEquals(statuses, [200] * 12 + [400] * 4)
+        self.assertEquals(len(Dashboard.objects.get(id=response.data['id']).config['c1']['args']['values']), 12)
+
 
 
 
@@ -0,0 +1,505 @@
+"""Streaming of uploaded datasource files into the content addressed datasource store."""
+import binascii
+import codecs
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import transaction
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+
+from .canonical import write_canonical, remove_canonical
+from .compression import compress_file, get_compression
+from .profiling import get_profile
+from .models import Datasource, DatasourceFile, UploadSession, UploadChunk
+from .util import get_datasource_base_path
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Prefixes of files with unfinished uploads in the datasource directory
+UPLOAD_TEMP_PREFIX = '.upload-'
+UPLOAD_SESSION_PREFIX = '.session-'
+# Chunks must be able to hold the bytes of a UTF-8 sequence crossing their borders
+UPLOAD_SESSION_MIN_CHUNK_SIZE = 1024
+
+class DatasourceWriter:
+    """Writes an upload chunk by chunk into the datasource directory.
+    Every chunk is checked against the size limit and validated as UTF-8, and the content is hashed on the fly,
+    so the upload never has to be held in memory as a whole.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size if max_size is not None else getattr(settings, "DATASOURCE_MAX_UPLOAD_SIZE", 1024 ** 3)
+        self.size = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._hash = hashlib.sha256()
+        base_path = get_datasource_base_path()
+        base_path.mkdir(parents=True, exist_ok=True)
+        self.path = base_path.joinpath(f"{UPLOAD_TEMP_PREFIX}{uuid4().hex}")
+        self._file = self.path.open('wb')
+
+    def write(self, chunk):
+        """Append a chunk to the upload.
+        :param bytes chunk: The next part of the upload
+        :raises ValueError: If the upload gets too large or is not valid UTF-8
+        """
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise ValueError(f"Upload exceeds the size limit of {self.max_size} bytes")
+        try:
+            self._decoder.decode(chunk)
+        except UnicodeDecodeError:
+            raise ValueError("Upload is not valid UTF-8")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    @property
+    def sha256(self):
+        """Hex digest of all data written so far"""
+        return self._hash.hexdigest()
+
+    def finish(self):
+        """Complete the upload. The file stays in self.path until it is stored.
+        :raises ValueError: If the upload ends in an incomplete UTF-8 sequence
+        """
+        try:
+            self._decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise ValueError("Upload is not valid UTF-8")
+        self._file.close()
+
+    def abort(self):
+        """Discard the upload, unless it was already stored."""
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+def write_base64(writer, data):
+    """Decode base64 data chunk-wise into a writer.
+    :param DatasourceWriter writer: The target
+    :param str data: base64 encoded data
+    :raises ValueError: If data is not valid base64 or the decoded data is rejected by the writer
+    """
+    # Chunks must start at multiples of 4 characters, which whitespace would break
+    if re.search(r'\s', data):
+        data = ''.join(data.split())
+    step = UPLOAD_CHUNK_SIZE // 3 * 4
+    try:
+        for start in range(0, len(data), step):
+            writer.write(binascii.a2b_base64(data[start:start + step]))
+    except binascii.Error:
+        raise ValueError("data is not valid base64")
+
+
+def get_datasource_file_path(sha256):
+    """Get the path of stored datasource content.
+    :param str sha256: Hex digest of the content
+    :rtype: Path
+    """
+    return get_datasource_base_path().joinpath(sha256[:2]).joinpath(sha256)
+
+
+def store_datasource_file(file_path, sha256):
+    """Move a file into the content addressed store, or remove it if the same content is stored already.
+    Has to be called in the transaction saving the datasource which references the content.
+    :param Path file_path: The file
+    :param str sha256: Hex digest of the file content
+    :return: The stored file, the path of its content and whether it was created
+    :rtype: (DatasourceFile, Path, bool)
+    """
+    content_path = get_datasource_file_path(sha256)
+    # Locking the row keeps release_datasource_file from deleting the content in between
+    stored_file, created = DatasourceFile.objects.select_for_update().get_or_create(sha256=sha256, defaults={'size': file_path.stat().st_size})
+    # A file without row is an orphan, which reconcile_storage might be removing. It is replaced by the fresh one,
+    # which is made younger than the minimum age of orphans: files of upload sessions keep the time of their last chunk.
+    if created or not content_path.exists():
+        content_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(file_path, content_path)
+        os.utime(content_path)
+    else:
+        file_path.unlink()
+    return stored_file, content_path, created
+
+
+def prepare_stored_content(content_path):
+    """Convert stored content into its canonical form and profile it, unless that was done already,
+    then compress it if DATASOURCE_COMPRESSION is set.
+    :param Path content_path: The stored content
+    """
+    write_canonical(content_path)
+    get_profile(content_path)
+    if get_compression() is not None:
+        try:
+            compress_file(content_path)
+        except OSError as e:
+            # The file stays readable uncompressed
+            print(e, file=sys.stderr)
+
+
+_prepare_executor = None
+_prepare_executor_lock = threading.Lock()
+_pending_preparations = {}
+_pending_preparations_lock = threading.Lock()
+
+def get_prepare_executor():
+    """Get the thread pool preparing stored content.
+    :rtype: ThreadPoolExecutor
+    """
+    global _prepare_executor
+    if _prepare_executor is None:
+        with _prepare_executor_lock:
+            if _prepare_executor is None:
+                _prepare_executor = ThreadPoolExecutor(max_workers=getattr(settings, "DATASOURCE_PREPARE_WORKERS", 1), thread_name_prefix="datasource-prepare")
+    return _prepare_executor
+
+def _prepare_pending(content_path):
+    try:
+        prepare_stored_content(content_path)
+    except Exception as e:
+        print(e, file=sys.stderr)
+    finally:
+        with _pending_preparations_lock:
+            _pending_preparations.pop(content_path, None)
+
+def prepare_stored_content_async(content_path):
+    """Prepare stored content in the background, see prepare_stored_content. Until it is done, profiles are missing,
+    previews parse the content and rows can not be appended yet. Content being prepared is not queued again.
+    :param Path content_path: The stored content
+    :return: The pending preparation
+    :rtype: Future
+    """
+    with _pending_preparations_lock:
+        future = _pending_preparations.get(content_path)
+        if future is None:
+            future = get_prepare_executor().submit(_prepare_pending, content_path)
+            _pending_preparations[content_path] = future
+    return future
+
+def wait_for_preparations():
+    """Wait until all content queued for preparation so far is prepared, e.g. in tests or management commands."""
+    with _pending_preparations_lock:
+        futures = list(_pending_preparations.values())
+    wait(futures)
+
+
+def store_datasource(file_path, sha256, owner, datasource_name, visibility):
+    """Create a datasource for a file, without preparing its content. The file is moved into the content addressed
+    store, or removed if the same content is stored already. It is removed as well if the datasource can not be created.
+    :param Path file_path: The file
+    :param str sha256: Hex digest of the file content
+    :param User owner: Owner of the new datasource
+    :param str datasource_name: Name of the new datasource
+    :param int visibility: Visibility of the new datasource
+    :return: The datasource and the path of its stored content
+    :rtype: (Datasource, Path)
+    """
+    content_path = get_datasource_file_path(sha256)
+    created = False
+    try:
+        with transaction.atomic():
+            stored_file, content_path, created = store_datasource_file(file_path, sha256)
+            datasource = Datasource.objects.create(source=content_path, stored_file=stored_file, datasource_name=datasource_name, owner=owner, visibility=visibility)
+    except Exception as e:
+        #Clean up files
+        file_path.unlink(missing_ok=True)
+        if created:
+            content_path.unlink(missing_ok=True)
+        #and reraise exception
+        raise e
+    return datasource, content_path
+
+
+def create_datasource_from_file(file_path, sha256, owner, datasource_name, visibility):
+    """Create a datasource for an uploaded file, see store_datasource.
+    The content is prepared in the background, see prepare_stored_content_async.
+    :param Path file_path: The file
+    :param str sha256: Hex digest of the file content
+    :param User owner: Owner of the new datasource
+    :param str datasource_name: Name of the new datasource
+    :param int visibility: Visibility of the new datasource
+    :rtype: Datasource
+    """
+    datasource, content_path = store_datasource(file_path, sha256, owner, datasource_name, visibility)
+    prepare_stored_content_async(content_path)
+    return datasource
+
+
+def release_datasource_file(stored_file_id):
+    """Delete stored datasource content, if no datasource references it anymore.
+    :param int stored_file_id: Database id of the DatasourceFile
+    """
+    with transaction.atomic():
+        stored_file = DatasourceFile.objects.select_for_update().filter(pk=stored_file_id).first()
+        if stored_file is None or stored_file.datasources.exists():
+            return
+        content_path = get_datasource_file_path(stored_file.sha256)
+        stored_file.delete()
+        def remove_files():
+            content_path.unlink(missing_ok=True)
+            remove_canonical(content_path)
+        transaction.on_commit(remove_files)
+
+
+def create_uploaded_datasource(writer, owner, datasource_name, visibility):
+    """Finish an upload and create its datasource.
+    :param DatasourceWriter writer: The upload
+    :param User owner: Owner of the new datasource
+    :param str datasource_name: Name of the new datasource
+    :param int visibility: Visibility of the new datasource
+    :rtype: Datasource
+    """
+    writer.finish()
+    return create_datasource_from_file(writer.path, writer.sha256, owner, datasource_name, visibility)
+
+
+class ChunkValidator:
+    """Incremental UTF-8 validation of a chunk cut out of a text at arbitrary byte positions.
+    Continuation bytes at the start of the chunk are kept in head, an incomplete sequence at its end in tail.
+    Both have to be checked together with the neighbouring chunks.
+    """
+
+    def __init__(self):
+        self.head = b""
+        self._started = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def feed(self, data):
+        """Validate the next part of the chunk.
+        :param bytes data: The next part of the chunk
+        :raises ValueError: If the chunk can not be part of a valid UTF-8 text
+        """
+        if not self._started:
+            start = 0
+            while start < len(data) and len(self.head) + start < 3 and 0x80 <= data[start] <= 0xBF:
+                start += 1
+            self.head += data[:start]
+            data = data[start:]
+            self._started = len(data) > 0
+        try:
+            self._decoder.decode(data)
+        except UnicodeDecodeError:
+            raise ValueError("Upload is not valid UTF-8")
+
+    @property
+    def tail(self):
+        return self._decoder.getstate()[0]
+
+
+def get_upload_session_path(session):
+    """Get the path of the file an upload session is assembled in.
+    :param UploadSession session: The session
+    :rtype: Path
+    """
+    return get_datasource_base_path().joinpath(f"{UPLOAD_SESSION_PREFIX}{session.id.hex}")
+
+
+def get_chunk_count(session):
+    """Get the number of chunks of an upload session.
+    :param UploadSession session: The session
+    :rtype: int
+    """
+    return -(-session.total_size // session.chunk_size)
+
+
+def get_missing_chunks(session):
+    """Get the indices of all chunks not yet received.
+    :param UploadSession session: The session
+    :rtype: list
+    """
+    received = set(session.chunks.values_list('index', flat=True))
+    return [index for index in range(get_chunk_count(session)) if index not in received]
+
+
+def write_upload_chunk(session, index, stream, sha256):
+    """Write a chunk of an upload session straight to its position in the session file while it is received.
+    A chunk may be sent again, e.g. after a connection failure, and then replaces the former one. The former chunk is
+    dropped before the new one is written, so a failed retry leaves the chunk missing and it has to be sent again.
+    Writers hold a shared lock on the session file, which finalize_upload_session checks for writes in progress.
+    :param UploadSession session: The session
+    :param int index: Index of the chunk
+    :param stream: File like object to read the chunk from
+    :param str sha256: Expected hex digest of the chunk
+    :raises ValueError: If the chunk is out of range, has the wrong size or checksum or is not valid UTF-8
+    :raises UploadSession.DoesNotExist: If the session was finalized or discarded in between
+    :rtype: UploadChunk
+    """
+    if not 0 <= index < get_chunk_count(session):
+        raise ValueError(f"Chunk index must be between 0 and {get_chunk_count(session) - 1}")
+    offset = index * session.chunk_size
+    expected_size = min(session.chunk_size, session.total_size - offset)
+    validator = ChunkValidator()
+    chunk_hash = hashlib.sha256()
+    size = 0
+    file_path = get_upload_session_path(session)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            with transaction.atomic():
+                session = UploadSession.objects.select_for_update().get(pk=session.pk)
+                UploadChunk.objects.filter(session=session, index=index).delete()
+                # Keeps the session from expiring while chunks are arriving
+                session.save(update_fields=['modification_time'])
+        except UploadSession.DoesNotExist:
+            # The file was taken over by a datasource or discarded, or was just created by the open above
+            file_path.unlink(missing_ok=True)
+            raise
+        data = stream.read(UPLOAD_CHUNK_SIZE)
+        while data:
+            if size + len(data) > expected_size:
+                raise ValueError(f"Chunk {index} must have {expected_size} bytes")
+            validator.feed(data)
+            chunk_hash.update(data)
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, offset + size)
+                view = view[written:]
+                size += written
+            data = stream.read(UPLOAD_CHUNK_SIZE)
+        if size != expected_size:
+            raise ValueError(f"Chunk {index} must have {expected_size} bytes")
+        if chunk_hash.hexdigest() != sha256.lower():
+            raise ValueError(f"Checksum of chunk {index} does not match")
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            chunk, _ = UploadChunk.objects.update_or_create(session=session, index=index, defaults={
+                'sha256': chunk_hash.hexdigest(),
+                'head': validator.head,
+                'tail': validator.tail,
+            })
+            session.save(update_fields=['modification_time'])
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+    return chunk
+
+
+def _get_chunk_state(session):
+    return [(chunk.index, chunk.sha256) for chunk in session.chunks.order_by('index')]
+
+
+def finalize_upload_session(session):
+    """Turn a complete upload session into a datasource and delete the session.
+    The chunks were validated on arrival, only the UTF-8 sequences crossing chunk borders are left to check.
+    The file is read sequentially once without locking the session, which gives the content hash and verifies every
+    chunk against its checksum. The session is locked afterwards, and finalizing fails if chunks were written in the
+    meantime or are still being written. The session stays locked until the datasource is created, so concurrent calls
+    can not finalize it twice. If the datasource can not be created, the session is kept unchanged.
+    :param UploadSession session: The session
+    :raises ValueError: If chunks are missing, damaged or being written or the upload is not valid UTF-8
+    :raises UploadSession.DoesNotExist: If the session was finalized or discarded in between
+    :raises IntegrityError: If the owner has a datasource with the same name already
+    :rtype: Datasource
+    """
+    session = UploadSession.objects.get(pk=session.pk)
+    chunks = list(session.chunks.order_by('index'))
+    if len(chunks) != get_chunk_count(session):
+        raise ValueError("Upload is incomplete")
+    tails = [b""] + [bytes(chunk.tail) for chunk in chunks]
+    heads = [bytes(chunk.head) for chunk in chunks] + [b""]
+    for tail, head in zip(tails, heads):
+        try:
+            (tail + head).decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("Upload is not valid UTF-8")
+    file_path = get_upload_session_path(session)
+    content_hash = hashlib.sha256()
+    with file_path.open('rb') as file:
+        for chunk in chunks:
+            chunk_hash = hashlib.sha256()
+            remaining = min(session.chunk_size, session.total_size - chunk.index * session.chunk_size)
+            while remaining > 0:
+                data = file.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                chunk_hash.update(data)
+                content_hash.update(data)
+                remaining -= len(data)
+            if remaining or chunk_hash.hexdigest() != chunk.sha256:
+                raise ValueError(f"Chunk {chunk.index} is damaged and has to be sent again")
+
+        # Writers hold a shared lock from before they drop their chunk until it is recorded again
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ValueError("Chunks are still being written")
+        # The lock is held until the transaction is committed, writers waiting for it find the session deleted
+        with transaction.atomic():
+            locked_session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if locked_session.modification_time != session.modification_time or _get_chunk_state(locked_session) != [(chunk.index, chunk.sha256) for chunk in chunks]:
+                raise ValueError("Chunks were written while finalizing, the upload has to be finalized again")
+            # The datasource gets a link to the session file, which is removed if the datasource can not be created
+            link_path = file_path.parent.joinpath(f"{UPLOAD_TEMP_PREFIX}{uuid4().hex}")
+            try:
+                os.link(file_path, link_path)
+            except OSError:
+                shutil.copyfile(file_path, link_path)
+            datasource, content_path = store_datasource(link_path, content_hash.hexdigest(), session.owner, session.datasource_name, session.visibility)
+            locked_session.delete()
+            transaction.on_commit(lambda: file_path.unlink(missing_ok=True))
+    prepare_stored_content_async(content_path)
+    return datasource
+
+
+def discard_upload_session(session):
+    """Delete an upload session and its file.
+    :param UploadSession session: The session
+    """
+    # Writers opening the file afterwards find the session deleted and remove the file they created
+    session.delete()
+    get_upload_session_path(session).unlink(missing_ok=True)
+
+
+class StreamedUpload(UploadedFile):
+    """Uploaded file that was already streamed into the datasource directory by a DatasourceWriter"""
+
+    def __init__(self, writer, name, content_type, size):
+        super().__init__(file=None, name=name, content_type=content_type, size=size)
+        self.writer = writer
+
+
+class DatasourceUploadHandler(FileUploadHandler):
+    """Upload handler streaming the multipart field 'file' directly into the datasource directory.
+    Other files are skipped. Errors are kept in self.error, as exceptions would be swallowed by request parsing.
+    """
+    field_name = 'file'
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.writer = None
+        self.error = None
+        self._skip = False
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self._skip = field_name != self.__class__.field_name or self.writer is not None
+        if not self._skip:
+            self.writer = DatasourceWriter()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self._skip:
+            raise SkipFile()
+        try:
+            self.writer.write(raw_data)
+        except ValueError as e:
+            self.error = str(e)
+            raise StopUpload()
+        return None
+
+    def file_complete(self, file_size):
+        if self._skip:
+            return None
+        return StreamedUpload(self.writer, self.file_name, self.content_type, file_size)
+
+    def abort(self):
+        """Discard the streamed file, if it was not finished."""
+        if self.writer is not None:
+            self.writer.abort()
@@ -12,23 +12,41 @@ urlpatterns = [
     path('charts/<pk>/data', ChartDataView.as_view(), name='chart-data'),
     path('charts/<pk>/code', ChartCodeView.as_view(), name='chart-code'),
     path('charts/<pk>/config', ChartConfigView.as_view(), name='chart-config'),
+    path('charts/<pk>/bundle', ChartBundleView.as_view(), name='chart-bundle'),
     path('charts/<pk>/files/<filename>', ChartFileView.as_view(), name='chart-files'),
+    path('charts/<pk>/dashboards', ChartDashboardsView.as_view(), name='chart-dashboards'),
 
     path('code/<name>', get_common_code, name='code-common-get'),
     path('code/<version>/<name>', get_code, name='code-get'),
 
     path('datasources', DatasourceCreateListView.as_view(), name='datasource-add'),
+    path('datasources/upload', DatasourceUploadView.as_view(), name='datasource-upload'),
     path('datasources/<pk>', DatasourceRetrieveUpdateDestroyAPIView.as_view(), name='datasource-get'),
     path('datasources/<pk>/shared', DatasourceShareView.as_view(), name='datasource-shared'),
     path('datasources/<pk>/charttypes', ChartTypeView.as_view(), name='datasource-charttypes'),
+    path('datasources/<pk>/profile', DatasourceProfileView.as_view(), name='datasource-profile'),
+    path('datasources/<pk>/preview', DatasourcePreviewView.as_view(), name='datasource-preview'),
+    path('datasources/<pk>/append', DatasourceAppendView.as_view(), name='datasource-append'),
+
+    path('uploads', UploadSessionCreateView.as_view(), name='upload-add'),
+    path('uploads/<pk>', UploadSessionView.as_view(), name='upload-get'),
+    path('uploads/<pk>/chunks/<int:index>', UploadChunkView.as_view(), name='upload-chunk'),
+    path('uploads/<pk>/finalize', UploadSessionFinalizeView.as_view(), name='upload-finalize'),
 
     path('dashboards', DashboardCreateListView.as_view(), name='dashboard-add'),
     path('dashboards/<pk>', DashboardRetrieveUpdateDestroyAPIView.as_view(), name='dashboard-get'),
     path('dashboards/<pk>/shared', DashboardShareView.as_view(), name='dashboard-shared'),
+    path('dashboards/<pk>/resolved', DashboardResolvedView.as_view(), name='dashboard-resolved'),
+    path('dashboards/<pk>/snapshot', DashboardSnapshotView.as_view(), name='dashboard-snapshot'),
+
+    path('shares', BulkShareView.as_view(), name='share-bulk'),
+
+    path('cache/stats', ArtifactCacheStatsView.as_view(), name='cache-stats'),
 
     path('groups', ShareGroupCreateListView.as_view(), name='sharegroup-add'),
     path('groups/<pk>', ShareGroupRetrieveDestroyView.as_view(), name='sharegroup-get'),
     path('groups/<pk>/properties', ShareGroupRetrieveUpdateDestroyView.as_view(), name='sharegroup-properties'),
+    path('groups/<pk>/members', ShareGroupMembersView.as_view(), name='sharegroup-members'),
 
     # path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     # path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
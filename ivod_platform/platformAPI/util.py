@@ -3,11 +3,25 @@ from django.urls import reverse
 from django.utils import baseconv
 from pive import environment, inputmanager, outputmanager
 from pathlib import Path
+from shutil import rmtree
+import io
 import json
 import sys
 import os
+import gzip
+import hashlib
+import string
+import threading
+from collections import OrderedDict
+from urllib.parse import urljoin
+from contextlib import contextmanager
 from django.conf import settings
 
+from .chart_data import write_derived_data
+from .append_log import get_append_log, materialize_pive_source
+from .compression import materialize_datasource_file
+from .cache import get_artifact_cache
+
 from django.core.mail import send_mail
 from django.core.mail.backends.smtp import EmailBackend
 
@@ -21,6 +35,27 @@ if hasattr(settings, "GEO_COUNTRYCODE"):
 if hasattr(settings, "GEO_API_ENDPOINT"):
     GEO_CONFIG["overpass_endpoint"] = getattr(settings, "GEO_API_ENDPOINT")
 
+@contextmanager
+def open_datasource_load_source(datasource):
+    """Provide the source pive should load for a datasource. pive always loads the original content, the canonical
+    form is typed differently. Compressed files, and content with appended rows, are written into a temporary file
+    for the duration of the context.
+    :param Datasource datasource: The datasource
+    :rtype: str
+    """
+    if datasource.stored_file_id is not None and get_append_log(datasource) is not None:
+        with materialize_pive_source(datasource) as path:
+            yield str(path)
+        return
+    if datasource.stored_file_id is None and not Path(datasource.source).is_file():
+        yield datasource.source
+        return
+    with materialize_datasource_file(Path(datasource.source)) as path:
+        yield str(path)
+
+_chart_types_cache = OrderedDict()
+_chart_types_cache_lock = threading.Lock()
+
 def get_chart_types_for_datasource(datasource):
     """Create a list of supported chart types for a datasource
     :param Datasource datasource: The datasource, for which the chart types should be generated
@@ -28,18 +63,51 @@ def get_chart_types_for_datasource(datasource):
     :rtype: [str]
     """
 
+    # Uploaded content never changes, so its result is cached by content hash and the state of the append log.
+    # The file is named after the hash.
+    key = (Path(datasource.source).name, datasource.append_log, datasource.log_rows) if datasource.stored_file_id is not None else None
+    if key is not None:
+        with _chart_types_cache_lock:
+            if key in _chart_types_cache:
+                _chart_types_cache.move_to_end(key)
+                return list(_chart_types_cache[key])
+
     manager = inputmanager.InputManager(mergedata=False, accept_unordered=getattr(settings, "DATA_ALLOW_UNORDERED", False))
     env = environment.Environment(inputmanager=manager)
-    supported = env.load(datasource.source)
+    with open_datasource_load_source(datasource) as source:
+        supported = env.load(source)
+
+    if key is not None:
+        with _chart_types_cache_lock:
+            _chart_types_cache[key] = list(supported)
+            while len(_chart_types_cache) > getattr(settings, "CHART_TYPES_CACHE_ENTRIES", 1024):
+                _chart_types_cache.popitem(last=False)
     return supported
 
+class AbsoluteUrlBuilder:
+    """Builds absolute urls like HttpRequest.build_absolute_uri from the base url of a request only.
+    Passed to rendering instead of the request where rendering outlives it, e.g. in background threads.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    @classmethod
+    def from_request(cls, request):
+        return cls(request.build_absolute_uri('/'))
+
+    def build_absolute_uri(self, location):
+        return urljoin(self.base_url, location)
+
 def render_chart(chart, chart_id, environment, request, config=None):
     """(Re-)draw a chart. Before calling, environment.choose or environment.load_raw should have been called.
     :param Basevisualization chart: The chart object to be rendered
     :param str/int chart_id: The primary key of the chart in the database
     :param Environment environment: The rendering environment of pive
-    :param HttpRequest request: Request object of the call that triggered rendering
+    :param HttpRequest request: Request object of the call that triggered rendering, or an AbsoluteUrlBuilder
     :param dict config: Dictionary representing information on how to customize rendering. See pive for more details
+    :return: Tuple of pive version and js code file name of the rendered chart
+    :rtype: (str, str)
     """
     #TODO: Order od operation correct? Should config overwrite html template path?
     #FIXME: Check if chart type is selected
@@ -50,18 +118,38 @@ def render_chart(chart, chart_id, environment, request, config=None):
     chart.set_dataset_url(dataset_url)
     config_url = request.build_absolute_uri(reverse("chart-config", kwargs={'pk': chart_id}))
     code_src = request.build_absolute_uri(reverse("chart-code", kwargs={'pk': chart_id}))
+    template_variables = {'t_config_url': config_url, 't_code_src': code_src}
+    if getattr(settings, "CHART_TEMPLATE_USE_BUNDLE", False):
+        template_variables['t_bundle_url'] = request.build_absolute_uri(reverse("chart-bundle", kwargs={'pk': chart_id})) + "?inline_data=false"
     if hasattr(chart, "set_map_shape_url"):
         chart.set_map_shape_url(request.build_absolute_uri(reverse("chart-files", kwargs={'pk': chart_id, 'filename': 'shape.json'})))
-    _ = environment.render(chart, template_variables={'t_config_url': config_url, 't_code_src': code_src}, filenames={'chart.js': None})
+    _ = environment.render(chart, template_variables=template_variables, filenames={'chart.js': None})
     _ = environment.render_code(chart)
+    write_derived_data(get_chart_base_path().joinpath(str(chart_id)))
+    return read_chart_code_info(chart_id)
+
+def read_chart_code_info(chart_id):
+    """Read pive version and js code file name of a rendered chart from its files.
+    :param str/int chart_id: The primary key of the chart in the database
+    :return: Tuple of pive version and js code file name
+    :rtype: (str, str)
+    """
+    output_path = get_chart_base_path().joinpath(str(chart_id))
+    version = get_artifact_cache().get(output_path.joinpath('config.json'), json.loads)['version']
+    # persisted.json may be large, only keep the name
+    chart_name = get_artifact_cache().get(output_path.joinpath('persisted.json'), lambda content: json.loads(content)['chart_name'],
+                                          variant='chart_name')
+    return version, chart_name.lower() + ".js"
 
 def generate_chart(datasource, chart_id, chart_type, request, config=None):
     """Generate a new new chart.
     :param Datasource datasource: The datasource to use for rendering this chart
     :param str/int chart_id: The primary key of the chart in the database
     :param str chart_type: The chart type
-    :param HttpRequest request: Request object of the call that triggered rendering
+    :param HttpRequest request: Request object of the call that triggered rendering, or an AbsoluteUrlBuilder
     :param dict config: Dictionary representing information on how to customize rendering. See pive for more details
+    :return: Tuple of pive version and js code file name of the rendered chart
+    :rtype: (str, str)
     """
 
     base_path = get_chart_base_path()
@@ -69,18 +157,21 @@ def generate_chart(datasource, chart_id, chart_type, request, config=None):
     output_path = base_path.joinpath(str(chart_id))
     manager = inputmanager.InputManager(mergedata=False, accept_unordered=getattr(settings, "DATA_ALLOW_UNORDERED", False))
     env = environment.Environment(inputmanager=manager, outputmanager=outputmanager.FolderOutputManager(output_path), **GEO_CONFIG)
-    supported = env.load(datasource.source)
+    with open_datasource_load_source(datasource) as source:
+        supported = env.load(source)
     if chart_type not in supported:
         raise Exception("Chart type unsupported")
     chart = env.choose(chart_type)
-    render_chart(chart, chart_id, env, request, config)
+    return render_chart(chart, chart_id, env, request, config)
 
 def modify_chart(chart_id, request, config=None):
     """Modify an existing chart.
     :param str/int chart_id: The primary key of the chart in the database
     :param str chart_type: The chart type
-    :param HttpRequest request: Request object of the call that triggered rendering
+    :param HttpRequest request: Request object of the call that triggered rendering, or an AbsoluteUrlBuilder
     :param dict config: Dictionary representing information on how to customize rendering. See pive for more details
+    :return: Tuple of pive version and js code file name of the rendered chart
+    :rtype: (str, str)
     """
 
     base_path = get_chart_base_path()
@@ -93,7 +184,7 @@ def modify_chart(chart_id, request, config=None):
     manager = inputmanager.InputManager(mergedata=False, accept_unordered=getattr(settings, "DATA_ALLOW_UNORDERED", False))
     env = environment.Environment(inputmanager=manager, outputmanager=outputmanager.FolderOutputManager(output_path), **GEO_CONFIG)
     chart = env.load_raw(persisted_data)
-    render_chart(chart, chart_id, env, request, config)
+    return render_chart(chart, chart_id, env, request, config)
 
 def get_datasource_base_path():
     """Get a Path object pointing to the base directory containing datasources"""
@@ -117,6 +208,12 @@ def get_chart_base_path():
     else:
         return Path(getattr(settings, "CHART_BASE_PATH", Path(__file__).resolve().parent.parent.joinpath("chart_data")))
 
+def remove_chart_files(chart_id):
+    """Delete the directory of a chart with everything rendered or derived in it.
+    :param str/int chart_id: The primary key of the chart in the database
+    """
+    rmtree(get_chart_base_path().joinpath(str(chart_id)), ignore_errors=True)
+
 def get_code_base_path():
     """Get a Path object pointing to the base directory containing js code"""
     TESTING = 'test' in sys.argv
@@ -128,11 +225,240 @@ def get_code_base_path():
     else:
         return Path(getattr(settings, "JS_BASE_PATH", Path(__file__).resolve().parent.parent.joinpath("code")))
 
+# Length of the content hash embedded into fingerprinted code file names
+CODE_FINGERPRINT_LENGTH = 16
+
+class CodeFile:
+    """In-memory copy of a js code file, together with its fingerprint and a precompressed variant.
+    Code files only change when a new pive version is written on startup, so they can be kept for the process lifetime.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.gzip_content = gzip.compress(content, compresslevel=9, mtime=0)
+        self.fingerprint = hashlib.sha256(content).hexdigest()[:CODE_FINGERPRINT_LENGTH]
+
+    def get_fingerprinted_name(self, name):
+        """Get the file name with the content fingerprint embedded, e.g. 'linechart.0123456789abcdef.js'"""
+        stem, dot, suffix = name.rpartition('.')
+        if not dot:
+            return f"{name}.{self.fingerprint}"
+        return f"{stem}.{self.fingerprint}.{suffix}"
+
+_code_cache = {}
+_code_cache_lock = threading.Lock()
+
+def get_code_file(name, version=None):
+    """Get a js code file from the in-process code cache, reading it from disk on first access.
+    :param str name: File name of the code file, without fingerprint
+    :param str version: pive version of the code file. None for code common to all versions
+    :return: The cached code file or None, if no such file exists
+    :rtype: CodeFile
+    """
+    key = (version, name)
+    code_file = _code_cache.get(key)
+    if code_file is None:
+        base_path = get_code_base_path().resolve()
+        filepath = base_path.joinpath(version, name) if version else base_path.joinpath(name)
+        filepath = filepath.resolve()
+        # Never serve anything outside of the code directory
+        if base_path not in filepath.parents or not filepath.is_file():
+            return None
+        with filepath.open('rb') as file:
+            code_file = CodeFile(file.read())
+        with _code_cache_lock:
+            code_file = _code_cache.setdefault(key, code_file)
+    return code_file
+
+def clear_code_cache():
+    """Drop all cached code files. Must be called whenever the files in the code directory are rewritten."""
+    with _code_cache_lock:
+        _code_cache.clear()
+
+def accepts_encoding(accept_encoding, encoding):
+    """Check whether an Accept-Encoding header allows a content coding, honouring q-values.
+    An encoding is acceptable if it is listed, or covered by '*', with a q-value above 0.
+    :param str accept_encoding: Value of the Accept-Encoding header
+    :param str encoding: Content coding to check, e.g. 'gzip'
+    :return: True, if the encoding may be used for the response
+    :rtype: bool
+    """
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    q = qvalues.get(encoding.lower(), qvalues.get('*', 0.0))
+    return q > 0
+
+def split_code_fingerprint(name):
+    """Split a possibly fingerprinted code file name into the plain name and the fingerprint.
+    :param str name: File name, e.g. 'linechart.0123456789abcdef.js' or 'linechart.js'
+    :return: Tuple of plain name and fingerprint. The fingerprint is None if the name carries none
+    :rtype: (str, str)
+    """
+    parts = name.rsplit('.', 2)
+    if len(parts) == 3 and len(parts[1]) == CODE_FINGERPRINT_LENGTH and all(c in string.hexdigits for c in parts[1]):
+        return f"{parts[0]}.{parts[2]}", parts[1]
+    return name, None
+
+_code_versions = frozenset()
+_code_versions_mtime = None
+_code_versions_lock = threading.Lock()
+
+def refresh_code_versions():
+    """Rescan the code directory for the available pive versions."""
+    global _code_versions, _code_versions_mtime
+    base_path = get_code_base_path()
+    with _code_versions_lock:
+        try:
+            mtime = base_path.stat().st_mtime_ns
+            versions = frozenset(path.name for path in base_path.iterdir() if path.is_dir())
+        except FileNotFoundError:
+            mtime = None
+            versions = frozenset()
+        _code_versions = versions
+        _code_versions_mtime = mtime
+
+def is_code_version_available(version):
+    """Check if js code for a pive version is available. Known versions are answered from memory.
+    :param str version: The pive version
+    :rtype: bool
+    """
+    if version in _code_versions:
+        return True
+    # Unknown version, rescan only if the code directory changed since the last scan
+    try:
+        mtime = get_code_base_path().stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+    if mtime != _code_versions_mtime:
+        refresh_code_versions()
+    return version in _code_versions
+
 def get_config_for_chart(chart):
-    """Get the complete config object for a chart."""
-    with get_chart_base_path().joinpath(str(chart.id)).joinpath('config.json').open('r') as file:
-        config = json.load(file)
-        return config
+    """Get the complete config object for a chart. Small configs are cached, the returned object is a copy."""
+    return get_artifact_cache().get(get_chart_base_path().joinpath(str(chart.id)).joinpath('config.json'), json.loads)
+
+def get_data_for_chart(chart):
+    """Get the parsed data of a chart. Small data files are cached, the returned object is a copy."""
+    return get_artifact_cache().get(get_chart_base_path().joinpath(str(chart.id)).joinpath('data.json'), json.loads, variant='parsed')
+
+def ensure_chart_code_info(chart):
+    """Make sure pive version and js code name are set on a chart.
+    Charts rendered before this information was stored on the chart are backfilled from their files once.
+    :param Chart chart: The chart
+    """
+    if not chart.pive_version or not chart.js_name:
+        chart.pive_version, chart.js_name = read_chart_code_info(chart.id)
+        type(chart).objects.filter(pk=chart.pk).update(pive_version=chart.pive_version, js_name=chart.js_name)
+
+def get_chart_code_url(chart):
+    """Get the fingerprinted url of the js code of a chart.
+    :param Chart chart: The chart
+    :return: Url path of the code or None, if the code of the chart is not available
+    :rtype: str
+    """
+    ensure_chart_code_info(chart)
+    if not is_code_version_available(chart.pive_version):
+        return None
+    code_file = get_code_file(chart.js_name, chart.pive_version)
+    if code_file is None:
+        return None
+    return reverse("code-get", kwargs={'version': chart.pive_version, 'name': code_file.get_fingerprinted_name(chart.js_name)})
+
+def get_chart_bundle(chart, request, inline_data_limit=0):
+    """Collect everything needed to display a chart. Access rights must have been checked by the caller.
+    :param Chart chart: The chart
+    :param HttpRequest request: Request object, used to build absolute urls
+    :param int inline_data_limit: Data files up to this size in bytes are included in the bundle. 0 to never include data
+    :return: Dictionary with the chart id, config, code url, data url and possibly the data
+    :rtype: dict
+    """
+    code_url = get_chart_code_url(chart)
+    bundle = {
+        'id': chart.id,
+        'config': get_config_for_chart(chart),
+        'code_url': request.build_absolute_uri(code_url) if code_url else None,
+        'data_url': request.build_absolute_uri(reverse("chart-data", kwargs={'pk': chart.id})),
+    }
+    data_path = get_chart_base_path().joinpath(str(chart.id)).joinpath('data.json')
+    if inline_data_limit and data_path.stat().st_size <= inline_data_limit:
+        bundle['data'] = get_data_for_chart(chart)
+    return bundle
+
+def resolve_chart_bundles(chart_ids, charts, request, budget):
+    """Collect the bundles of several charts within a size budget. Data of small charts is included,
+    as long as the budget allows. Access rights must have been checked by the caller.
+    :param [int] chart_ids: Ids of the charts in order of priority
+    :param dict charts: The charts which may be included, by id
+    :param HttpRequest request: Request object, used to build absolute urls
+    :param int budget: Maximum size of the serialized bundles in bytes
+    :return: Bundles by chart id, ids of charts exceeding the budget and ids of unavailable charts
+    :rtype: (dict, [int], [int])
+    """
+    inline_data_limit = getattr(settings, "CHART_BUNDLE_INLINE_DATA_LIMIT", 64 * 1024)
+    resolved = {}
+    truncated = []
+    unavailable = []
+    for chart_id in chart_ids:
+        if chart_id not in charts:
+            unavailable.append(chart_id)
+            continue
+        try:
+            bundle = get_chart_bundle(charts[chart_id], request)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            unavailable.append(chart_id)
+            continue
+        size = len(json.dumps(bundle))
+        if size > budget:
+            # Client has to fetch this chart on its own
+            truncated.append(chart_id)
+            continue
+        budget -= size
+        resolved[chart_id] = bundle
+
+    # Inline data of small charts, as long as the payload stays bounded
+    for chart_id, bundle in resolved.items():
+        data_path = get_chart_base_path().joinpath(str(chart_id)).joinpath('data.json')
+        try:
+            size = data_path.stat().st_size
+            if size <= inline_data_limit and size <= budget:
+                bundle['data'] = get_data_for_chart(charts[chart_id])
+                budget -= size
+        except Exception as e:
+            print(e, file=sys.stderr)
+    return resolved, truncated, unavailable
+
+class LimitedStream(io.RawIOBase):
+    """Readable stream over an object with read(size), like a request, failing once more than max_size bytes were read"""
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise ValueError(f"Input exceeds the maximum size of {self.max_size} bytes")
+        buffer[:len(data)] = data
+        return len(data)
 
 def send_a_mail(receiver, subject, content, html_content=None):
     try:
@@ -1,6 +1,9 @@
 from .debug import helloworld,debug_reset_database
-from .datasource_views import DatasourceCreateListView, DatasourceRetrieveUpdateDestroyAPIView, DatasourceShareView
-from .chart_views import ChartCreateListView, ChartRetrieveUpdateDestroy, ChartDataView, ChartConfigView, ChartCodeView, ChartFileView, get_code, get_common_code, ChartTypeView, ChartShareView
-from .dashboard_views import DashboardCreateListView, DashboardRetrieveUpdateDestroyAPIView, DashboardShareView
-from .sharegroup_views import ShareGroupCreateListView, ShareGroupRetrieveDestroyView, ShareGroupRetrieveUpdateDestroyView
+from .datasource_views import DatasourceCreateListView, DatasourceRetrieveUpdateDestroyAPIView, DatasourceShareView, DatasourceUploadView, DatasourceProfileView, DatasourcePreviewView, DatasourceAppendView
+from .chart_views import ChartCreateListView, ChartRetrieveUpdateDestroy, ChartDataView, ChartConfigView, ChartCodeView, ChartBundleView, ChartFileView, get_code, get_common_code, ChartTypeView, ChartShareView
+from .dashboard_views import DashboardCreateListView, DashboardRetrieveUpdateDestroyAPIView, DashboardShareView, DashboardResolvedView, DashboardSnapshotView, ChartDashboardsView
+from .sharegroup_views import ShareGroupCreateListView, ShareGroupRetrieveDestroyView, ShareGroupRetrieveUpdateDestroyView, ShareGroupMembersView
 from .user_views import LoggedInUserView, UserView, UserSearchView, MultiUserView, CreateUserView, CreatePasswordResetRequest, ResetPasswordView, ChangeMailView, ConfirmMailView, PasswordChangeView
+from .cache_views import ArtifactCacheStatsView
+from .share_views import BulkShareView
+from .upload_views import UploadSessionCreateView, UploadSessionView, UploadChunkView, UploadSessionFinalizeView
@@ -0,0 +1,11 @@
+from rest_framework import generics, permissions, serializers
+from rest_framework.response import Response
+from ..cache import get_artifact_cache
+
+class ArtifactCacheStatsView(generics.RetrieveAPIView):
+    """Get hit/miss counters and fill level of the artifact cache of the serving process"""
+    permission_classes = [permissions.IsAdminUser]
+    serializer_class = serializers.Serializer
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_artifact_cache().stats())
@@ -1,19 +1,25 @@
 import sys
+from io import BytesIO
 from pathlib import Path
 
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, HttpRequest, HttpResponseRedirect, FileResponse
+from django.http import HttpResponse, HttpRequest, HttpResponseRedirect, FileResponse, HttpResponseNotFound, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django_filters.rest_framework import DjangoFilterBackend
 from django.conf import settings
 
 from rest_framework import generics, permissions, status, serializers
 from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 from ..serializers import ChartSerializer
 from ..permissions import IsOwner, IsSharedWithUser, IsPublic, IsSemiPublic, IsShared
-from ..util import get_chart_base_path, get_config_for_chart, get_code_base_path, get_chart_types_for_datasource
+from ..util import get_chart_base_path, get_config_for_chart, get_code_base_path, get_chart_types_for_datasource, get_code_file, split_code_fingerprint, accepts_encoding, ensure_chart_code_info, is_code_version_available, get_chart_bundle
+from ..chart_data import get_downsampled_data, get_columnar_data, encode_columnar, get_data_page, UnsupportedData, COLUMNAR_CONTENT_TYPE
+from ..renderers import ColumnarRenderer
+from ..cache import get_artifact_cache
 from ..models import Chart, Datasource
 from rest_framework.response import Response
-from json import load
+from json import load, loads, dumps
 from .util import ShareView
 
 class ChartCreateListView(generics.ListCreateAPIView):
@@ -108,23 +114,74 @@ class ChartRetrieveUpdateDestroy(generics.RetrieveUpdateDestroyAPIView):
 
 
 class ChartDataView(generics.RetrieveAPIView):
-    """Get processed data associated with a chart"""
+    """Get processed data associated with a chart, as JSON or in the columnar format"""
     permission_classes = [IsOwner | IsShared & IsSharedWithUser | IsSemiPublic]
     serializer_class = serializers.Serializer
     queryset = Chart.objects.all()
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [ColumnarRenderer]
 
     def get_object(self):
         obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
         self.check_object_permissions(self.request, obj)
         return obj
 
+    @staticmethod
+    def get_int_parameter(request, name, minimum, default=None):
+        """Read an integer query parameter. Raises ValueError if it is malformed or too small."""
+        value = request.query_params.get(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            value = minimum - 1
+        if value < minimum:
+            raise ValueError(f"{name} must be an integer of at least {minimum}")
+        return value
+
     def get(self, request, *args, **kwargs):
         obj = self.get_object()
+        max_page_size = getattr(settings, "CHART_DATA_MAX_PAGE_SIZE", 10000)
+        paged = any(key in request.query_params for key in ('offset', 'limit', 'columns'))
         try:
-            with get_chart_base_path().joinpath(str(obj.id)).joinpath('data.json').open('rb') as data_file:
-                return HttpResponse(data_file.read())
+            max_points = self.get_int_parameter(request, 'max_points', 3)
+            offset = self.get_int_parameter(request, 'offset', 0, default=0)
+            limit = self.get_int_parameter(request, 'limit', 1, default=max_page_size)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        if limit > max_page_size:
+            return Response(f"limit must not exceed {max_page_size}", status=status.HTTP_400_BAD_REQUEST)
+        if paged and max_points is not None:
+            return Response("max_points can not be combined with paging", status=status.HTTP_400_BAD_REQUEST)
+        columns = request.query_params['columns'].split(',') if 'columns' in request.query_params else None
+
+        columnar = request.accepted_renderer.format == ColumnarRenderer.format
+        try:
+            chart_path = get_chart_base_path().joinpath(str(obj.id))
+            if paged:
+                total, rows = get_data_page(chart_path, offset, limit, columns)
+                if columnar:
+                    response = HttpResponse(encode_columnar(rows), content_type=COLUMNAR_CONTENT_TYPE)
+                else:
+                    response = HttpResponse(dumps(rows), content_type='application/json')
+                response['X-Total-Count'] = total
+            elif max_points is not None:
+                content = get_downsampled_data(chart_path, max_points)
+                if columnar:
+                    response = HttpResponse(encode_columnar(loads(content)), content_type=COLUMNAR_CONTENT_TYPE)
+                else:
+                    response = HttpResponse(content, content_type='application/json')
+            elif columnar:
+                response = HttpResponse(get_columnar_data(chart_path), content_type=COLUMNAR_CONTENT_TYPE)
+            else:
+                response = HttpResponse(get_artifact_cache().get(chart_path.joinpath('data.json'), bytes))
+            patch_vary_headers(response, ('Accept',))
+            return response
+        except UnsupportedData as e:
+            return Response(str(e), status=status.HTTP_406_NOT_ACCEPTABLE if columnar else status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            print(e, file=sys.stderr)
+            # Includes stored data which can not be decoded
+            print(f"Data of chart {obj.id} could not be served: {e!r}", file=sys.stderr)
             return Response("Error retrieving data", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
@@ -163,25 +220,46 @@ class ChartCodeView(generics.RetrieveAPIView):
     def get(self, request, *args, **kwargs):
         obj = self.get_object()
         try:
-            config = get_config_for_chart(obj)
-            version = config['version']
+            ensure_chart_code_info(obj)
 
             # Whitelist check of version, to avoid XSS
-            whitelist = (str(path.name) for path in Path(get_code_base_path()).resolve().iterdir() if path.is_dir())
-            if version not in whitelist:
+            if not is_code_version_available(obj.pive_version):
                 return Response("Version of this chart is not supported", status=status.HTTP_409_CONFLICT)
 
-            # Redirect to the correct endpoint
-            with get_chart_base_path().joinpath(str(obj.id)).joinpath('persisted.json').open('r') as file:
-                config = load(file)
-                name = config['chart_name'].lower() + ".js"
-                target = reverse("code-get", kwargs={'version': version, 'name': name})
+            # Redirect to the fingerprinted, immutable endpoint
+            code_file = get_code_file(obj.js_name, obj.pive_version)
+            if code_file is None:
+                return Response("Code of this chart is not available", status=status.HTTP_404_NOT_FOUND)
+            target = reverse("code-get", kwargs={'version': obj.pive_version, 'name': code_file.get_fingerprinted_name(obj.js_name)})
             return HttpResponseRedirect(redirect_to=target)
         except Exception as e:
             print(e, file=sys.stderr)
             return Response("Error retrieving code", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class ChartBundleView(generics.RetrieveAPIView):
+    """Get config, code url and data (or its url) of a chart in one response"""
+    permission_classes = [IsOwner | IsShared & IsSharedWithUser | IsSemiPublic]
+    serializer_class = serializers.Serializer
+    queryset = Chart.objects.all()
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def get(self, request, *args, **kwargs):
+        obj = self.get_object()
+        inline_data_limit = getattr(settings, "CHART_BUNDLE_INLINE_DATA_LIMIT", 64 * 1024)
+        if request.query_params.get('inline_data', 'true').lower() == 'false':
+            inline_data_limit = 0
+        try:
+            return Response(get_chart_bundle(obj, request, inline_data_limit))
+        except Exception as e:
+            print(e, file=sys.stderr)
+            return Response("Error retrieving bundle", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class ChartFileView(generics.RetrieveAPIView):
     """Get another file associated with a chart (e.g. shapefile for maps)"""
     permission_classes = [IsOwner | IsShared & IsSharedWithUser | IsSemiPublic]
@@ -211,22 +289,43 @@ class ChartFileView(generics.RetrieveAPIView):
             return Response("Error retrieving data", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def serve_code_file(request: HttpRequest, name, version=None) -> HttpResponse:
+    """Serve a cached js code file.
+    Fingerprinted names never change their content and are cached by clients indefinitely,
+    plain names have to be revalidated by the client on every use.
+    """
+    name, fingerprint = split_code_fingerprint(name)
+    code_file = get_code_file(name, version)
+    if code_file is None or (fingerprint is not None and fingerprint != code_file.fingerprint):
+        return HttpResponseNotFound()
+
+    # Both representations need their own strong ETag, as they differ byte for byte
+    use_gzip = accepts_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), 'gzip')
+    etag = f'"{code_file.fingerprint}-gz"' if use_gzip else f'"{code_file.fingerprint}"'
+    if etag in (tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')):
+        response = HttpResponseNotModified()
+    elif use_gzip:
+        response = FileResponse(BytesIO(code_file.gzip_content), content_type='text/javascript')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = FileResponse(BytesIO(code_file.content), content_type='text/javascript')
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if fingerprint is not None:
+        patch_cache_control(response, public=True, max_age=60*60*24*365, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
+
+
 def get_code(request: HttpRequest, version, name) -> HttpResponse:
     """Get js code file specified by name and version"""
-    filepath = Path(get_code_base_path()).resolve().joinpath(version).joinpath(name)
-    if filepath.exists():
-        return FileResponse(filepath.open("rb"))
-    else:
-        return Response(status=status.HTTP_404_NOT_FOUND)
+    return serve_code_file(request, name, version)
 
 
 def get_common_code(request: HttpRequest, name) -> HttpResponse:
-    """Get js code file specified by name and version"""
-    filepath = Path(get_code_base_path()).resolve().joinpath(name)
-    if filepath.exists():
-        return FileResponse(filepath.open("rb"))
-    else:
-        return Response(status=status.HTTP_404_NOT_FOUND)
+    """Get js code file common to all versions specified by name"""
+    return serve_code_file(request, name)
 
 class ChartTypeView(generics.ListAPIView):
     """Get a list of supported chart types for a datasource"""
@@ -241,6 +340,8 @@ class ChartTypeView(generics.ListAPIView):
 
     def get(self, request, *args, **kwargs):
         datasource = self.get_object()
+        if datasource.status != Datasource.STATUS_READY:
+            return Response("Datasource is not available", status=status.HTTP_409_CONFLICT)
         # TODO: Error handling (Source unreachable, pive error)
         supported = get_chart_types_for_datasource(datasource)
         return Response(supported)
@@ -1,16 +1,31 @@
+import sys
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.db import transaction
 
 from rest_framework import generics, permissions, status, serializers
 from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 from ..serializers import DashboardSerializer
-from ..permissions import IsOwner, IsSharedWithUser, IsPublic, IsSemiPublic, IsShared
-from ..models import Dashboard
+from ..permissions import IsOwner, IsSharedWithUser, IsPublic, IsSemiPublic, IsShared, filter_viewable
+from ..models import Dashboard, Chart
+from ..util import resolve_chart_bundles
+from ..snapshots import get_snapshot
+from ..dashboard_config import validate_config_paths, get_malformed_chart_ids
+from ..json_patch import apply_patch, get_changed_paths, JSON_PATCH_CONTENT_TYPE
+from ..parsers import JSONPatchParser
 
 from rest_framework.response import Response
-from json import load
+from json import load, loads, dumps
 
 from .util import ShareView
 
+def get_dashboard_etag(dashboard):
+    """Get the ETag of a dashboard, derived from its version"""
+    return f'"{dashboard.version}"'
+
 class DashboardCreateListView(generics.ListCreateAPIView):
     """Add or list existing datasources, for which the caller has access rights"""
     permission_classes = [permissions.IsAuthenticated]
@@ -43,12 +58,19 @@ class DashboardRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIVie
     permission_classes = [permissions.IsAuthenticated & (IsOwner | IsShared & IsSharedWithUser | IsSemiPublic)]
     serializer_class = DashboardSerializer
     queryset = Dashboard.objects.all()
+    parser_classes = list(api_settings.DEFAULT_PARSER_CLASSES) + [JSONPatchParser]
 
     def get_object(self):
         obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
         self.check_object_permissions(self.request, obj)
         return obj
 
+    def get(self, request, *args, **kwargs):
+        dashboard = self.get_object()
+        response = Response(DashboardSerializer(dashboard, context={'request': request}).data)
+        response['ETag'] = get_dashboard_etag(dashboard)
+        return response
+
     def put(self, request, *args, **kwargs):
         # Unsupported, return 405
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -63,10 +85,35 @@ class DashboardRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIVie
         if not owner_permission.has_object_permission(request, self, current_object):
             return Response(status=status.HTTP_403_FORBIDDEN)
 
-        serializer = DashboardSerializer(current_object, data=request.data, context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
-        return Response(serializer.data)
+        # Optimistic concurrency: Updates based on an outdated version are rejected
+        base_version = current_object.version
+        if_match = request.META.get('HTTP_IF_MATCH')
+        if if_match is not None and if_match.strip() != '*' and get_dashboard_etag(current_object) not in [tag.strip() for tag in if_match.split(',')]:
+            return Response("Dashboard was modified", status=status.HTTP_412_PRECONDITION_FAILED)
+
+        if request.content_type.split(';')[0].strip() == JSON_PATCH_CONTENT_TYPE:
+            try:
+                config = apply_patch(current_object.config, request.data)
+                # Only the changed parts of the config are validated again
+                config = validate_config_paths(config, get_changed_paths(request.data))
+            except ValueError as e:
+                return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+            current_object.config = config
+            current_object.version = base_version + 1
+            save = current_object.save
+        else:
+            serializer = DashboardSerializer(current_object, data=request.data, context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            save = lambda: self.perform_update(serializer)
+
+        with transaction.atomic():
+            # Claim the version the update is based on, concurrent updates based on the same version fail
+            if not Dashboard.objects.filter(pk=current_object.pk, version=base_version).update(version=base_version + 1):
+                return Response("Dashboard was modified", status=status.HTTP_412_PRECONDITION_FAILED)
+            save()
+        response = Response(DashboardSerializer(current_object, context={'request': request}).data)
+        response['ETag'] = get_dashboard_etag(current_object)
+        return response
 
     def delete(self, request, *args, **kwargs):
         current_object = self.get_object()
@@ -81,6 +128,72 @@ class DashboardRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIVie
         current_object.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+class DashboardResolvedView(generics.RetrieveAPIView):
+    """Get a dashboard together with config, code url and small data of all charts it references"""
+    permission_classes = [permissions.IsAuthenticated & (IsOwner | IsShared & IsSharedWithUser | IsSemiPublic)]
+    serializer_class = DashboardSerializer
+    queryset = Dashboard.objects.all()
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def get(self, request, *args, **kwargs):
+        dashboard = self.get_object()
+        config = dashboard.config
+        max_bytes = getattr(settings, "DASHBOARD_RESOLVE_MAX_BYTES", 1024 * 1024)
+
+        chart_ids = list(dashboard.chart_references.order_by('position').values_list('chart_id', flat=True))
+        # One query for all access checks
+        charts = {chart.id: chart for chart in filter_viewable(Chart.objects.filter(id__in=chart_ids), request)}
+        resolved, truncated, unavailable = resolve_chart_bundles(chart_ids, charts, request, max_bytes - len(dumps(config)))
+
+        return Response({
+            'id': dashboard.id,
+            'name': dashboard.name,
+            'config': config,
+            'charts': resolved,
+            'truncated': truncated,
+            'unavailable': get_malformed_chart_ids(config) + unavailable,
+        })
+
+class DashboardSnapshotView(generics.RetrieveAPIView):
+    """Get the pre-rendered snapshot of a public or semi-public dashboard, with layout and bundles of its charts"""
+    permission_classes = [IsSemiPublic]
+    serializer_class = serializers.Serializer
+    queryset = Dashboard.objects.all()
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def get(self, request, *args, **kwargs):
+        dashboard = self.get_object()
+        fingerprint, get_document = get_snapshot(dashboard, request)
+        etag = f'"{fingerprint}"'
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(get_document(), content_type='application/json')
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=getattr(settings, "DASHBOARD_SNAPSHOT_MAX_AGE", 0))
+        return response
+
+class ChartDashboardsView(generics.ListAPIView):
+    """List the dashboards embedding a chart, which are visible to the caller"""
+    permission_classes = [permissions.IsAuthenticated & (IsOwner | IsShared & IsSharedWithUser | IsSemiPublic)]
+    serializer_class = DashboardSerializer
+    queryset = Chart.objects.all()
+
+    def get(self, request, *args, **kwargs):
+        chart = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(request, chart)
+        dashboards = filter_viewable(Dashboard.objects.filter(chart_references__chart_id=chart.id), request).order_by('name')
+        serializer = DashboardSerializer(dashboards, many=True, context={'request': request})
+        return Response(serializer.data)
+
 class DashboardShareView(ShareView):
     """ShareView for Datasources"""
     permission_classes = [permissions.IsAuthenticated & IsOwner]
@@ -1,3 +1,4 @@
+import sys
 from django.shortcuts import get_object_or_404
 from rest_framework import generics
 from ..serializers import DatasourceSerializer
@@ -6,7 +7,13 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import permissions
 from .util import ShareView
-from ..models import Datasource
+from ..models import Datasource, ShareableModel
+from ..profiling import get_datasource_profile, get_impossible_chart_types, get_unlikely_chart_types
+from ..preview import get_preview
+from ..append import append_rows
+from django.conf import settings
+from requests import RequestException
+from ..uploads import DatasourceUploadHandler, DatasourceWriter, create_uploaded_datasource, UPLOAD_CHUNK_SIZE
 
 class DatasourceCreateListView(generics.ListCreateAPIView):
     """Add or list existing datasources, for which the caller has access rights"""
@@ -35,6 +42,76 @@ class DatasourceCreateListView(generics.ListCreateAPIView):
         return Response(serializer.data)
 
 
+class DatasourceUploadView(generics.GenericAPIView):
+    """Add a datasource by streaming its file, either as multipart form field 'file' or as raw request body.
+    datasource_name and visibility are taken from the form fields or, for raw bodies, from the query parameters.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = DatasourceSerializer
+    queryset = Datasource.objects.all()
+
+    def initialize_request(self, request, *args, **kwargs):
+        # Upload handlers have to be in place before anything parses the request body
+        self.upload_handler = DatasourceUploadHandler(request)
+        request.upload_handlers = [self.upload_handler]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        writer = None
+        try:
+            if request.content_type.startswith('multipart/form-data'):
+                parameters = request.data
+                if self.upload_handler.error is not None:
+                    raise ValueError(self.upload_handler.error)
+                upload = request.FILES.get(DatasourceUploadHandler.field_name)
+                if upload is None:
+                    raise ValueError("No file specified")
+                writer = upload.writer
+            else:
+                parameters = request.query_params
+                writer = DatasourceWriter()
+                chunk = request._request.read(UPLOAD_CHUNK_SIZE)
+                while chunk:
+                    writer.write(chunk)
+                    chunk = request._request.read(UPLOAD_CHUNK_SIZE)
+
+            if not parameters.get('datasource_name'):
+                raise ValueError("No datasource_name specified")
+            visibility = int(parameters.get('visibility', ShareableModel.VISIBILITY_PRIVATE))
+            datasource = create_uploaded_datasource(writer, request.user, parameters['datasource_name'], visibility)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            # Removes the upload, unless it became a datasource
+            self.upload_handler.abort()
+            if writer is not None:
+                writer.abort()
+
+        serializer = DatasourceSerializer(datasource, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class DatasourceAppendView(generics.GenericAPIView):
+    """Append CSV rows, sent as raw request body, to an uploaded CSV datasource"""
+    permission_classes = [permissions.IsAuthenticated & IsOwner]
+    serializer_class = DatasourceSerializer
+    queryset = Datasource.objects.all()
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def post(self, request, *args, **kwargs):
+        datasource = self.get_object()
+        try:
+            datasource, appended_rows = append_rows(datasource, request._request, request)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        serializer = DatasourceSerializer(datasource, context={'request': request})
+        return Response(dict(serializer.data, appended_rows=appended_rows))
+
+
 class DatasourceRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIView):
     """Modify or delete an existing datasource"""
     permission_classes = [permissions.IsAuthenticated & (IsOwner | IsShared & IsSharedWithUser)]
@@ -78,6 +155,52 @@ class DatasourceRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIVi
         current_object.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+class DatasourceProfileView(generics.RetrieveAPIView):
+    """Get schema and column statistics of a datasource, computed on upload"""
+    permission_classes = [permissions.IsAuthenticated & (IsOwner | IsSharedWithUser)]
+    serializer_class = DatasourceSerializer
+    queryset = Datasource.objects.all()
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def get(self, request, *args, **kwargs):
+        datasource = self.get_object()
+        profile = get_datasource_profile(datasource)
+        if profile is None:
+            return Response("No profile available for this datasource", status=status.HTTP_404_NOT_FOUND)
+        return Response(dict(profile, impossible_chart_types=get_impossible_chart_types(profile), unlikely_chart_types=get_unlikely_chart_types(profile)))
+
+class DatasourcePreviewView(generics.RetrieveAPIView):
+    """Get the first rows of a datasource. CSV values are typed by parse_csv_value, which may differ from pive's typing"""
+    permission_classes = [permissions.IsAuthenticated & (IsOwner | IsSharedWithUser)]
+    serializer_class = DatasourceSerializer
+    queryset = Datasource.objects.all()
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def get(self, request, *args, **kwargs):
+        datasource = self.get_object()
+        max_rows = getattr(settings, "PREVIEW_MAX_ROWS", 1000)
+        try:
+            rows = int(request.query_params.get('rows', getattr(settings, "PREVIEW_DEFAULT_ROWS", 10)))
+        except ValueError:
+            rows = 0
+        if not 1 <= rows <= max_rows:
+            return Response(f"rows must be an integer between 1 and {max_rows}", status=status.HTTP_400_BAD_REQUEST)
+        try:
+            return Response(get_preview(datasource, rows))
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        except (OSError, RequestException) as e:
+            print(e, file=sys.stderr)
+            return Response("Datasource content is not available", status=status.HTTP_502_BAD_GATEWAY)
+
 class DatasourceShareView(ShareView):
     """ShareView for Datasources"""
     permission_classes = [permissions.IsAuthenticated & IsOwner]
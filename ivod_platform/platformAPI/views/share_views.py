@@ -0,0 +1,43 @@
+from django.db import transaction
+
+from rest_framework import generics, permissions, serializers, status
+from rest_framework.response import Response
+from ..models import User, ShareGroup
+from ..sharing import get_selection, share_objects, unshare_objects
+from .util import get_affected_objects
+
+class BulkShareView(generics.GenericAPIView):
+    """Share many charts, datasources or dashboards of the caller with many users and groups at once"""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = serializers.Serializer
+
+    def get_arguments(self, request):
+        """Get the selected objects and the affected users and groups of a request"""
+        selection = get_selection(request.data.get('type'), request.user, request.data.get('ids'), request.data.get('filter'))
+        users = get_affected_objects("users", User, request)
+        groups = get_affected_objects("groups", ShareGroup, request)
+        return selection, users, groups
+
+    def post(self, request, *args, **kwargs):
+        try:
+            with transaction.atomic():
+                selection, users, groups = self.get_arguments(request)
+                created = share_objects(selection, users, groups)
+                count = selection.count()
+        except PermissionError as e:
+            return Response(str(e), status=status.HTTP_403_FORBIDDEN)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return Response({'objects': count, 'created': created})
+
+    def delete(self, request, *args, **kwargs):
+        try:
+            with transaction.atomic():
+                selection, users, groups = self.get_arguments(request)
+                removed = unshare_objects(selection, users, groups)
+                count = selection.count()
+        except PermissionError as e:
+            return Response(str(e), status=status.HTTP_403_FORBIDDEN)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return Response({'objects': count, 'removed': removed})
@@ -1,3 +1,4 @@
+from django.db import transaction
 
 from django.shortcuts import get_object_or_404
 
@@ -5,6 +6,7 @@ from rest_framework import generics, serializers
 from ..serializers import ShareGroupSerializer
 from ..permissions import IsGroupPublic, IsUserGroupOwner, IsUserGroupMember, IsUserGroupAdmin
 from ..models import User, ShareGroup
+from ..memberships import MEMBERSHIP_ROLES, iter_identifiers, resolve_users, sync_group_members
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import permissions
@@ -99,12 +101,19 @@ class ShareGroupRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView)
         try:
             new_members = get_affected_objects("group_members", User, request)
             new_admins = get_affected_objects("group_admins", User, request)
+            new_groups = get_affected_objects("member_groups", ShareGroup, request)
         except ValueError as e:
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
 
         # Add users and groups to object
-        obj.group_members.add(*new_members)
-        obj.group_admins.add(*new_admins)
+        try:
+            with transaction.atomic():
+                obj.group_members.add(*new_members)
+                obj.group_admins.add(*new_admins)
+                obj.member_groups.add(*new_groups)
+        except ValueError as e:
+            # Member groups containing this group would form a cycle
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
         # Return current shares
         return self.get(request, *args, **kwargs)
 
@@ -114,12 +123,14 @@ class ShareGroupRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView)
         try:
             new_members = get_affected_objects("group_members", User, request)
             new_admins = get_affected_objects("group_admins", User, request)
+            new_groups = get_affected_objects("member_groups", ShareGroup, request)
         except ValueError as e:
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
 
-        # Add users and groups to object
+        # Remove users and groups from object
         obj.group_members.remove(*new_members)
         obj.group_admins.remove(*new_admins)
+        obj.member_groups.remove(*new_groups)
         # Return current shares
         return self.get(request, *args, **kwargs)
 
@@ -172,4 +183,40 @@ class ShareView(generics.RetrieveUpdateDestroyAPIView):
         obj.shared_users.remove(*new_users)
         obj.shared_groups.remove(*new_groups)
         # Return current shares
-        return self.get(request, *args, **kwargs)
\ No newline at end of file
+        return self.get(request, *args, **kwargs)
+
+
+class ShareGroupMembersView(generics.GenericAPIView):
+    """Bulk import or sync members or admins of a group from a CSV or JSON list of emails or ids, sent as raw request body.
+    POST adds the listed users, PUT makes them the only members. The role is chosen by query parameter 'role'.
+    An empty list on PUT would remove everyone, which has to be confirmed with query parameter 'allow_empty=1'.
+    """
+    serializer_class = serializers.Serializer
+    queryset = ShareGroup.objects.all()
+    permission_classes = [IsUserGroupOwner | IsUserGroupAdmin]
+
+    def get_object(self):
+        obj = get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"])
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def sync(self, request, remove):
+        group = self.get_object()
+        role = request.query_params.get('role', 'members')
+        if role not in MEMBERSHIP_ROLES:
+            return Response(f"Unknown role: {role}", status=status.HTTP_400_BAD_REQUEST)
+        try:
+            user_ids = resolve_users(iter_identifiers(request._request, request.content_type))
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        if remove and not user_ids and request.query_params.get('allow_empty', '0').lower() not in ('1', 'true'):
+            return Response("Empty list would remove all users, confirm with allow_empty=1", status=status.HTTP_400_BAD_REQUEST)
+        added, removed = sync_group_members(group, role, user_ids, remove=remove)
+        return Response({'role': role, 'added': added, 'removed': removed,
+                         'count': getattr(group, MEMBERSHIP_ROLES[role]).count()})
+
+    def post(self, request, *args, **kwargs):
+        return self.sync(request, remove=False)
+
+    def put(self, request, *args, **kwargs):
+        return self.sync(request, remove=True)
@@ -0,0 +1,68 @@
+from django.db import IntegrityError
+from rest_framework import generics, permissions, status
+from rest_framework.response import Response
+from ..models import UploadSession
+from ..serializers import UploadSessionSerializer, DatasourceSerializer
+from ..uploads import write_upload_chunk, finalize_upload_session, discard_upload_session, get_missing_chunks
+
+class UploadSessionMixin:
+    """Upload sessions are only visible to their owner"""
+
+    def get_object(self):
+        return generics.get_object_or_404(UploadSession, pk=self.kwargs["pk"], owner=self.request.user)
+
+class UploadSessionCreateView(generics.CreateAPIView):
+    """Start a resumable upload of a datasource file"""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    queryset = UploadSession.objects.all()
+
+class UploadSessionView(UploadSessionMixin, generics.RetrieveDestroyAPIView):
+    """Show the progress of an upload session or abort it"""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    queryset = UploadSession.objects.all()
+
+    def perform_destroy(self, instance):
+        discard_upload_session(instance)
+
+class UploadChunkView(UploadSessionMixin, generics.GenericAPIView):
+    """Upload a chunk of an upload session as raw request body, with its SHA-256 hex digest in the header X-Chunk-SHA256"""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    queryset = UploadSession.objects.all()
+
+    def put(self, request, *args, **kwargs):
+        session = self.get_object()
+        sha256 = request.headers.get('X-Chunk-SHA256')
+        if not sha256:
+            return Response("Header X-Chunk-SHA256 missing", status=status.HTTP_400_BAD_REQUEST)
+        try:
+            write_upload_chunk(session, self.kwargs["index"], request._request, sha256)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        except UploadSession.DoesNotExist:
+            return Response("Upload session was finalized or discarded", status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class UploadSessionFinalizeView(UploadSessionMixin, generics.GenericAPIView):
+    """Turn a complete upload session into a datasource"""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    queryset = UploadSession.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        session = self.get_object()
+        missing_chunks = get_missing_chunks(session)
+        if missing_chunks:
+            return Response({'missing_chunks': missing_chunks}, status=status.HTTP_409_CONFLICT)
+        try:
+            datasource = finalize_upload_session(session)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        except UploadSession.DoesNotExist:
+            return Response("Upload session was finalized or discarded", status=status.HTTP_404_NOT_FOUND)
+        except IntegrityError:
+            return Response("A datasource with this name exists already", status=status.HTTP_409_CONFLICT)
+        serializer = DatasourceSerializer(datasource, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
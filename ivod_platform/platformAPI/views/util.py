@@ -7,17 +7,15 @@ from rest_framework.response import Response
 
 def get_affected_objects(key, clazz, request, error_on_missing=True):
     """Get user objects affected in this request"""
-    affected_users = clazz.objects.filter(pk__in=request.data.get(key, []))
+    pks = request.data.get(key, [])
+    affected_objects = clazz.objects.filter(pk__in=pks)
     if error_on_missing:
-        for pk in request.data.get(key, []):
-            user_missing = True
-            for user in affected_users:
-                if str(pk) == str(user.id):
-                    user_missing = False
-                    continue
-            if user_missing:
+        # One query for the ids that exist, compared as strings like they were given
+        found = {str(pk) for pk in affected_objects.values_list('pk', flat=True)}
+        for pk in pks:
+            if str(pk) not in found:
                 raise ValueError(f"{pk} doesnt refer to any objects")
-    return affected_users
+    return affected_objects
 
 class ShareView(generics.RetrieveUpdateDestroyAPIView):
     """ Read, update or delete shares on sharable objects"""
@@ -13,8 +13,12 @@ setup(
                       'aiosmtpd',
                       'django-ratelimit',
                       'drf-jwt',
+                      'numpy',
                       f'pive=={HARDCODED_PIVE_VERSION}',
                       ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     dependency_links = [
         f'git+ssh://git@github.com/internet-sicherheit/pive@develop#egg=pive-{HARDCODED_PIVE_VERSION}',
         ''.join(['file://', str(Path(__file__).resolve().parent.joinpath(f'pive#egg=pive-{HARDCODED_PIVE_VERSION}'))])